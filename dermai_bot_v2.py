@@ -1,19 +1,104 @@
-import asyncio
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, filters
+import time
+
+STARTED = time.perf_counter()          # для отчёта о холодном старте (до остальных импортов)
+
+import os
 from utils.bot import SkinBot
-from utils.db import DBHandler
+from utils.photo import PhotoPipeline
+from utils.photo_cache import PhotoCache
+from utils.storage import create_storage
 
-# DB_CONFIG = {
-#     "user": "postgres",
-#     "password": "dermai",
-#     "database": "dermai_assistant_bot",
-#     "host": "127.0.0.1",
-#     "port": 5432
-# }
+DB_CONFIG = {
+    "user": "postgres",
+    "password": "dermai",
+    "database": "dermai_assistant_bot",
+    "host": "127.0.0.1",
+    "port": 5432
+}
 
 TOKEN = "here bot TOKEN"
 
+# Telegram user id администраторов (доступ к /stats), через запятую
+ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()]
+
+# Хранилище: csv (patients.csv) | postgres (DB_CONFIG) | memory
+STORAGE = os.getenv("STORAGE", "csv")
+
+# Пакетная запись в Postgres (None — каждая запись сразу).
+# max_pending ограничивает, сколько операций можно потерять при падении.
+WRITE_BEHIND = {
+    "batch_size": 200,
+    "flush_interval": 0.05,
+    "max_pending": 2000
+} if os.getenv("WRITE_BEHIND", "0") == "1" else None
+
+# Журнал незавершённых тестов: переживает перезапуск бота ("" — не сохранять)
+SESSIONS_FILE = os.getenv("SESSIONS_FILE", "sessions.jsonl")
+
+# Сколько апдейтов обрабатывать одновременно
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "16"))
+
+# Адрес Bot API (пусто — api.telegram.org; для нагрузочного теста — фейковый сервер)
+BOT_API_URL = os.getenv("BOT_API_URL", "")
+
+# Классификатор фото дерматоскопа ("модуль:Класс") и число процессов анализа
+PHOTO_CLASSIFIER = os.getenv("PHOTO_CLASSIFIER", "utils.photo:StubClassifier")
+PHOTO_WORKERS = int(os.getenv("PHOTO_WORKERS", "0")) or None      # 0 — по числу ядер (до 4)
+# Кэш результатов анализа на диске ("" — только в памяти)
+PHOTO_CACHE_FILE = os.getenv("PHOTO_CACHE_FILE", "photo_cache.sqlite")
+
+# file_id отправленных PDF-отчётов ("" — только в памяти, до перезапуска)
+FILE_IDS_FILE = os.getenv("FILE_IDS_FILE", "file_ids.jsonl")
+
+# Каталог средств для подбора ухода (JSON lines, см. utils/care.py)
+CARE_CATALOG = os.getenv("CARE_CATALOG", "data/care_catalog.jsonl")
+
+# LLM для текста рекомендаций: OpenAI-совместимый сервер (пусто — без LLM;
+# для проверки — python -m tools.fake_llm и LLM_URL=http://127.0.0.1:8081)
+LLM_URL = os.getenv("LLM_URL", "")
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-3.5-turbo-instruct")
+LLM_API_KEY = os.getenv("LLM_API_KEY")
+# Векторный индекс заметок для промта LLM (каталог, пересобирается при изменении корпуса)
+RAG_INDEX_DIR = os.getenv("RAG_INDEX_DIR", "rag_index")
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (0 — не отдавать)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Режим получения апдейтов: polling | webhook
+MODE = os.getenv("MODE", "polling")
+WEBHOOK = {
+    "listen": os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+    "port": int(os.getenv("WEBHOOK_PORT", "8443")),
+    "url_path": os.getenv("WEBHOOK_PATH", "bot"),
+    "webhook_url": os.getenv("WEBHOOK_URL"),        # публичный https-адрес, напр. https://example.com/bot
+    "secret_token": os.getenv("WEBHOOK_SECRET"),
+} if MODE == "webhook" else None
+
 if __name__ == "__main__":
+    if LLM_URL:
+        from utils.llm import LLMClient
 
-    bot = SkinBot(token=TOKEN)
-    bot.run()
+    storage = create_storage(STORAGE, db_config=DB_CONFIG, write_behind=WRITE_BEHIND)
+    bot = SkinBot(
+        token=TOKEN,
+        storage=storage,
+        admin_ids=ADMIN_IDS,
+        sessions_path=SESSIONS_FILE or None,
+        concurrent_updates=CONCURRENT_UPDATES,
+        base_url=f"{BOT_API_URL}/bot" if BOT_API_URL else None,
+        base_file_url=f"{BOT_API_URL}/file/bot" if BOT_API_URL else None,
+        photo_pipeline=PhotoPipeline(
+            PHOTO_CLASSIFIER,
+            workers=PHOTO_WORKERS,
+            cache=PhotoCache(PHOTO_CLASSIFIER, path=PHOTO_CACHE_FILE or None)
+        ),
+        file_ids_path=FILE_IDS_FILE or None,
+        care_catalog=CARE_CATALOG,
+        llm=LLMClient(LLM_URL, LLM_MODEL, api_key=LLM_API_KEY) if LLM_URL else None,
+        rag_path=RAG_INDEX_DIR or None,
+        metrics_port=METRICS_PORT or None,
+        metrics_host=METRICS_HOST,
+        started_at=STARTED
+    )
+    bot.run(webhook=WEBHOOK)
@@ -0,0 +1,493 @@
+import argparse
+import asyncio
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from itertools import count
+
+# ===============================================================
+#        МИКРОБЕНЧМАРКИ ГОРЯЧИХ ПУТЕЙ (хранилище, тест, БД)
+# ===============================================================
+#
+# Три группы замеров, результаты — в JSON, который можно сравнить
+# с прошлым прогоном (--compare) и упасть, если что-то замедлилось:
+#
+#   csv.*  — функции utils/dataset_csv.py на синтетических patients.csv
+#            от 1k до 1M строк: построение индекса при открытии,
+#            save_initial_data, save_test_results, save_dermatoscopy_result,
+#            get_patient_json (задержки p50/p99 на операцию);
+#   test.* — SkinTest.classify_baumann, explain_skin_type,
+#            compare_skin_types в цикле (нс на вызов, лучший из повторов);
+#   db.*   — методы DBHandler против локальной замены пула asyncpg
+#            (считает обращения к базе, задержка --db-latency) или против
+#            настоящего Postgres (--db), с пакетной записью и без.
+#
+# csv.* и db.* повторяются --passes раз (csv — каждый раз на свежей копии
+# файла), в отчёт идёт лучший проход и медиана проходов. При сравнении
+# порог умножается на разброс (медиана / лучший) — шумный замер на
+# одном и том же коде регрессией не считается.
+#
+# Для csv.* в JSON есть ещё scaling — во сколько раз операция на самом
+# большом файле медленнее, чем на самом маленьком: рост этого числа
+# между коммитами и есть «хранилище стало хуже масштабироваться».
+#
+#   python -m tools.bench --json bench.json
+#   python -m tools.bench --sizes 1k,10k --ops 500 --compare bench.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SIZES = "1k,10k,100k,1m"
+CSV_OPS = ("save_initial_data", "save_test_results", "save_dermatoscopy_result", "get_patient_json")
+SKIN_LETTERS = ("OD", "SR", "PN", "WT")
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().lower()
+    scale = {"k": 1_000, "m": 1_000_000}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * scale)
+
+
+def patient_id(i: int) -> str:
+    """Детерминированный id в формате uuid: не нужно хранить список id в памяти."""
+    return f"{i:08x}-0000-4000-8000-00000000beef"
+
+
+def random_code(rnd: random.Random) -> str:
+    return "".join(rnd.choice(pair) for pair in SKIN_LETTERS)
+
+
+# -----------------------------------------------------------
+#                        ЗАМЕРЫ
+# -----------------------------------------------------------
+
+def summarize(latencies: list, total: float) -> dict:
+    latencies = sorted(latencies)
+    n = len(latencies)
+    return {
+        "ops": n,
+        "total_s": total,
+        "ops_per_s": n / total if total else 0.0,
+        "us_per_op": total / n * 1e6 if n else 0.0,
+        "p50_us": latencies[n // 2] * 1e6 if n else 0.0,
+        "p99_us": latencies[min(n - 1, int(n * 0.99))] * 1e6 if n else 0.0,
+    }
+
+
+async def run_async(op, calls: list, concurrency: int = 1) -> dict:
+    """op(*args) для каждого args из calls, в concurrency параллельных задачах."""
+    latencies = []
+    pending = iter(calls)
+
+    async def worker():
+        for args in pending:
+            started = time.perf_counter()
+            await op(*args)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def best_of(passes: list) -> dict:
+    """Лучший проход (по us_per_op) + медиана проходов — для сравнения с учётом шума."""
+    passes = sorted(passes, key=lambda r: r["us_per_op"])
+    return {**passes[0], "median_us": passes[len(passes) // 2]["us_per_op"], "passes": len(passes)}
+
+
+def run_sync(fn, inputs: list, repeat: int = 5) -> dict:
+    """fn(x) по всем inputs, repeat раз; время — лучший и медианный проход."""
+    passes = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for x in inputs:
+            fn(x)
+        passes.append((time.perf_counter() - started) / len(inputs))
+    passes.sort()
+    return {
+        "ops": len(inputs) * repeat,
+        "us_per_op": passes[0] * 1e6,
+        "median_us": passes[len(passes) // 2] * 1e6,
+        "ops_per_s": 1 / passes[0] if passes[0] else 0.0,
+    }
+
+
+# -----------------------------------------------------------
+#                  CSV: СИНТЕТИЧЕСКИЕ ДАННЫЕ
+# -----------------------------------------------------------
+
+def make_patients_csv(path: str, rows: int, seed: int = 1):
+    """patients.csv на rows пациентов (по одной версии записи на каждого)."""
+    from utils.storage import HEADERS
+    from utils.test import QUESTIONNAIRE_VERSION, QUESTIONS
+
+    rnd = random.Random(seed)
+    answers = [json.dumps([rnd.choice("AB") for _ in QUESTIONS]) for _ in range(256)]
+    allergies = ["нет", "нет", "нет", "орехи", "мёд", "отдушки", "спирт, отдушки", "латекс"]
+    seasons = ["Осень/Зима", "Весна/Лето", ""]
+    created_from = 1735689600            # 2025-01-01, записи за ~два года
+    started = time.perf_counter()
+    with open(path + ".tmp", "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADERS)
+        for i in range(rows):
+            code, derm = random_code(rnd), random_code(rnd)
+            matches = sum(a == b for a, b in zip(code, derm))
+            writer.writerow([
+                patient_id(i), rnd.randint(14, 80), rnd.choice("МЖ"), rnd.choice(allergies),
+                rnd.choice(answers), code, derm, matches * 25.0, derm, rnd.choice(seasons),
+                QUESTIONNAIRE_VERSION, "",
+                time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(created_from + rnd.randrange(2 * 365 * 86400))),
+                "yes",
+            ])
+    os.replace(path + ".tmp", path)
+    print(f"📝 {path}: {rows} строк за {time.perf_counter() - started:.1f} с")
+
+
+async def bench_csv(rows: int, data_dir: str, ops: int, concurrency: int, seed: int, passes: int = 3) -> dict:
+    source = os.path.join(data_dir, f"patients-{rows}.csv")
+    if not os.path.exists(source):
+        make_patients_csv(source, rows, seed)
+    runs = {}
+    for _ in range(passes):
+        for op, result in (await _csv_pass(rows, source, ops, concurrency, seed)).items():
+            runs.setdefault(op, []).append(result)
+    return {op: best_of(results) for op, results in runs.items()}
+
+
+async def _csv_pass(rows: int, source: str, ops: int, concurrency: int, seed: int) -> dict:
+    from utils import dataset_csv
+
+    # Замеры дописывают в файл — каждый проход на свежей копии, исходник переиспользуется
+    await dataset_csv.close_store()
+    dataset_csv.CSV_FILE = os.path.abspath(f"work-{rows}.csv")
+    shutil.copyfile(source, dataset_csv.CSV_FILE)
+
+    rnd = random.Random(seed)
+    results = {}
+    started = time.perf_counter()
+    await dataset_csv.open_store()
+    opened = time.perf_counter() - started
+    results["open"] = {"ops": 1, "total_s": opened, "us_per_op": opened * 1e6}
+
+    def existing():
+        return [patient_id(rnd.randrange(rows)) for _ in range(ops)]
+
+    calls = {
+        "save_initial_data": [(patient_id(rows + i), rnd.randint(14, 80), rnd.choice("МЖ"), "нет")
+                              for i in range(ops)],
+        "save_test_results": [(i, json.dumps(["A"] * 24), random_code(rnd), "Осень/Зима", "bench")
+                              for i in existing()],
+        "save_dermatoscopy_result": [(i, random_code(rnd), random_code(rnd)) for i in existing()],
+        "get_patient_json": [(i,) for i in existing()],
+    }
+    for op in CSV_OPS:
+        results[op] = await run_async(getattr(dataset_csv, op), calls[op], concurrency)
+
+    await dataset_csv.close_store()
+    os.remove(dataset_csv.CSV_FILE)
+    if os.path.exists(dataset_csv.CSV_FILE + ".lock"):
+        os.remove(dataset_csv.CSV_FILE + ".lock")
+    return results
+
+
+# -----------------------------------------------------------
+#                  АНКЕТА И СРАВНЕНИЕ ТИПОВ
+# -----------------------------------------------------------
+
+def bench_test(calls: int, repeat: int, seed: int) -> dict:
+    from utils.test import SKIN_CODES, SkinTest, compare_skin_types
+
+    rnd = random.Random(seed)
+    test = SkinTest()
+    answers = [test.pair_answers([rnd.choice("AB") for _ in test.questions]) for _ in range(calls)]
+    # Известные коды, изредка — неизвестный (объяснение собирается на лету)
+    codes = [rnd.choice(SKIN_CODES) if i % 16 else random_code(rnd).lower() for i in range(calls)]
+    pairs = [(random_code(rnd), random_code(rnd)) if i % 8 else ("", random_code(rnd)) for i in range(calls)]
+    return {
+        "classify_baumann": run_sync(test.classify_baumann, answers, repeat),
+        "classify_bits": run_sync(test.classify_bits, [test.pack(a for _, a in x) for x in answers], repeat),
+        "explain_skin_type": run_sync(test.explain_skin_type, codes, repeat),
+        "compare_skin_types": run_sync(lambda p: compare_skin_types(*p), pairs, repeat),
+    }
+
+
+# -----------------------------------------------------------
+#                  DBHandler: ЗАМЕНА ПУЛА
+# -----------------------------------------------------------
+
+class StandInConnection:
+    """Соединение asyncpg без сервера: только то, что вызывает DBHandler."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def _roundtrip(self):
+        self.pool.roundtrips += 1
+        if self.pool.latency:
+            await asyncio.sleep(self.pool.latency)
+
+    async def execute(self, sql, *args):
+        await self._roundtrip()
+        return "OK"
+
+    async def executemany(self, sql, args):
+        await self._roundtrip()
+
+    async def fetchrow(self, sql, *args):
+        await self._roundtrip()
+        if "RETURNING id" in sql:
+            return {"id": next(self.pool.ids)}
+        return dict(self.pool.row, id_patient=args[0])
+
+    async def fetchval(self, sql, *args):
+        await self._roundtrip()
+        return next(self.pool.ids) if "RETURNING id" in sql else 1
+
+    async def fetch(self, sql, *args):
+        await self._roundtrip()
+        return [{"id": next(self.pool.ids)} for _ in range(args[1])]     # nextval(...) FROM generate_series
+
+    async def copy_records_to_table(self, table, records, columns):
+        await self._roundtrip()
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+
+class StandInPool:
+    def __init__(self, size: int = 10, latency: float = 0.0):
+        self.latency = latency
+        self.roundtrips = 0
+        self.ids = count(1)
+        self.row = {"age": "30", "sex": "Ж", "allergies": "нет", "answers_json": "[]", "skin_code": "OSPW",
+                    "skin_type_dermatoscopy": "OSPW", "match_percent": "100", "final_skin_type": "OSPW",
+                    "time_of_year": "", "questionnaire_version": "", "abandoned_stage": "",
+                    "created_at": "2026-01-01T00:00:00Z", "consent": "yes", "updated_at": None}
+        self._free = asyncio.Semaphore(size)
+
+    @asynccontextmanager
+    async def acquire(self):
+        async with self._free:
+            yield StandInConnection(self)
+
+    async def close(self):
+        pass
+
+
+async def bench_db(ops: int, concurrency: int, latency: float, db_config: dict, seed: int,
+                   passes: int = 3) -> dict:
+    try:
+        from utils.db import DBHandler
+    except ImportError as e:
+        print(f"⚠️ DBHandler пропущен: {e}")
+        return {}
+
+    rnd = random.Random(seed)
+    runs = {}
+    for _ in range(passes):
+        for name, result in (await _db_pass(DBHandler, ops, concurrency, latency, db_config, rnd)).items():
+            runs.setdefault(name, []).append(result)
+    return {name: best_of(results) for name, results in runs.items()}
+
+
+async def _db_pass(DBHandler, ops: int, concurrency: int, latency: float, db_config: dict,
+                   rnd: random.Random) -> dict:
+    results = {}
+    for mode, write_behind in (("direct", None),
+                               ("write_behind", {"batch_size": 200, "flush_interval": 0.005, "max_pending": 2000})):
+        db = DBHandler(db_config or {}, write_behind=write_behind)
+        if db_config:
+            await db.init_db()
+            target = "postgres"
+        else:
+            db.pool = StandInPool(latency=latency)
+            if db.write_behind is not None:
+                db.write_behind.start()
+            target = "standin"
+        offset = rnd.randrange(1 << 24) << 8
+        ids = [patient_id(offset + i) for i in range(ops)]
+        calls = {
+            "create_patient_initial": (lambda *a: db.create_patient_initial(*a, wait=write_behind is None),
+                                       [("Ж", 30, "нет", i) for i in ids]),
+            "update_test_results": (db.update_test_results,
+                                    [(i, ["A"] * 24, random_code(rnd), "Весна/Лето", "bench") for i in ids]),
+            "save_dermatoscopy_result": (db.save_dermatoscopy_result,
+                                         [(i, random_code(rnd), random_code(rnd)) for i in ids]),
+            "get_patient": (db.get_patient, [(i,) for i in ids]),
+        }
+        for op, (fn, args) in calls.items():
+            before = getattr(db.pool, "roundtrips", 0)
+            result = await run_async(fn, args, concurrency)
+            await db.flush()
+            if target == "standin":
+                result["roundtrips_per_op"] = (db.pool.roundtrips - before) / len(args)
+            results[f"{target}.{mode}.{op}"] = result
+        await db.close()
+    return results
+
+
+# -----------------------------------------------------------
+#                     ОТЧЁТ И СРАВНЕНИЕ
+# -----------------------------------------------------------
+
+def git_commit() -> dict:
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True, timeout=10).stdout.strip()
+    try:
+        return {"commit": git("rev-parse", "--short", "HEAD") or None,
+                "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+    except (OSError, subprocess.SubprocessError):
+        return {"commit": None, "dirty": None}
+
+
+def scaling(results: dict, sizes: list) -> dict:
+    """Во сколько раз операция на самом большом файле дороже, чем на самом маленьком."""
+    if len(sizes) < 2:
+        return {}
+    small, large = min(sizes), max(sizes)
+    out = {}
+    for op in ("open",) + CSV_OPS:
+        a, b = results.get(f"csv.{op}@{small}"), results.get(f"csv.{op}@{large}")
+        if a and b and a["us_per_op"]:
+            out[f"csv.{op}"] = b["us_per_op"] / a["us_per_op"]
+    return out
+
+
+def print_results(results: dict):
+    print(f"\n{'замер':<58}{'мкс/оп':>12}{'p50':>10}{'p99':>10}{'оп/с':>12}")
+    for name, r in results.items():
+        p50 = f"{r['p50_us']:.1f}" if "p50_us" in r else "—"
+        p99 = f"{r['p99_us']:.1f}" if "p99_us" in r else "—"
+        rate = f"{r['ops_per_s']:.0f}" if "ops_per_s" in r else "—"
+        print(f"{name:<58}{r['us_per_op']:>12.2f}{p50:>10}{p99:>10}{rate:>12}")
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> list:
+    """
+    Замеры, ставшие медленнее baseline больше чем в threshold раз. Порог
+    замера умножается на его разброс (медиана / лучший проход, больший
+    из двух прогонов): одиночный медленный проход не регрессия.
+    """
+    regressions = []
+    rows = [(name, r["us_per_op"], baseline["results"][name]["us_per_op"],
+             max(_noise(r), _noise(baseline["results"][name])))
+            for name, r in report["results"].items() if name in baseline.get("results", {})]
+    # scaling — отношение двух шумных замеров: разброс входит дважды
+    rows += [(f"scaling:{name}", value, baseline["scaling"][name],
+              max((_noise(r) for results in (report["results"], baseline["results"])
+                   for key, r in results.items() if key.startswith(f"{name}@")), default=1.0) ** 2)
+             for name, value in report.get("scaling", {}).items() if name in baseline.get("scaling", {})]
+    print(f"\nСравнение с {baseline.get('meta', {}).get('commit') or 'baseline'} (порог ×{threshold}):")
+    for name, new, old, noise in rows:
+        limit = threshold * noise
+        ratio = new / old if old else float("inf")
+        mark = "🔴" if ratio > limit else ("🟢" if ratio < 1 / limit else "  ")
+        note = f" (порог ×{limit:.2f} с учётом разброса)" if noise > 1.0 else ""
+        print(f"{mark} {name:<58}{old:>12.2f} → {new:<12.2f} ×{ratio:.2f}{note}")
+        if ratio > limit:
+            regressions.append(name)
+    return regressions
+
+
+def _noise(result: dict) -> float:
+    best, median = result.get("us_per_op"), result.get("median_us")
+    return max(1.0, median / best) if best and median else 1.0
+
+
+async def run(args) -> dict:
+    sizes = [parse_size(s) for s in args.sizes.split(",") if s.strip()] if args.sizes else []
+    data_dir = os.path.abspath(args.data_dir or ".")
+    os.makedirs(data_dir, exist_ok=True)
+    results = {}
+
+    if "test" in args.only:
+        for op, r in bench_test(args.calls, args.repeat, args.seed).items():
+            results[f"test.{op}"] = r
+    if "csv" in args.only:
+        for rows in sizes:
+            print(f"📦 csv: {rows} строк")
+            for op, r in (await bench_csv(rows, data_dir, args.ops, args.concurrency, args.seed,
+                                                  args.passes)).items():
+                results[f"csv.{op}@{rows}"] = r
+    if "db" in args.only:
+        db_config = json.loads(args.db) if args.db else None
+        for op, r in (await bench_db(args.ops, args.concurrency, args.db_latency, db_config, args.seed,
+                                                args.passes)).items():
+            results[f"db.{op}"] = r
+
+    return {
+        "meta": {
+            **git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("json", "compare", "db")},
+        },
+        "results": results,
+        "scaling": scaling(results, sizes),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Микробенчмарки хранилища, анкеты и DBHandler")
+    parser.add_argument("--only", default="test,csv,db", help="группы замеров через запятую: test,csv,db")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="размеры patients.csv, напр. 1k,10k,100k,1m")
+    parser.add_argument("--ops", type=int, default=2000, help="операций хранилища на каждый замер")
+    parser.add_argument("--concurrency", type=int, default=1, help="параллельных задач для операций хранилища")
+    parser.add_argument("--calls", type=int, default=100_000, help="вызовов на проход для test.*")
+    parser.add_argument("--repeat", type=int, default=5, help="проходов для test.* (берётся лучший)")
+    parser.add_argument("--passes", type=int, default=3, help="проходов для csv.* и db.* (берётся лучший)")
+    parser.add_argument("--db", help="JSON с параметрами настоящего Postgres (по умолчанию — замена пула)")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="задержка замены пула на обращение, с")
+    parser.add_argument("--data-dir", help="где хранить синтетические файлы между прогонами")
+    parser.add_argument("--workdir", help="рабочий каталог (по умолчанию — временный)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="записать результаты в JSON-файл")
+    parser.add_argument("--compare", help="JSON прошлого прогона: показать разницу")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="во сколько раз медленнее считать регрессией (код выхода 1)")
+    args = parser.parse_args(argv)
+    args.only = sorted({s.strip() for s in args.only.split(",")})
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    json_path = os.path.abspath(args.json) if args.json else None
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+    if args.data_dir:
+        args.data_dir = os.path.abspath(args.data_dir)
+    # Копии patients.csv, .lock и т.п. — не в рабочей копии
+    workdir = args.workdir or tempfile.mkdtemp(prefix="skinbot-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    print(f"📂 Рабочий каталог: {workdir}")
+
+    report = asyncio.run(run(args))
+    print_results(report["results"])
+    for name, value in report["scaling"].items():
+        print(f"📈 {name}: ×{value:.2f} от {min(parse_size(s) for s in args.sizes.split(','))} "
+              f"до {max(parse_size(s) for s in args.sizes.split(','))} строк")
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 {json_path}")
+    if baseline_path:
+        with open(baseline_path, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print(f"❌ Медленнее порога: {', '.join(regressions)}")
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import random
+import time
+from collections import Counter, defaultdict
+
+from tools.mini_http import read_request, respond
+
+# ===============================================================
+#             ФЕЙКОВЫЙ TELEGRAM BOT API (для нагрузки)
+# ===============================================================
+#
+# Отвечает на вызовы бота так же, как api.telegram.org, но локально и
+# мгновенно: getMe, getUpdates (long polling из очереди push_update),
+# send*/edit*, answerCallbackQuery, getFile и скачивание файлов
+# (/file/bot<токен>/<путь>). Всё, что бот отправил в чат, передаётся
+# в on_reply(chat_id, method, message) — по этому нагрузочный тест
+# понимает, что бот ответил пользователю.
+# Бот подключается через SkinBot(base_url="http://127.0.0.1:<port>/bot",
+#                                base_file_url="http://127.0.0.1:<port>/file/bot").
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "SkinBot", "username": "fake_skin_bot",
+            "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+
+def make_photo(seed: int, size: int = 640) -> bytes:
+    """JPEG «дерматоскопа»: пятна на фоне кожи, разные для разных seed."""
+    from PIL import Image, ImageDraw
+
+    rnd = random.Random(seed)
+    img = Image.new("RGB", (size, size), (rnd.randint(170, 230), rnd.randint(120, 170), rnd.randint(100, 150)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(rnd.randint(5, 40)):
+        x, y, r = rnd.randrange(size), rnd.randrange(size), rnd.randint(3, 40)
+        shade = rnd.randint(60, 255)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=(shade, rnd.randint(40, 200), rnd.randint(40, 160)))
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=85)
+    return out.getvalue()
+
+
+class FakeBotAPI:
+    def __init__(self, on_reply=None, updates_limit: int = 100):
+        self.on_reply = on_reply
+        self.updates_limit = updates_limit
+        self.files = {}                      # file_id -> байты
+        self.calls = Counter()               # метод -> число вызовов
+        self._updates = []
+        self._has_updates = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = defaultdict(itertools.count)    # chat_id -> счётчик message_id
+        self._file_ids = itertools.count(1)
+
+    # -----------------------------------------------------------
+    #                    ВХОДЯЩИЕ АПДЕЙТЫ
+    # -----------------------------------------------------------
+
+    def push_update(self, update: dict) -> int:
+        update["update_id"] = next(self._update_ids)
+        self._updates.append(update)
+        self._has_updates.set()
+        return update["update_id"]
+
+    def add_file(self, data: bytes) -> str:
+        file_id = f"file{next(self._file_ids)}"
+        self.files[file_id] = data
+        return file_id
+
+    def next_message_id(self, chat_id) -> int:
+        return next(self._message_ids[chat_id]) + 1
+
+    async def _get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset", 0) or 0)
+        timeout = float(params.get("timeout", 0) or 0)
+        limit = min(int(params.get("limit", self.updates_limit) or self.updates_limit), self.updates_limit)
+        # Подтверждённые (update_id < offset) больше не отдаём
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._has_updates.clear()
+            try:
+                await asyncio.wait_for(self._has_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    # -----------------------------------------------------------
+    #                       МЕТОДЫ BOT API
+    # -----------------------------------------------------------
+
+    async def call(self, method: str, params: dict):
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method == "getMe":
+            return BOT_USER
+        if method == "getFile":
+            file_id = params["file_id"]
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.files.get(file_id, b"")),
+                    "file_path": f"files/{file_id}"}
+        if method.startswith(("send", "edit", "copy", "forward")):
+            return self._reply(method, params)
+        return True          # answerCallbackQuery, deleteWebhook, setMyCommands, ...
+
+    def _reply(self, method: str, params: dict) -> dict:
+        chat_id = int(params["chat_id"])
+        message_id = int(params["message_id"]) if "message_id" in params else self.next_message_id(chat_id)
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if "caption" in params:
+            message["caption"] = params["caption"]
+        if "reply_markup" in params:
+            message["reply_markup"] = json.loads(params["reply_markup"])
+        if "document" in params:
+            document = params["document"]
+            if isinstance(document, bytes):
+                document = self.add_file(document)
+            message["document"] = {"file_id": document, "file_unique_id": document,
+                                   "file_size": len(self.files.get(document, b""))}
+        if self.on_reply is not None:
+            self.on_reply(chat_id, method, message)
+        return message
+
+    # -----------------------------------------------------------
+    #                          HTTP
+    # -----------------------------------------------------------
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                parts = request.path.strip("/").split("/")
+                if len(parts) >= 3 and parts[0] == "file":          # /file/bot<токен>/<путь>
+                    data = self.files.get(parts[-1])
+                    await respond(writer, 200 if data is not None else 404, data or b"",
+                                  "application/octet-stream")
+                    continue
+                if len(parts) != 2 or not parts[0].startswith("bot"):
+                    await respond(writer, 404, b'{"ok": false, "error_code": 404, "description": "Not Found"}')
+                    continue
+                result = await self.call(parts[1], request.form())
+                await respond(writer, 200, json.dumps({"ok": True, "result": result}, ensure_ascii=False).encode())
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass             # клиент ушёл или сервер останавливается посреди long polling
+        finally:
+            writer.close()
+
+
+async def serve(host: str = "127.0.0.1", port: int = 8082, on_reply=None) -> tuple:
+    """Запускает сервер в текущем event loop: (FakeBotAPI, asyncio.Server)."""
+    api = FakeBotAPI(on_reply)
+    server = await asyncio.start_server(api.handle, host, port, limit=2**20)
+    return api, server
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Фейковый Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    args = parser.parse_args()
+
+    api, server = await serve(args.host, args.port,
+                              on_reply=lambda chat_id, method, message: print(f"→ {chat_id} {method}: "
+                                                                              f"{message.get('text', '')[:60]!r}"))
+    print(f"🤖 Фейковый Bot API на http://{args.host}:{args.port} (BOT_API_URL=http://{args.host}:{args.port})")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        print(f"Вызовы: {dict(api.calls)}")
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import json
+import time
+
+from tools.mini_http import end_chunked, read_request, respond, start_chunked, write_chunk
+
+# ===============================================================
+#          ЛОКАЛЬНАЯ ЗАМЕНА LLM-СЕРВЕРА (для проверок и нагрузки)
+# ===============================================================
+#
+# Отвечает на POST /v1/completions (stream=true) как OpenAI-совместимый
+# сервер: на каждый промт из списка — один и тот же ответ по словам,
+# с задержкой delay секунд на «токен»; пакет промтов генерируется
+# параллельно (как у настоящего сервера с батчингом).
+#
+#   python -m tools.fake_llm --port 8081 --delay 0.02
+#   LLM_URL=http://127.0.0.1:8081 python dermai_bot_v2.py
+
+ANSWER = (
+    "Утром: мягкое очищение, тонер, лёгкое увлажнение и обязательно SPF. "
+    "Вечером: очищение, сыворотка по типу кожи и питательный крем. "
+    "Новые средства вводите по одному и следите за реакцией кожи."
+)
+
+
+class FakeLLM:
+    def __init__(self, delay: float = 0.02, answer: str = ANSWER):
+        self.delay = delay
+        self.words = answer.split(" ")
+        self.requests = 0
+        self.prompts = 0
+        self.max_batch = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                if request.method != "POST" or request.path != "/v1/completions":
+                    await respond(writer, 404, b'{"error": "not found"}')
+                    continue
+                payload = json.loads(request.body or b"{}")
+                prompts = payload.get("prompt", "")
+                prompts = prompts if isinstance(prompts, list) else [prompts]
+                self.requests += 1
+                self.prompts += len(prompts)
+                self.max_batch = max(self.max_batch, len(prompts))
+                await self._stream(writer, len(prompts), payload.get("model", "fake"))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _stream(self, writer: asyncio.StreamWriter, count: int, model: str):
+        start_chunked(writer, "text/event-stream")
+        created = int(time.time())
+        for n, word in enumerate(self.words):
+            await asyncio.sleep(self.delay)
+            piece = word if n == 0 else " " + word
+            for index in range(count):
+                chunk = {"object": "text_completion", "created": created, "model": model,
+                         "choices": [{"index": index, "text": piece, "finish_reason": None}]}
+                write_chunk(writer, f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            await writer.drain()
+        write_chunk(writer, b"data: [DONE]\n\n")
+        end_chunked(writer)
+        await writer.drain()
+
+
+async def serve(host: str = "127.0.0.1", port: int = 8081, delay: float = 0.02) -> tuple:
+    """Запускает сервер в текущем event loop: (FakeLLM, asyncio.Server)."""
+    fake = FakeLLM(delay)
+    server = await asyncio.start_server(fake.handle, host, port)
+    return fake, server
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Фейковый OpenAI-совместимый LLM-сервер")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--delay", type=float, default=0.02, help="задержка на слово, с")
+    args = parser.parse_args()
+
+    fake, server = await serve(args.host, args.port, args.delay)
+    print(f"🤖 Фейковый LLM на http://{args.host}:{args.port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        print(f"Запросов: {fake.requests}, промтов: {fake.prompts}, макс. пакет: {fake.max_batch}")
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
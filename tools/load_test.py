@@ -0,0 +1,353 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from tools import fake_bot_api, fake_llm
+
+# ===============================================================
+#       НАГРУЗОЧНЫЙ ТЕСТ: ТЫСЯЧИ ПОЛЬЗОВАТЕЛЕЙ ПРОТИВ SkinBot
+# ===============================================================
+#
+# В одном процессе поднимаются фейковый Bot API (tools/fake_bot_api.py),
+# настоящий SkinBot (build_app + base_url на фейк, long polling) и
+# N симулированных пользователей. Каждый проходит весь сценарий:
+# /start → согласие → пол/возраст/аллергии → все вопросы → сезон →
+# фото → подбор ухода, с паузами «на раздумье» между шагами.
+# Задержка шага — от отправки апдейта до ответа бота, который ждёт
+# пользователь (сообщение с нужными кнопками или нужное число ответов).
+# В конце — пропускная способность и p50/p95/p99 по каждому обработчику.
+#
+#   python -m tools.load_test --users 1000 --ramp 30 --storage csv
+#   python -m tools.load_test --users 500 --storage postgres --write-behind --json result.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "123456:LOADTEST"
+
+# Шаг сценария -> обработчик SkinBot
+HANDLERS = {
+    "start": "start",
+    "start_test": "handle_start_button",
+    "consent": "handle_consent",
+    "sex": "handle_demo",
+    "age": "handle_demo",
+    "allergies": "handle_demo",
+    "answer": "handle_answer",
+    "season": "handle_time_of_year",
+    "photo_stage": "handle_photo_stage",
+    "photo": "handle_photo",
+    "care": "handle_care_stage",
+    "care_llm": "handle_care_stage",
+}
+ALLERGIES = ["нет", "нет", "нет", "орехи", "мёд", "отдушки", "спирт, отдушки", "латекс"]
+SEASONS = ["Осень/Зима", "Весна/Лето"]
+
+
+class StepTimeout(Exception):
+    pass
+
+
+def _buttons(message: dict) -> set:
+    rows = (message.get("reply_markup") or {}).get("inline_keyboard", [])
+    return {button.get("callback_data") for row in rows for button in row}
+
+
+class SimUser:
+    def __init__(self, harness, user_id: int):
+        self.h = harness
+        self.id = user_id
+        self.replies = asyncio.Queue()
+        self.markup_message = None           # последнее сообщение бота с кнопками
+        self.message_ids = 0
+        self.started = 0.0                   # когда отправлен апдейт текущего шага
+
+    # -----------------------------------------------------------
+    #                     АПДЕЙТЫ ОТ ПОЛЬЗОВАТЕЛЯ
+    # -----------------------------------------------------------
+
+    def _user(self) -> dict:
+        return {"id": self.id, "is_bot": False, "first_name": f"user{self.id}"}
+
+    def _message(self, **fields) -> dict:
+        self.message_ids += 1
+        return {"message_id": 10**6 + self.message_ids, "date": int(time.time()),
+                "chat": {"id": self.id, "type": "private"}, "from": self._user(), **fields}
+
+    def text(self, text: str) -> dict:
+        fields = {"text": text}
+        if text.startswith("/"):
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": self._message(**fields)}
+
+    def photo(self, file_id: str, size: int) -> dict:
+        sizes = [{"file_id": file_id, "file_unique_id": file_id, "width": 640, "height": 640, "file_size": size}]
+        return {"message": self._message(photo=sizes)}
+
+    def press(self, data: str) -> dict:
+        message = self.markup_message
+        if message is None or data not in _buttons(message):
+            raise AssertionError(f"нет кнопки {data!r} в последнем сообщении бота")
+        return {"callback_query": {"id": f"{self.id}-{self.message_ids}", "from": self._user(),
+                                   "chat_instance": str(self.id), "data": data, "message": message}}
+
+    # -----------------------------------------------------------
+    #                          ШАГИ
+    # -----------------------------------------------------------
+
+    async def step(self, name: str, update: dict, done, follow: bool = False):
+        """
+        Отправляет апдейт и ждёт ответа, на котором done(method, message) → True.
+        follow=True — без нового апдейта: ждём продолжения ответа на предыдущий
+        (задержка считается от него же).
+        """
+        if not follow:
+            await asyncio.sleep(random.uniform(*self.h.think))
+            while not self.replies.empty():      # хвосты прошлых шагов (правки прогресса и т.п.)
+                self._seen(*self.replies.get_nowait())
+            self.started = time.monotonic()
+            self.h.api.push_update(update)
+        deadline = self.started + self.h.step_timeout
+        while True:
+            try:
+                method, message = await asyncio.wait_for(self.replies.get(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                self.h.timeouts[name] += 1
+                raise StepTimeout(name) from None
+            self._seen(method, message)
+            if done(method, message):
+                break
+        self.h.latencies[name].append(time.monotonic() - self.started)
+
+    def _seen(self, method: str, message: dict):
+        if message.get("reply_markup"):
+            self.markup_message = message
+
+    async def run(self):
+        await self.step("start", self.text("/start"), _has_button("start_test"))
+        await self.step("start_test", self.press("start_test"), _has_button("yes"))
+        await self.step("consent", self.press("yes"), _has_button("Ж"))
+        await self.step("sex", self.press(random.choice(["М", "Ж"])), _replies(1))
+        await self.step("age", self.text(str(random.randint(16, 70))), _replies(1))
+        await self.step("allergies", self.text(random.choice(ALLERGIES)), _has_button("A"))
+        while "A" in _buttons(self.markup_message):
+            await self.step("answer", self.press(random.choice("AB")),
+                            lambda method, message: bool(message.get("reply_markup")))
+        await self.step("season", self.press(random.choice(SEASONS)), _has_button("photo_stage"))
+        if not self.h.photos:
+            return
+        await self.step("photo_stage", self.press("photo_stage"), _replies(1))
+        file_id, size = random.choice(self.h.photos)
+        await self.step("photo", self.photo(file_id, size), _has_button("care_stage"))
+        if not self.h.care:
+            return
+        await self.step("care", self.press("care_stage"), _replies(1))
+        if self.h.llm:
+            # Рекомендации LLM приходят отдельным сообщением, правками по мере генерации
+            await self.step("care_llm", None, _llm_done, follow=True)
+
+
+def _has_button(data: str):
+    return lambda method, message: data in _buttons(message)
+
+
+def _replies(n: int):
+    count = 0
+
+    def done(method, message):
+        nonlocal count
+        count += 1
+        return count >= n
+    return done
+
+
+def _llm_done(method: str, message: dict) -> bool:
+    text = message.get("text", "")
+    return method == "editMessageText" and text.startswith("🤖 ") and not text.endswith("▌")
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.think = (args.think_min, args.think_max)
+        self.step_timeout = args.step_timeout
+        self.care = not args.no_care
+        self.llm = bool(args.llm_delay is not None)
+        self.latencies = defaultdict(list)
+        self.timeouts = defaultdict(int)
+        self.users = {}
+        self.photos = []
+        self.api = None
+
+    def on_reply(self, chat_id, method, message):
+        user = self.users.get(chat_id)
+        if user is not None:
+            user.replies.put_nowait((method, message))
+
+    async def run(self) -> dict:
+        args = self.args
+        self.api, server = await fake_bot_api.serve(port=args.port, on_reply=self.on_reply)
+        port = server.sockets[0].getsockname()[1]
+        llm_server = None
+        if self.llm:
+            _, llm_server = await fake_llm.serve(port=0, delay=args.llm_delay)
+        for seed in range(args.photos):
+            data = fake_bot_api.make_photo(seed)
+            self.photos.append((self.api.add_file(data), len(data)))
+
+        bot, app = self._build_bot(port, llm_server)
+        await app.initialize()
+        await bot.on_startup(app)
+        await app.updater.start_polling(poll_interval=0.0, timeout=5)
+        await app.start()
+
+        print(f"🚀 {args.users} пользователей, хранилище {args.storage}, "
+              f"параллельно апдейтов {args.concurrent_updates}")
+        started = time.monotonic()
+        results = await asyncio.gather(*(self._user(i) for i in range(args.users)), return_exceptions=True)
+        duration = time.monotonic() - started
+
+        await app.updater.stop()
+        await app.stop()
+        await bot.on_shutdown(app)
+        await app.shutdown()
+        server.close()
+        if llm_server is not None:
+            llm_server.close()
+
+        errors = [r for r in results if isinstance(r, BaseException) and not isinstance(r, StepTimeout)]
+        for error in errors[:5]:
+            print(f"❌ {error!r}")
+        return self.report(duration, results, len(errors))
+
+    async def _user(self, i: int):
+        await asyncio.sleep(random.uniform(0, self.args.ramp))
+        user = self.users[10_000 + i] = SimUser(self, 10_000 + i)
+        await user.run()
+
+    def _build_bot(self, port: int, llm_server):
+        from utils.bot import SkinBot
+        from utils.llm import LLMClient
+        from utils.photo import PhotoPipeline
+        from utils.photo_cache import PhotoCache
+        from utils.storage import create_storage
+
+        args = self.args
+        db_config = json.loads(args.db) if args.db else None
+        if args.storage == "postgres" and db_config is None:
+            from dermai_bot_v2 import DB_CONFIG
+            db_config = DB_CONFIG
+        write_behind = {"batch_size": 200, "flush_interval": 0.05, "max_pending": 2000} if args.write_behind else None
+        llm = None
+        if llm_server is not None:
+            llm = LLMClient(f"http://127.0.0.1:{llm_server.sockets[0].getsockname()[1]}", "fake")
+        bot = SkinBot(
+            token=TOKEN,
+            storage=create_storage(args.storage, db_config=db_config, write_behind=write_behind),
+            sessions_path=None,
+            concurrent_updates=args.concurrent_updates,
+            base_url=f"http://127.0.0.1:{port}/bot",
+            base_file_url=f"http://127.0.0.1:{port}/file/bot",
+            rate_limit=not args.no_rate_limit,
+            photo_pipeline=PhotoPipeline(workers=args.photo_workers or None,
+                                         cache=PhotoCache("utils.photo:StubClassifier")),
+            file_ids_path=None,
+            care_catalog=os.path.join(ROOT, "data", "care_catalog.jsonl"),
+            care_knowledge=os.path.join(ROOT, "data", "care_knowledge.jsonl"),
+            llm=llm,
+            rag_path="rag_index",
+            metrics_port=args.metrics_port or None,
+        )
+        return bot, bot.build_app()
+
+    # -----------------------------------------------------------
+    #                          ОТЧЁТ
+    # -----------------------------------------------------------
+
+    def report(self, duration: float, results: list, errors: int) -> dict:
+        steps = {}
+        total = 0
+        for name in HANDLERS:
+            values = self.latencies.get(name)
+            if not values and not self.timeouts.get(name):
+                continue
+            ms = np.array(values or [0.0]) * 1000
+            total += len(values)
+            steps[name] = {
+                "handler": HANDLERS[name],
+                "count": len(values),
+                "timeouts": self.timeouts.get(name, 0),
+                "p50_ms": float(np.percentile(ms, 50)),
+                "p95_ms": float(np.percentile(ms, 95)),
+                "p99_ms": float(np.percentile(ms, 99)),
+                "max_ms": float(ms.max()),
+            }
+        completed = sum(1 for r in results if not isinstance(r, BaseException))
+        report = {
+            "config": {k: v for k, v in vars(self.args).items() if k not in ("json", "db")},
+            "duration_s": duration,
+            "users_completed": completed,
+            "users_failed": len(results) - completed,
+            "errors": errors,
+            "updates": total,
+            "updates_per_s": total / duration if duration else 0.0,
+            "api_calls": dict(self.api.calls),
+            "steps": steps,
+        }
+
+        print(f"\n⏱  {duration:.1f} с, пользователей: {completed}/{len(results)}, "
+              f"апдейтов: {total} ({report['updates_per_s']:.0f}/с)")
+        print(f"{'шаг (обработчик)':<42}{'n':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'timeout':>9}")
+        for name, s in steps.items():
+            print(f"{name + ' (' + s['handler'] + ')':<42}{s['count']:>7}{s['p50_ms']:>9.1f}{s['p95_ms']:>9.1f}"
+                  f"{s['p99_ms']:>9.1f}{s['max_ms']:>9.1f}{s['timeouts']:>9}")
+        return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест SkinBot на фейковом Bot API")
+    parser.add_argument("--users", type=int, default=100, help="число симулированных пользователей")
+    parser.add_argument("--ramp", type=float, default=10.0, help="пользователи стартуют равномерно за N секунд")
+    parser.add_argument("--think-min", type=float, default=0.2, help="мин. пауза между шагами, с")
+    parser.add_argument("--think-max", type=float, default=1.5, help="макс. пауза между шагами, с")
+    parser.add_argument("--step-timeout", type=float, default=60.0, help="сколько ждать ответа бота, с")
+    parser.add_argument("--storage", choices=["csv", "memory", "postgres"], default="csv")
+    parser.add_argument("--db", help="JSON с параметрами Postgres (по умолчанию DB_CONFIG из dermai_bot_v2)")
+    parser.add_argument("--write-behind", action="store_true", help="пакетная запись в Postgres")
+    parser.add_argument("--concurrent-updates", type=int, default=16)
+    parser.add_argument("--no-rate-limit", action="store_true", help="без лимитов исходящих сообщений")
+    parser.add_argument("--photos", type=int, default=50, help="разных фото (0 — без этапа фото)")
+    parser.add_argument("--photo-workers", type=int, default=0, help="процессов анализа (0 — по ядрам)")
+    parser.add_argument("--no-care", action="store_true", help="без этапа подбора ухода")
+    parser.add_argument("--llm-delay", type=float, default=None,
+                        help="включить фейковый LLM с такой задержкой на слово, с")
+    parser.add_argument("--port", type=int, default=0, help="порт фейкового Bot API (0 — свободный)")
+    parser.add_argument("--metrics-port", type=int, default=0, help="отдавать /metrics бота на этом порту")
+    parser.add_argument("--workdir", help="каталог для файлов хранилища (по умолчанию — временный)")
+    parser.add_argument("--json", help="записать результаты в JSON-файл")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    json_path = os.path.abspath(args.json) if args.json else None
+    # patients.csv, индексы и т.п. — не в рабочей копии
+    workdir = args.workdir or tempfile.mkdtemp(prefix="skinbot-load-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    print(f"📂 Рабочий каталог: {workdir}")
+
+    report = asyncio.run(Harness(args).run())
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 {json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import asyncio
+import json
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qsl, urlsplit
+
+# ===============================================================
+#        МИНИМАЛЬНЫЙ HTTP/1.1 ДЛЯ ЛОКАЛЬНЫХ ФЕЙКОВЫХ СЕРВЕРОВ
+# ===============================================================
+#
+# Только то, что нужно фейковым Bot API и LLM: keep-alive, Content-Length,
+# chunked-ответы, формы (urlencoded и multipart). Без зависимостей.
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 429: "Too Many Requests"}
+
+
+class Request:
+    __slots__ = ("method", "path", "query", "headers", "body")
+
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+    def form(self) -> dict:
+        """Параметры из query string и тела (urlencoded, multipart или JSON)."""
+        params = dict(self.query)
+        content_type = self.headers.get("content-type", "")
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            params.update(parse_qsl(self.body.decode(), keep_blank_values=True))
+        elif content_type.startswith("multipart/form-data"):
+            message = BytesParser(policy=HTTP).parsebytes(
+                b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + self.body
+            )
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                payload = part.get_payload(decode=True)
+                params[name] = payload if part.get_filename() else payload.decode()
+        elif content_type.startswith("application/json") and self.body:
+            params.update(json.loads(self.body))
+        return params
+
+
+async def read_request(reader: asyncio.StreamReader):
+    """Следующий запрос соединения или None, если клиент закрыл его."""
+    line = await reader.readline()
+    if not line:
+        return None
+    method, target, _ = line.decode().split(" ", 2)
+    headers = {}
+    while True:
+        header = await reader.readline()
+        if header in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = header.decode().partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    body = await reader.readexactly(length) if length else b""
+    url = urlsplit(target)
+    return Request(method, url.path, parse_qsl(url.query), headers, body)
+
+
+async def respond(writer: asyncio.StreamWriter, status: int, body: bytes,
+                  content_type: str = "application/json"):
+    writer.write(f"HTTP/1.1 {status} {REASONS.get(status, 'X')}\r\nContent-Type: {content_type}\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+
+
+def start_chunked(writer: asyncio.StreamWriter, content_type: str):
+    writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\n"
+                 f"Transfer-Encoding: chunked\r\n\r\n".encode())
+
+
+def write_chunk(writer: asyncio.StreamWriter, data: bytes):
+    writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+
+def end_chunked(writer: asyncio.StreamWriter):
+    writer.write(b"0\r\n\r\n")
@@ -0,0 +1,175 @@
+import asyncio
+import bisect
+import time
+
+import numpy as np
+
+from utils.test import SKIN_CODES
+
+# ===============================================================
+#          КОЛОНОЧНЫЙ СНИМОК ТАБЛИЦЫ ПАЦИЕНТОВ ДЛЯ /stats
+# ===============================================================
+#
+# Вместо списка словарей держим по одному NumPy-массиву на поле,
+# закодированному маленьким целым (код кожи → 0..15, пол → 0..1 и т.д.).
+# Для агрегатов у каждой строки хранится ещё и общий ключ
+# (пол, возраст, сезон, тип кожи): один np.bincount по нему даёт «куб»
+# из ~1000 ячеек, а все разрезы — это суммы по его осям. Поэтому ответ
+# на /stats занимает миллисекунды даже на миллионах строк. Снимок обновляется
+# инкрементально: из хранилища берутся только записи, изменённые
+# с прошлого обновления (storage.changes_since), и перезаписываются
+# их строки в массивах.
+
+SKIN_INDEX = {code: i for i, code in enumerate(SKIN_CODES)}
+SKIN_UNKNOWN = len(SKIN_CODES)
+
+SEXES = ["М", "Ж"]
+SEASONS = ["Осень/Зима", "Весна/Лето"]
+
+AGE_BINS = [0, 18, 25, 35, 45, 55, 65]
+AGE_LABELS = ["<18", "18–24", "25–34", "35–44", "45–54", "55–64", "65+"]
+
+MATCH_BINS = [0, 25, 50, 75, 100]   # совпадение бывает только кратным 25%
+
+# Размеры осей куба (последнее значение каждой оси — «не указано»)
+CUBE_SHAPE = (len(SEXES) + 1, len(AGE_LABELS) + 1, len(SEASONS) + 1, SKIN_UNKNOWN + 1)
+
+
+def _encode(value: str, values: list) -> int:
+    try:
+        return values.index(value)
+    except ValueError:
+        return len(values)
+
+
+class PatientColumns:
+    def __init__(self, capacity: int = 1024):
+        self.rows = {}           # id_patient -> номер строки
+        self.size = 0
+        self.token = None        # позиция в хранилище для changes_since
+        self.refreshed_at = None
+        self._alloc(capacity)
+
+    def _alloc(self, capacity: int):
+        def grow(old, dtype, fill):
+            arr = np.full(capacity, fill, dtype=dtype)
+            if old is not None:
+                arr[:len(old)] = old
+            return arr
+
+        self.skin = grow(getattr(self, "skin", None), np.uint8, SKIN_UNKNOWN)
+        self.match = grow(getattr(self, "match", None), np.uint8, len(MATCH_BINS))
+        self.sex = grow(getattr(self, "sex", None), np.uint8, len(SEXES))
+        self.age = grow(getattr(self, "age", None), np.uint8, len(AGE_LABELS))
+        self.season = grow(getattr(self, "season", None), np.uint8, len(SEASONS))
+        self.key = grow(getattr(self, "key", None), np.uint16, np.prod(CUBE_SHAPE) - 1)
+        self.capacity = capacity
+
+    # -----------------------------------------------------------
+    #                        ОБНОВЛЕНИЕ
+    # -----------------------------------------------------------
+
+    def upsert(self, records):
+        # Кодируем в обычные списки, а в массивы пишем одной векторной операцией
+        rows, skins, sexes, ages, seasons, matches = [], [], [], [], [], []
+        for record in records:
+            row = self.rows.get(record["id_patient"])
+            if row is None:
+                row = self.rows[record["id_patient"]] = self.size
+                self.size += 1
+            rows.append(row)
+            skins.append(SKIN_INDEX.get((record.get("final_skin_type") or "").upper(), SKIN_UNKNOWN))
+            sexes.append(_encode(record.get("sex", ""), SEXES))
+            seasons.append(_encode(record.get("time_of_year", ""), SEASONS))
+            try:
+                age = int(record.get("age") or -1)
+            except ValueError:
+                age = -1
+            # Храним сразу номер возрастной группы и корзины совпадения
+            ages.append(bisect.bisect_right(AGE_BINS, age) - 1 if age >= 0 else len(AGE_LABELS))
+            try:
+                match = float(record.get("match_percent") or "nan")
+            except ValueError:
+                match = float("nan")
+            matches.append(min(int(match // 25), len(MATCH_BINS) - 1) if match >= 0 else len(MATCH_BINS))
+
+        if not rows:
+            return
+        if self.size > self.capacity:
+            self._alloc(max(self.size, self.capacity * 2))
+        rows = np.array(rows, dtype=np.intp)
+        self.skin[rows] = skins
+        self.sex[rows] = sexes
+        self.age[rows] = ages
+        self.season[rows] = seasons
+        self.match[rows] = matches
+        self.key[rows] = np.ravel_multi_index((sexes, ages, seasons, skins), CUBE_SHAPE)
+
+    async def refresh(self, storage) -> int:
+        """Подтягивает изменения из хранилища; возвращает число записей."""
+        records, self.token = await storage.changes_since(self.token)
+        # Первое построение на миллионах строк — секунды, не держим event loop
+        await asyncio.to_thread(self.upsert, records)
+        self.refreshed_at = time.time()
+        return len(records)
+
+    # -----------------------------------------------------------
+    #                         АГРЕГАТЫ
+    # -----------------------------------------------------------
+
+    def stats(self) -> dict:
+        n = self.size
+        cube = np.bincount(self.key[:n], minlength=int(np.prod(CUBE_SHAPE))).reshape(CUBE_SHAPE)
+        # Разрезы «группа × тип кожи» без строк «не указано»
+        skin = cube.sum(axis=(0, 1, 2))
+        by_sex = cube.sum(axis=(1, 2))[:len(SEXES), :SKIN_UNKNOWN]
+        by_age = cube.sum(axis=(0, 2))[:len(AGE_LABELS), :SKIN_UNKNOWN]
+        by_season = cube.sum(axis=(0, 1))[:len(SEASONS), :SKIN_UNKNOWN]
+
+        match_hist = np.bincount(self.match[:n], minlength=len(MATCH_BINS) + 1)[:len(MATCH_BINS)]
+        matched = match_hist.sum()
+
+        return {
+            "total": n,
+            "skin_types": skin[:SKIN_UNKNOWN],
+            "skin_unknown": int(skin[SKIN_UNKNOWN]),
+            "match_hist": match_hist,
+            "match_mean": float(np.dot(match_hist, MATCH_BINS) / matched) if matched else None,
+            "by_sex": by_sex,
+            "by_age": by_age,
+            "by_season": by_season,
+        }
+
+
+def _top(row, k: int = 3) -> str:
+    """Самые частые типы кожи в строке таблицы сопряжённости."""
+    order = np.argsort(row)[::-1][:k]
+    parts = [f"{SKIN_CODES[i]} {row[i]}" for i in order if row[i]]
+    return ", ".join(parts) or "—"
+
+
+def format_stats(stats: dict, elapsed_ms: float = None) -> str:
+    """Текст ответа на /stats."""
+    lines = [f"📊 *Пациентов:* {stats['total']}", "", "*Финальный тип кожи:*"]
+    counts = stats["skin_types"]
+    for i in np.argsort(counts)[::-1]:
+        if counts[i]:
+            lines.append(f"  {SKIN_CODES[i]}: {counts[i]}")
+    lines.append(f"  не определён: {stats['skin_unknown']}")
+
+    lines += ["", "*Совпадение тест/дерматоскопия:*"]
+    for value, count in zip(MATCH_BINS, stats["match_hist"]):
+        lines.append(f"  {value}%: {count}")
+    if stats["match_mean"] is not None:
+        lines.append(f"  среднее: {stats['match_mean']:.1f}%")
+
+    lines += ["", "*По полу:*"]
+    lines += [f"  {sex}: {_top(row)}" for sex, row in zip(SEXES, stats["by_sex"])]
+    lines += ["", "*По возрасту:*"]
+    lines += [f"  {label}: {_top(row)}" for label, row in zip(AGE_LABELS, stats["by_age"]) if row.any()]
+    lines += ["", "*По сезону:*"]
+    lines += [f"  {season}: {_top(row)}" for season, row in zip(SEASONS, stats["by_season"])]
+
+    if elapsed_ms is not None:
+        lines += ["", f"_расчёт: {elapsed_ms:.1f} мс_"]
+    return "\n".join(lines)
@@ -1,41 +1,156 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import (
-    CommandHandler, MessageHandler, CallbackQueryHandler,
-    ConversationHandler, filters, ContextTypes
-)
-from utils.test import SkinTest
-from utils.dataset_csv import (
-    save_initial_data,
-    save_test_results,
-    save_dermatoscopy_result,
-    get_patient_json
-)
+from __future__ import annotations
+
 import asyncio
-import os
 import json
+import os
+import time
 import uuid
 from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from utils.test import SkinTest
+from utils.reports import ReportBuilder
+from utils.file_ids import FileIdCache
+from utils.sweeper import SessionSweeper
+from utils import metrics
+
+# Импорт модуля не тянет python-telegram-bot, numpy и хранилища: PTB
+# импортируется в build_app, подсистемы — при создании или первом
+# использовании (подбор ухода, RAG), хранилище открывается в on_startup.
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import ContextTypes
+    from utils.llm import LLMClient
+    from utils.photo import PhotoPipeline
+    from utils.storage import BaseStorage
 
 REPORTS_DIR = "reports"
+EXPORTS_DIR = "exports"
+MAX_DOCUMENT_BYTES = 50 * 1024 * 1024   # больше бот отправить не может
 CONSENT, DEMO, Q_STATE, TIME_OF_YEAR = range(4)
+END = -1                       # ConversationHandler.END (без импорта PTB)
+STATE_NAMES = {CONSENT: "CONSENT", DEMO: "DEMO", Q_STATE: "Q_STATE", TIME_OF_YEAR: "TIME_OF_YEAR"}
+
+# Сколько секунд бездействия терпим в каждом состоянии теста
+SESSION_TIMEOUTS = {
+    CONSENT: 15 * 60,
+    DEMO: 30 * 60,
+    Q_STATE: 2 * 3600,
+    TIME_OF_YEAR: 2 * 3600,
+}
+MAX_PHOTO_BYTES = 20 * 1024 * 1024      # больше Bot API всё равно не отдаст
+
+# Сессия после теста (ждём фото / подбор ухода)
+IDLE_SESSION_TIMEOUT = 3 * 24 * 3600
+
+SEASONS = ["Осень/Зима", "Весна/Лето"]
 
 
 class SkinBot:
-    def __init__(self, token):
+    def __init__(self, token, storage: BaseStorage = None, admin_ids=(), sessions_path: str = "sessions.jsonl",
+                 session_timeouts: dict = None, record_abandoned: bool = True,
+                 concurrent_updates: int = 1, base_url: str = None, base_file_url: str = None,
+                 rate_limit: bool = True, photo_pipeline: PhotoPipeline = None,
+                 file_ids_path: str = "file_ids.jsonl", care_catalog: str = "data/care_catalog.jsonl",
+                 llm: LLMClient = None, care_knowledge: str = "data/care_knowledge.jsonl",
+                 rag_path: str = "rag_index", metrics_port: int = None, metrics_host: str = "127.0.0.1",
+                 started_at: float = None):
+        # Отчёт о холодном старте: фазы от started_at (time.perf_counter() в начале
+        # процесса, до импортов) до готовности on_startup
+        self.startup = {}
+        self._phase_at = started_at if started_at is not None else time.perf_counter()
+        if started_at is not None:
+            self._phase("imports")
         self.token = token
+        # Сколько апдейтов обрабатывается одновременно (1 — строго по очереди;
+        # больше 1 — параллельно между чатами, по порядку внутри чата)
+        if isinstance(concurrent_updates, bool) or not isinstance(concurrent_updates, int) or concurrent_updates < 1:
+            # True / update processor PTB включили бы параллельность без порядка внутри чата
+            raise ValueError(f"concurrent_updates — число от 1, получено {concurrent_updates!r}")
+        self.concurrent_updates = concurrent_updates
+        # Адрес Bot API (по умолчанию api.telegram.org; для нагрузочных тестов — локальный фейк)
+        self.base_url = base_url
+        self.base_file_url = base_file_url
+        # Очередь исходящих сообщений с лимитами Telegram (см. utils/rate_limit.py, создаётся в build_app)
+        self.rate_limit = rate_limit
+        self.rate_limiter = None
+        # Анализ фото дерматоскопа в пуле процессов (классификатор подключаемый)
+        if photo_pipeline is None:
+            from utils.photo import PhotoPipeline
+            photo_pipeline = PhotoPipeline()
+        self.photos = photo_pipeline
+        # PDF-отчёты: рендер в пуле процессов, файлы в REPORTS_DIR по хэшу содержимого
+        self.reports = ReportBuilder(REPORTS_DIR)
+        # file_id уже загруженных в Telegram отчётов: повторная отправка без загрузки байтов
+        self.file_ids = FileIdCache(file_ids_path)
+        # Подбор ухода: каталог средств и его индексы строятся при первом подборе
+        self.care_catalog = care_catalog
+        self.care = None
+        # Текст рекомендаций от LLM поверх подобранного ухода (None — без LLM)
+        self.llm = llm
+        # Заметки для промта: векторный индекс по заметкам и каталогу (на диске, через mmap),
+        # открывается в фоне при старте
+        self.care_knowledge = care_knowledge
+        self.rag_path = rag_path if llm is not None else None
+        self.rag = None
+        self._rag_task = None
+        self._rag_lock = asyncio.Lock()
+        self._lazy_lock = asyncio.Lock()
+        # HTTP /metrics в формате Prometheus (None — метрики пишутся, но наружу не отдаются)
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self._metrics_server = None
+        self.sessions_path = sessions_path   # журнал незавершённых тестов (None — только в памяти)
+        self.session_timeouts = session_timeouts or SESSION_TIMEOUTS
+        self.record_abandoned = record_abandoned
+        self.sweeper = None
+        self._sweeper_task = None
+        if storage is None:
+            from utils.storage import CsvStorage
+            storage = CsvStorage()
+        self.storage = storage
+        self.admin_ids = set(admin_ids)
+        self.columns = None          # колоночный снимок для /stats
+        self._stats_lock = asyncio.Lock()
+        self._exports = set()        # фоновые выгрузки /export
+        self._background = set()     # прочие фоновые задачи (_spawn)
         self.test = SkinTest()
         self.questions = self.test.questions
-        os.makedirs(REPORTS_DIR, exist_ok=True)
+        self._phase("init")
+
+    def _build_markups(self):
+        """Клавиатуры собираются один раз, в build_app (объекты PTB неизменяемые)."""
+        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+        self.question_markups = tuple(
+            InlineKeyboardMarkup([[InlineKeyboardButton(label, callback_data=data)] for label, data in q.buttons])
+            for q in self.test.prepared
+        )
+        self.season_markup = InlineKeyboardMarkup(
+            [[InlineKeyboardButton(season, callback_data=season)] for season in SEASONS]
+        )
+        self.start_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🧪 Пройти тест", callback_data="start_test")]])
+        self.consent_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Да", callback_data="yes")],
+            [InlineKeyboardButton("❌ Нет", callback_data="no")]
+        ])
+        self.sex_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("Мужсой", callback_data="М")],
+            [InlineKeyboardButton("Женский", callback_data="Ж")]
+        ])
+        self.photo_markup = InlineKeyboardMarkup([[InlineKeyboardButton("📸 Провести анализ фото", callback_data="photo_stage")]])
+        self.care_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("📄 PDF-отчёт", callback_data="report")],
+            [InlineKeyboardButton("💄 Подобрать уход", callback_data="care_stage")]
+        ])
 
     # =============================================================
     # ЭТАП 0: СТАРТ
     # =============================================================
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        buttons = [
-            [InlineKeyboardButton("🧪 Пройти тест", callback_data="start_test")]
-        ]
-        markup = InlineKeyboardMarkup(buttons)
+        markup = self.start_markup
         await update.message.reply_text(
             "👋 Здравствуйте!\n\n"
             "Это AI-ассистент для подбора уходовой косметики по типу кожи.\n\n"
@@ -53,11 +168,9 @@ class SkinBot:
     # =============================================================
 
     async def consent_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        buttons = [
-            [InlineKeyboardButton("✅ Да", callback_data="yes")],
-            [InlineKeyboardButton("❌ Нет", callback_data="no")]
-        ]
-        markup = InlineKeyboardMarkup(buttons)
+        # Новый тест начинается с чистой сессии (иначе пол/возраст прошлого прохода пропускают вопросы)
+        context.user_data.clear()
+        markup = self.consent_markup
         msg = (
             "🧩 Мы собираем анонимные данные для улучшения рекомендаций.\n"
             "Вы согласны принять участие?"
@@ -76,13 +189,9 @@ class SkinBot:
                 "❌ Спасибо за уделенное время, тест отменён в связи с желанием пациента. До встречи!\n"
                 "Чтобы перезапустить бота и начать заново - введите команду: /start \n"
             )
-            return ConversationHandler.END
+            return END
 
-        buttons = [
-            [InlineKeyboardButton("Мужсой", callback_data="М")],
-            [InlineKeyboardButton("Женский", callback_data="Ж")]
-        ]
-        await query.edit_message_text("Укажите ваш пол:", reply_markup=InlineKeyboardMarkup(buttons))
+        await query.edit_message_text("Укажите ваш пол:", reply_markup=self.sex_markup)
         return DEMO
 
     async def handle_demo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -114,11 +223,11 @@ class SkinBot:
         else:
             context.user_data["allergies"] = update.message.text.strip() or "нет"
             context.user_data["id_patient"] = str(uuid.uuid4())
-            context.user_data["answers_json"] = {}
+            context.user_data["answers"] = 0     # упакованные ответы (биты)
             context.user_data["index"] = 0
 
-            # --- Сохраняем начальные данные в CSV ---
-            await save_initial_data(
+            # --- Сохраняем начальные данные ---
+            await self.storage.save_initial_data(
                 id_patient=context.user_data["id_patient"],
                 age=context.user_data["age"],
                 sex=context.user_data["sex"],
@@ -138,16 +247,8 @@ class SkinBot:
 
     async def ask_question(self, update_or_query, context):
         idx = context.user_data["index"]
-        category, question, options = self.questions[idx]
-
-        buttons = [
-            [InlineKeyboardButton(f"A: {options['A']}", callback_data="A")],
-            [InlineKeyboardButton(f"B: {options['B']}", callback_data="B")]
-        ]
-        markup = InlineKeyboardMarkup(buttons)
-        # Если есть заметка, добавляем её
-        note_text = options.get("note", "")
-        text = f"{question}\n\n{note_text}\n\nВыберите вариант:"
+        text = self.test.prepared[idx].text
+        markup = self.question_markups[idx]
 
         if hasattr(update_or_query, "message"):
             await update_or_query.message.reply_text(text, reply_markup=markup)
@@ -159,26 +260,21 @@ class SkinBot:
         await query.answer()
         ans = query.data
 
+        # ответы упакованы в биты: бит i = 1, если на вопрос i ответили «A»
         idx = context.user_data["index"]
-        category, _, _ = self.questions[idx]
-        context.user_data["answers_json"][category] = ans
-        context.user_data["index"] += 1
+        context.user_data["answers"] = self.test.pack_answer(context.user_data["answers"], idx, ans)
+        context.user_data["index"] = idx + 1
 
         # если тест закончен
         if context.user_data["index"] >= len(self.questions):
-            answers_list = list(context.user_data["answers_json"].items())
-            result = self.test.classify_baumann(answers_list)
+            result = self.test.classify_bits(context.user_data["answers"])
             context.user_data["skin_code"] = result["code"]
 
             # --- Уточняющий вопрос о времени года ---
-            buttons = [
-                [InlineKeyboardButton("Осень/Зима", callback_data="Осень/Зима")],
-                [InlineKeyboardButton("Весна/Лето", callback_data="Весна/Лето")]
-            ]
             await query.edit_message_text(
                 f"✅ Тест завершён!\n\nТип кожи: *{result['code']}*\n{result['desc']}\n\n"
                 "📌 В какое время года планируется использовать уходовую косметику?",
-                reply_markup=InlineKeyboardMarkup(buttons),
+                reply_markup=self.season_markup,
                 parse_mode="Markdown"
             )
             return TIME_OF_YEAR
@@ -198,11 +294,12 @@ class SkinBot:
         context.user_data["time_of_year"] = season
         id_patient = context.user_data.get("id_patient")
         if id_patient:
-            await save_test_results(
+            await self.storage.save_test_results(
                 id_patient=id_patient,
-                answers_json=json.dumps(context.user_data["answers_json"], ensure_ascii=False),
+                answers_json=json.dumps(self.test.unpack(context.user_data["answers"]), ensure_ascii=False),
                 skin_code=context.user_data["skin_code"],
-                time_of_year=season
+                time_of_year=season,
+                questionnaire_version=self.test.version
             )
 
         await query.edit_message_text(
@@ -210,100 +307,486 @@ class SkinBot:
             parse_mode="Markdown"
         )
 
-        buttons = [[InlineKeyboardButton("📸 Провести анализ фото", callback_data="photo_stage")]]
-        await query.message.reply_text("Следующий шаг:", reply_markup=InlineKeyboardMarkup(buttons))
-        return ConversationHandler.END
+        await query.message.reply_text("Следующий шаг:", reply_markup=self.photo_markup)
+        return END
 
     # =============================================================
-    # ЭТАП 3: АНАЛИЗ ФОТО (симуляция дерматоскопии)
+    # ЭТАП 3: АНАЛИЗ ФОТО ДЕРМАТОСКОПА
     # =============================================================
 
     async def handle_photo_stage(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         await query.answer()
 
-        id_patient = context.user_data.get("id_patient")
-        if not id_patient:
+        if not context.user_data.get("id_patient"):
             await query.message.reply_text("⚠️ Сначала пройдите тест.")
             return
 
-        await query.edit_message_text("📸 Эмулируем получение фото дерматоскопа...")
-        await asyncio.sleep(1.5)
-        await query.message.reply_text("🔍 Анализ изображения...")
-        await asyncio.sleep(2.0)
+        await query.edit_message_text("📸 Отправьте фото с дерматоскопа (как фото или файлом).")
 
-        skin_type_dermatoscopy = "OSPW"
-        skin_desc = "Жирная, чувствительная, пигментированная, склонна к морщинам."
+    async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        from utils.photo import PipelineBusy
+
+        message = update.message
+        id_patient = context.user_data.get("id_patient")
         skin_code = context.user_data.get("skin_code")
-        comparison = await save_dermatoscopy_result(id_patient, skin_code, skin_type_dermatoscopy)
-        match_percent = comparison["match_percent"]
-        final_skin_type = comparison["final_skin_type"]
+        if not id_patient or not skin_code:
+            await message.reply_text("⚠️ Сначала пройдите тест.")
+            return
 
-        pdf_path = r"C:\Users\minik\Desktop\dermatoscopy_andery.pdf"
-        if not os.path.exists(pdf_path):
-            await query.message.reply_text("❌ PDF-файл отчёта не найден на сервере.")
+        # Самое крупное превью или изображение, присланное файлом
+        media = message.photo[-1] if message.photo else message.document
+        if media.file_size and media.file_size > MAX_PHOTO_BYTES:
+            await message.reply_text("⚠️ Файл слишком большой (максимум 20 МБ).")
             return
 
-        await query.message.reply_text("📄 Формируем отчёт...")
-        await asyncio.sleep(1.0)
+        status = await message.reply_text("📥 Фото получено, загружаем...")
+        file = await media.get_file()
+        data = bytes(await file.download_as_bytearray())
 
-        patient_json = get_patient_json(id_patient)
+        async def progress(stage, position):
+            if stage == "queued":
+                await status.edit_text(f"⏳ Фото в очереди на анализ (перед вами: {position})...")
+            else:
+                await status.edit_text("🔍 Анализ изображения...")
+
+        try:
+            analysis = await self.photos.analyze(data, progress=progress)
+        except PipelineBusy:
+            await status.edit_text("⚠️ Сейчас слишком много фото на анализе. Попробуйте через минуту.")
+            return
+        except Exception as e:
+            print(f"❌ Ошибка анализа фото: {e!r}")
+            await status.edit_text("❌ Не удалось распознать изображение. Пришлите другое фото.")
+            return
+
+        skin_type_dermatoscopy = analysis["code"]
+        skin_desc = self.test.explain_skin_type(skin_type_dermatoscopy)
+        comparison = await self.storage.save_dermatoscopy_result(id_patient, skin_code, skin_type_dermatoscopy)
+        match_percent = comparison["match_percent"]
+        final_skin_type = comparison["final_skin_type"]
+
+        # Запись полная — начинаем рендер PDF, пока пользователь читает результат
+        record = await self.storage.get_patient(id_patient)
+        if record is not None:
+            self.reports.prefetch(record)
+        patient_json = await self.storage.get_patient_json(id_patient)
 
         caption = (
             f"📋 *Результаты анализа:*\n\n"
-            f"💠 Тип кожи по тесту: *{context.user_data.get('skin_code', '—')}*\n"
+            f"💠 Тип кожи по тесту: *{skin_code}*\n"
             f"🔬 Тип кожи по дерматоскопии: *{skin_type_dermatoscopy}*\n  {skin_desc}\n"
             f"📊 Совпадение: *{match_percent}%*\n"
             f"✅ Финальный тип кожи: *{final_skin_type}*\n"
             f"*Отладка - посылаемый промт JSON: {patient_json}\n*"
         )
+        await status.edit_text(caption, parse_mode="Markdown")
+        await message.reply_text("Можно получить PDF-отчёт или подобрать уход:", reply_markup=self.care_markup)
+
+    async def handle_report(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        await query.answer()
+
+        id_patient = context.user_data.get("id_patient")
+        record = await self.storage.get_patient(id_patient) if id_patient else None
+        if record is None or not record.get("final_skin_type"):
+            await query.message.reply_text("⚠️ Отчёт будет доступен после анализа фото.")
+            return
 
-        with open(pdf_path, "rb") as f:
-            await query.message.reply_document(document=f, caption=caption, parse_mode="Markdown")
+        async def get_path():
+            path, _ = await self.reports.ensure(record)
+            return path
 
-        buttons = [[InlineKeyboardButton("💄 Подобрать уход", callback_data="care_stage")]]
-        await query.message.reply_text("Теперь можно подобрать уход:", reply_markup=InlineKeyboardMarkup(buttons))
+        # Если такой отчёт уже загружался — отправляем по file_id (PDF даже не нужен на диске)
+        try:
+            await self.file_ids.send_document(query.message, self.reports.key_for(record), get_path,
+                                              filename="skin_report.pdf", caption="📄 Отчёт по типу кожи")
+        except Exception as e:
+            print(f"❌ Ошибка отправки отчёта: {e!r}")
+            await query.message.reply_text("❌ Не удалось сформировать отчёт. Попробуйте позже.")
 
     # =============================================================
-    # ЭТАП 4: ПОДБОР УХОДА (заглушка перед LLM)
+    # ЭТАП 4: ПОДБОР УХОДА
     # =============================================================
 
     async def handle_care_stage(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         await query.answer()
-        await query.edit_message_text(
-            "🤖 Подбор персонализированного ухода...\n(этап интеграции с LLM)\n"
-            "*Это пока заглушка, дальше нет ничего*"
-        )
+
+        id_patient = context.user_data.get("id_patient")
+        if not id_patient:
+            await query.edit_message_text("⚠️ Сначала пройдите тест: /start")
+            return
+        from telegram.error import BadRequest
+        from utils.care import format_routine
+
+        patient = json.loads(await self.storage.get_patient_json(id_patient))
+        care = await self.care_engine()
+        routine = care.recommend(patient)
+        try:
+            await query.edit_message_text(format_routine(routine), parse_mode="Markdown")
+        except BadRequest as e:
+            # Разметку не разобрал Telegram — показываем тот же уход без неё
+            print(f"⚠️ Уход не отправлен с Markdown ({e}), отправляю без разметки")
+            await query.edit_message_text(format_routine(routine, markdown=False))
+        if self.llm is None or not routine["steps"]:
+            return
+        from utils.llm import stream_to_message
+
+        status = await query.message.reply_text("🤖 Готовлю рекомендации по уходу...")
+        rag = await self.rag_index()
+        notes = None
+        if rag is not None and len(rag):
+            # Поиск — numpy по mmap: в потоке, не в event loop
+            notes = await asyncio.to_thread(rag.context_for, routine["skin_type"], routine["season"])
+        try:
+            await stream_to_message(status, self.llm.stream(patient, routine, notes), header="🤖 ")
+        except Exception as e:
+            print(f"❌ Ошибка рекомендаций LLM: {e!r}")
+            await status.edit_text("⚠️ Не удалось получить рекомендации. Подобранный уход — выше.")
+
+    async def care_engine(self):
+        """Каталог ухода и его индексы — при первом подборе (numpy грузится только тогда)."""
+        if self.care is None:
+            async with self._lazy_lock:
+                if self.care is None:
+                    from utils.care import CareEngine
+
+                    care = CareEngine()
+                    if self.care_catalog:
+                        try:
+                            await asyncio.to_thread(care.load, self.care_catalog)
+                        except OSError as e:
+                            print(f"⚠️ Каталог ухода не загружен ({e}), подбор ухода недоступен")
+                    self.care = care
+        return self.care
+
+    async def rag_index(self):
+        """
+        Векторный индекс заметок (None, если выключен или не открылся).
+        Открывается в фоне из on_startup; запрос, пришедший раньше, дождётся его.
+        """
+        if self.rag is None and self.rag_path:
+            async with self._rag_lock:
+                if self.rag is None and self.rag_path:
+                    try:
+                        rag = await asyncio.to_thread(self._open_rag)
+                    except Exception as e:
+                        print(f"⚠️ RAG-индекс не открыт ({e!r}), рекомендации LLM — без заметок")
+                        self.rag_path = None
+                        return None
+                    r = rag.stats()
+                    print(f"📚 RAG-индекс: {r['documents']} документов, {'собран' if r['rebuilt'] else 'загружен'} "
+                          f"за {r['build_ms']:.0f} мс")
+                    self.rag = rag
+        return self.rag
+
+    def _open_rag(self):
+        # Целиком в потоке: импорт numpy, чтение корпуса, сборка или mmap индекса
+        from utils.rag import VectorIndex, care_corpus
+
+        rag = VectorIndex(self.rag_path)
+        rag.open(care_corpus(self.care_catalog, self.care_knowledge))
+        return rag
+
+    # =============================================================
+    # АДМИН: СТАТИСТИКА
+    # =============================================================
+
+    async def refresh_stats(self) -> dict:
+        """Инкрементально обновляет колоночный снимок и считает агрегаты."""
+        from utils.analytics import PatientColumns
+
+        async with self._stats_lock:
+            if self.columns is None:
+                self.columns = PatientColumns()
+            await self.columns.refresh(self.storage)
+            return self.columns.stats()
+
+    async def stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user.id not in self.admin_ids:
+            return
+        from utils.analytics import format_stats
+        from utils.care import escape_markdown
+
+        started = time.perf_counter()
+        stats = await self.refresh_stats()
+        text = format_stats(stats, (time.perf_counter() - started) * 1000)
+        if self.sweeper is not None:
+            text += "\n\n" + self.format_sessions(self.sweeper.stats(), escape_markdown)
+        from utils.scheduler import ChatOrderedUpdateProcessor
+
+        processor = context.application.update_processor
+        if isinstance(processor, ChatOrderedUpdateProcessor):
+            q = processor.stats()
+            text += (f"\n\n*Апдейты:* выполняется {q['running']}/{q['workers']}, в очередях {q['queued']} "
+                     f"(чатов {q['chats']}, макс. очередь {q['busiest_depth']}, пик {q['max_depth']})")
+        f = self.photos.stats()
+        text += (f"\n*Фото:* в очереди {f['queued']}, в работе {f['in_progress']}/{f['workers']}, "
+                 f"готово {f['processed']} (сред. {f['avg_ms']:.0f} мс), ошибок {f['failed']}, отказов {f['rejected']}")
+        c = self.photos.cache.stats()
+        text += (f"\n  кэш: {c['entries']} записей, попаданий {c['hit_rate']:.0%} "
+                 f"(точных {c['hits_exact']}, похожих {c['hits_similar']}, с диска {c['hits_disk']}), "
+                 f"сэкономлено {c['saved_ms'] / 1000:.1f} с")
+        if self.rate_limiter is not None:
+            r = self.rate_limiter.stats()
+            text += (f"\n*Исходящие:* в очереди {r['queued']}, склеено правок {r['coalesced']}, 429: {r['retries_429']}"
+                     f"\n  ожидание: интерактивные {r['interactive']['delay_avg_ms']:.0f}/{r['interactive']['delay_max_ms']:.0f} мс, "
+                     f"фоновые {r['bulk']['delay_avg_ms']:.0f}/{r['bulk']['delay_max_ms']:.0f} мс (сред./макс.)")
+        if self.llm is not None:
+            m = self.llm.stats()
+            text += (f"\n*LLM:* запросов {m['requests']}, без генерации {m['hit_rate']:.0%} "
+                     f"(кэш {m['cache_hits']}, общие {m['joined']}), пакетов {m['batches']} "
+                     f"(сред. {m['avg_batch']:.1f} промта, {m['avg_generation_ms']:.0f} мс), ошибок {m['errors']}")
+        if self.rag is not None:
+            g = self.rag.stats()
+            text += (f"\n*RAG:* документов {g['documents']}, {'собран' if g['rebuilt'] else 'загружен'} "
+                     f"за {g['build_ms']:.0f} мс, поисков {g['queries']} (сред. {g['avg_search_ms']:.1f} мс)")
+        d = self.file_ids.stats()
+        text += (f"\n*Отчёты:* file\\_id {d['entries']}, повторных отправок {d['hit_rate']:.0%} "
+                 f"({d['hits']}/{d['hits'] + d['misses']}), сброшено {d['invalidations']}, "
+                 f"не загружено {d['bytes_saved'] / 2**20:.1f} МБ")
+        # В тексте Markdown: имена вроде Q_STATE и build_app экранируются, иначе непарный «_»
+        text += "\n*Старт:* " + escape_markdown(self.format_startup())
+        await update.message.reply_text(text, parse_mode="Markdown")
+
+    @staticmethod
+    def format_sessions(stats: dict, escape=str) -> str:
+        states = ", ".join(f"{STATE_NAMES.get(s, s)} {n}" for s, n in stats["by_state"].items()) or "—"
+        states = escape(states)
+        lines = [
+            f"*Сессии:* {stats['sessions']} (~{stats['memory_bytes'] / 1024:.0f} КБ)",
+            f"  в тесте: {states}",
+            f"  удалено: {stats['evicted_total']}, брошено: {stats['abandoned_total']}",
+        ]
+        if stats["rss_peak_bytes"]:
+            lines.append(f"  пиковый RSS: {stats['rss_peak_bytes'] / 2**20:.0f} МБ")
+        return "\n".join(lines)
+
+    async def export(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        /export [csv|jsonl] [gz] [since=ГГГГ-ММ-ДД] [until=...] [type=OSPW,DRNT] [season=...] [consent=yes]
+        Выгрузка идёт в фоне (см. utils/export.py): обработчик сразу отвечает, диалоги не ждут.
+        """
+        if update.effective_user.id not in self.admin_ids:
+            return
+        from utils.export import parse_command_args
+
+        try:
+            fmt, compress, record_filter = parse_command_args(context.args or ())
+        except ValueError as e:
+            await update.message.reply_text(f"⚠️ {e}\n{self.export.__doc__.strip().splitlines()[0]}")
+            return
+        status = await update.message.reply_text(f"📤 Выгрузка {fmt}{' (gz)' if compress else ''}: {record_filter}…")
+        # Не через app.create_task: Application.stop ждал бы выгрузку до конца
+        task = asyncio.get_running_loop().create_task(self._run_export(update.message, status, fmt, compress,
+                                                                       record_filter))
+        self._exports.add(task)
+        task.add_done_callback(self._exports.discard)
+
+    async def _run_export(self, message, status, fmt, compress, record_filter):
+        from utils.export import export_filename, export_to_file
+        from utils.rate_limit import reply_document
+
+        path = os.path.join(EXPORTS_DIR, export_filename(fmt, compress))
+        try:
+            result = await export_to_file(self.storage, path, fmt, compress, record_filter)
+            summary = (f"📤 Выгружено {result['rows']} записей, {result['bytes'] / 2**20:.1f} МБ "
+                       f"за {result['seconds']:.1f} с")
+            if result["bytes"] <= MAX_DOCUMENT_BYTES:
+                await reply_document(message, Path(path), caption=summary)
+                os.remove(path)
+            else:
+                summary += f"\nФайл больше 50 МБ, лежит на сервере: {path}"
+            await status.edit_text(summary)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Ошибка выгрузки: {e!r}")
+            await status.edit_text("❌ Выгрузка не удалась, подробности в логе.")
+
+    # =============================================================
+    # СЕССИИ: АКТИВНОСТЬ И ОЧИСТКА
+    # =============================================================
+
+    async def touch_session(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Отметка активности для SessionSweeper (на каждый апдейт от пользователя)."""
+        if update.effective_user is not None:
+            context.user_data["touched"] = time.time()
+
+    async def record_abandonment(self, user_id, session, state):
+        id_patient = session.get("id_patient")
+        if not id_patient:
+            return                       # бросил до анкеты — в хранилище ничего нет
+        stage = STATE_NAMES.get(state, str(state))
+        if state == Q_STATE:
+            stage += f":{session.get('index', 0)}"
+        await self.storage.save_abandonment(id_patient, stage)
 
     # =============================================================
     # ЗАПУСК
     # =============================================================
 
-    def run(self):
-        from telegram.ext import ApplicationBuilder
+    def _phase(self, name: str):
+        """Отметка фазы запуска: время с предыдущей отметки."""
+        now = time.perf_counter()
+        self.startup[name] = now - self._phase_at
+        self._phase_at = now
+
+    def format_startup(self) -> str:
+        phases = " · ".join(f"{name} {seconds * 1000:.0f}" for name, seconds in self.startup.items())
+        return f"{sum(self.startup.values()) * 1000:.0f} мс ({phases})"
+
+    def _spawn(self, coro):
+        """Фоновая задача в event loop; ссылка хранится до завершения, в on_shutdown — отмена."""
+        task = asyncio.get_running_loop().create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    async def on_startup(self, app):
+        self._phase("ptb_initialize")         # Application.initialize: getMe, журнал сессий
+        # Хранилище открывается здесь, а не при импорте: индекс CSV строится в потоке
+        await self.storage.init()
+        print(f"Хранилище: {self.storage.name}")
+        self._phase("storage")
+        self.photos.start()
+        self.reports.start()
+        # post_init идёт до Application.start: app.create_task здесь задачу не отслеживает
+        self._spawn(asyncio.to_thread(self.reports.cleanup))
+        if self.llm is not None:
+            await self.llm.start()
+        if self.admin_ids:
+            # Первое (полное) построение снимка — в фоне, чтобы /stats сразу был быстрым
+            self._spawn(self.refresh_stats())
+        if self.metrics_port:
+            self._metrics_server = await metrics.serve(self.metrics_host, self.metrics_port)
+        if self.sweeper is not None:
+            # Не через app.create_task: Application.stop ждёт такие задачи, а эта бесконечна
+            self._sweeper_task = asyncio.get_running_loop().create_task(self.sweeper.run())
+        if self.rag_path:
+            # RAG-индекс (сборка или mmap) — в фоне, старт бота его не ждёт
+            self._rag_task = asyncio.get_running_loop().create_task(self.rag_index())
+        # Каталог ухода грузится при первом подборе (care_engine)
+        self._phase("subsystems")
+        metrics.STARTUP_SECONDS.set_function(lambda: {(name,): value for name, value in self.startup.items()})
+        print(f"⏱ Старт за {self.format_startup()}")
+
+    async def on_shutdown(self, app):
+        if self._sweeper_task is not None:
+            self._sweeper_task.cancel()
+        if self._rag_task is not None:
+            self._rag_task.cancel()
+        pending = [*self._exports, *self._background]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+        await self.photos.close()
+        await self.reports.close()
+        if self.llm is not None:
+            await self.llm.close()
+        await self.storage.close()
+
+    def build_app(self):
+        """Application со всеми обработчиками (без запуска)."""
+        from telegram import Update
+        from telegram.ext import (
+            ApplicationBuilder, CallbackQueryHandler, CommandHandler, ContextTypes, ConversationHandler,
+            MessageHandler, TypeHandler, filters
+        )
+        from utils.scheduler import ChatOrderedUpdateProcessor
+        from utils.session import JournalPersistence, Session
 
-        app = ApplicationBuilder().token(self.token).build()
+        self._build_markups()
 
+        builder = (
+            ApplicationBuilder()
+            .token(self.token)
+            .context_types(ContextTypes(user_data=Session))
+            .post_init(self.on_startup)
+            .post_shutdown(self.on_shutdown)
+        )
+        if self.concurrent_updates > 1:
+            # Параллельно между чатами, но строго по порядку внутри чата. Обычная
+            # параллельность PTB (concurrent_updates(N)) не включается никогда:
+            # два быстрых нажатия одного пользователя сдвигали бы index теста
+            # не в том порядке
+            builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(workers=self.concurrent_updates))
+        if self.rate_limit:
+            from utils.rate_limit import OutboundRateLimiter
+            self.rate_limiter = OutboundRateLimiter()
+            builder = builder.rate_limiter(self.rate_limiter)
+        if self.base_url:
+            builder = builder.base_url(self.base_url)
+        if self.base_file_url:
+            builder = builder.base_file_url(self.base_file_url)
+        if self.sessions_path:
+            builder = builder.persistence(JournalPersistence(self.sessions_path))
+        app = builder.build()
+        processor = app.update_processor
+        if processor.max_concurrent_updates > 1 and not isinstance(processor, ChatOrderedUpdateProcessor):
+            raise RuntimeError("Параллельная обработка апдейтов — только через ChatOrderedUpdateProcessor")
+
+        # Время каждого обработчика — в метрики (skinbot_handler_seconds)
+        timed = metrics.timed_handler
         conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(self.handle_start_button, pattern="^start_test$")],
+            entry_points=[CallbackQueryHandler(timed(self.handle_start_button), pattern="^start_test$")],
             states={
-                CONSENT: [CallbackQueryHandler(self.handle_consent, pattern="^(yes|no)$")],
+                CONSENT: [CallbackQueryHandler(timed(self.handle_consent), pattern="^(yes|no)$")],
                 DEMO: [
-                    CallbackQueryHandler(self.handle_demo, pattern="^(М|Ж)$"),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_demo)
+                    CallbackQueryHandler(timed(self.handle_demo), pattern="^(М|Ж)$"),
+                    MessageHandler(filters.TEXT & ~filters.COMMAND, timed(self.handle_demo))
                 ],
-                Q_STATE: [CallbackQueryHandler(self.handle_answer, pattern="^(A|B)$")],
-                TIME_OF_YEAR: [CallbackQueryHandler(self.handle_time_of_year)]
+                Q_STATE: [CallbackQueryHandler(timed(self.handle_answer), pattern="^(A|B)$")],
+                TIME_OF_YEAR: [CallbackQueryHandler(timed(self.handle_time_of_year))]
             },
             fallbacks=[],
-            per_message=False
+            per_message=False,
+            name="skin_test",
+            persistent=bool(self.sessions_path)
         )
 
-        app.add_handler(CommandHandler("start", self.start))
-        app.add_handler(conv)
-        app.add_handler(CallbackQueryHandler(self.handle_photo_stage, pattern="^photo_stage$"))
-        app.add_handler(CallbackQueryHandler(self.handle_care_stage, pattern="^care_stage$"))
+        self.sweeper = SessionSweeper(
+            app, conv, self.session_timeouts, idle_timeout=IDLE_SESSION_TIMEOUT,
+            on_abandon=self.record_abandonment if self.record_abandoned else None
+        )
+
+        metrics.CONVERSATIONS.set_function(self.conversation_counts)
+        metrics.SESSIONS.set_function(lambda: len(app.user_data))
 
-        print("Бот запущен 🚀")
-        app.run_polling()
+        app.add_handler(TypeHandler(Update, self.touch_session), group=-1)
+        app.add_handler(CommandHandler("start", timed(self.start)))
+        app.add_handler(CommandHandler("stats", timed(self.stats)))
+        app.add_handler(CommandHandler("export", timed(self.export)))
+        app.add_handler(conv)
+        app.add_handler(CallbackQueryHandler(timed(self.handle_photo_stage), pattern="^photo_stage$"))
+        app.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE, timed(self.handle_photo)))
+        app.add_handler(CallbackQueryHandler(timed(self.handle_report), pattern="^report$"))
+        app.add_handler(CallbackQueryHandler(timed(self.handle_care_stage), pattern="^care_stage$"))
+        self._phase("build_app")
+        return app
+
+    def conversation_counts(self) -> dict:
+        """Незавершённые тесты по состояниям — для метрики skinbot_conversations."""
+        by_state = self.sweeper.by_state() if self.sweeper is not None else {}
+        return {(name,): by_state.get(state, 0) for state, name in STATE_NAMES.items()}
+
+    def run(self, webhook: dict = None):
+        """
+        webhook — None (long polling) или параметры встроенного HTTP-сервера PTB:
+        {"listen": "0.0.0.0", "port": 8443, "url_path": "bot", "webhook_url": "https://.../bot",
+         "secret_token": "..."}; нужен пакет python-telegram-bot[webhooks].
+        """
+        app = self.build_app()
+        if webhook:
+            # Сколько параллельных соединений Telegram открывает к вебхуку (1..100)
+            webhook = {"max_connections": min(100, max(40, self.concurrent_updates)), **webhook}
+            print(f"Бот запущен 🚀 (webhook :{webhook.get('port', 80)}, "
+                  f"параллельно апдейтов: {self.concurrent_updates})")
+            app.run_webhook(**webhook)
+        else:
+            print(f"Бот запущен 🚀 (polling, параллельно апдейтов: {self.concurrent_updates})")
+            app.run_polling()
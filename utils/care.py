@@ -0,0 +1,285 @@
+import json
+import re
+import time
+
+import numpy as np
+
+from utils.test import AXES, SKIN_CODES
+
+# ===============================================================
+#              ПОДБОР УХОДА ПО КАТАЛОГУ СРЕДСТВ
+# ===============================================================
+#
+# Каталог (JSON lines, по средству на строку) загружается один раз при
+# старте, и сразу строятся индексы:
+#   - для каждой пары (код Бауманн, сезон) и каждого шага ухода —
+#     заранее отранжированный список лучших depth средств;
+#   - обратный индекс «ингредиент / группа аллергенов → номера средств».
+# Запрос пациента — это поиск готового списка по (код, сезон), объединение
+# множеств средств с его аллергенами и проход по списку с пропуском
+# исключённых. Время ответа не зависит от размера каталога.
+#
+# Формат строки каталога:
+#   {"id": "c1", "name": "...", "brand": "...", "step": "cleanser",
+#    "skin": "O*S*",                  # буквы по осям O/D S/R P/N W/T, * — любая
+#    "seasons": ["Весна/Лето"],       # пусто — круглый год
+#    "ingredients": ["niacinamide", ...], "allergens": ["fragrance", ...],
+#    "rating": 4.6}
+
+# Шаги ухода в порядке применения
+STEPS = {
+    "cleanser": "Очищение",
+    "toner": "Тонизирование",
+    "serum": "Сыворотка",
+    "moisturizer": "Увлажнение",
+    "spf": "Защита от солнца",
+}
+
+SEASON_ANY = ""                 # сезон не указан — только круглогодичные средства
+SEASONS = [SEASON_ANY, "Осень/Зима", "Весна/Лето"]
+
+# Основы слов из свободного ответа «аллергии» → группы аллергенов каталога
+ALLERGEN_STEMS = {
+    "орех": "nuts", "миндал": "nuts", "арахис": "nuts", "ши": "nuts",
+    "отдушк": "fragrance", "аромат": "fragrance", "парфюм": "fragrance", "духи": "fragrance",
+    "эфирн": "essential_oils", "лаванд": "essential_oils", "цитрус": "essential_oils",
+    "ланолин": "lanolin", "шерст": "lanolin",
+    "мед": "bee", "мёд": "bee", "пчел": "bee", "пчёл": "bee", "прополис": "bee", "воск": "bee",
+    "спирт": "alcohol", "алкогол": "alcohol",
+    "салицил": "salicylates", "аспирин": "salicylates",
+    "парабен": "parabens", "консервант": "parabens",
+    "соя": "soy", "сои": "soy", "соев": "soy",
+    "латекс": "latex",
+    "никел": "nickel",
+    "ретинол": "retinoids", "ретино": "retinoids",
+    "кислот": "acids",
+    "солнцезащит": "uv_filters", "фильтр": "uv_filters",
+}
+NO_ALLERGIES = {"", "нет", "no", "none", "-", "—"}
+
+# Как группы аллергенов показываются пользователю
+ALLERGEN_NAMES = {
+    "nuts": "орехи", "fragrance": "отдушки", "essential_oils": "эфирные масла", "lanolin": "ланолин",
+    "bee": "продукты пчеловодства", "alcohol": "спирт", "salicylates": "салицилаты", "parabens": "парабены",
+    "soy": "соя", "latex": "латекс", "nickel": "никель", "retinoids": "ретиноиды", "acids": "кислоты",
+    "uv_filters": "УФ-фильтры",
+}
+
+_WORD = re.compile(r"[a-zа-яё0-9_]+")
+
+
+def parse_allergies(text: str) -> set:
+    """Группы аллергенов и названия ингредиентов из свободного текста."""
+    text = (text or "").strip().lower()
+    if text in NO_ALLERGIES:
+        return set()
+    found = set()
+    for word in _WORD.findall(text):
+        found.add(word)                          # латинское название ингредиента
+        # Самая длинная подходящая основа: «соевый» → «соев», «сок» не трогаем
+        for size in range(min(len(word), 12), 1, -1):
+            group = ALLERGEN_STEMS.get(word[:size])
+            if group is not None and (size >= 3 or size == len(word)):
+                found.add(group)
+                break
+    return found
+
+
+def normalize_phrase(text: str) -> str:
+    """«Shea-Butter,» → "shea butter": слова через один пробел, для поиска фраз."""
+    return " ".join(_WORD.findall((text or "").lower()))
+
+
+def pattern_codes(pattern: str):
+    """Коды осей для маски "O*S*": 0 — любая буква, 1 — первая, 2 — вторая."""
+    pattern = (pattern or "****").upper().ljust(len(AXES), "*")
+    codes = []
+    for letter, axis in zip(pattern, AXES):
+        first, second = axis.split("/")
+        codes.append(1 if letter == first else 2 if letter == second else 0)
+    return codes
+
+
+class CareEngine:
+    def __init__(self, per_step: int = 2, depth: int = 64):
+        self.per_step = per_step
+        self.depth = depth                   # сколько лучших средств хранится на (код, сезон, шаг)
+        self.products = []
+        self.ranked = {}                     # (код, сезон, шаг) -> np.ndarray номеров средств
+        self.inverted = {}                   # ингредиент / группа -> frozenset номеров средств
+        self.phrases = {}                    # нормализованная фраза из нескольких слов -> ключ inverted
+        self.phrase_words = 0                # самая длинная фраза, слов
+        # Колонки каталога для поиска мимо заготовленных списков
+        self._axes = None
+        self._score = None
+        self._step_masks = {}
+        self._season_masks = {}
+        self.load_ms = 0.0
+        self.lookups = 0
+        self.lookup_ms = 0.0
+        self.deep_lookups = 0                # поиски мимо заготовленных списков
+
+    # -----------------------------------------------------------
+    #                    ЗАГРУЗКА И ИНДЕКСЫ
+    # -----------------------------------------------------------
+
+    def load(self, path: str):
+        products = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    products.append(json.loads(line))
+        self.build(products)
+        print(f"💄 Каталог ухода: {len(products)} средств, индексы за {self.load_ms:.0f} мс")
+
+    def build(self, products: list):
+        started = time.perf_counter()
+        n = len(products)
+        axes = np.array([pattern_codes(p.get("skin")) for p in products], dtype=np.uint8).reshape(n, len(AXES))
+        rating = np.array([float(p.get("rating", 0)) for p in products], dtype=np.float32)
+        # Более точное попадание в тип кожи важнее рейтинга
+        score = (axes > 0).sum(axis=1).astype(np.float32) * 10 + rating
+        steps = np.array([p.get("step", "") for p in products], dtype=object)
+        season_any = np.array([not p.get("seasons") for p in products], dtype=bool)
+
+        inverted = {}
+        for i, p in enumerate(products):
+            for name in {*p.get("ingredients", ()), *p.get("allergens", ())}:
+                inverted.setdefault(name.lower(), []).append(i)
+
+        self._axes = axes
+        self._score = score
+        self._step_masks = {step: steps == step for step in STEPS}
+        self._season_masks = {SEASON_ANY: season_any}
+        for season in SEASONS[1:]:
+            self._season_masks[season] = season_any | np.array(
+                [season in (p.get("seasons") or ()) for p in products], dtype=bool
+            )
+        ranked = {}
+        for code in SKIN_CODES:
+            fits = self._fits(code)
+            for season, season_mask in self._season_masks.items():
+                for step, step_mask in self._step_masks.items():
+                    idx = np.flatnonzero(fits & season_mask & step_mask)
+                    if len(idx) > self.depth:
+                        idx = idx[np.argpartition(-score[idx], self.depth)[:self.depth]]
+                    ranked[code, season, step] = idx[np.argsort(-score[idx], kind="stable")].tolist()
+
+        self.products = products
+        self.ranked = ranked
+        self.inverted = {name: frozenset(ids) for name, ids in inverted.items()}
+        # «shea butter», «coco-glucoside»: по отдельным словам ответа их не найти
+        self.phrases = {}
+        for name in inverted:
+            phrase = normalize_phrase(name)
+            if " " in phrase or phrase != name:
+                self.phrases[phrase] = name
+        self.phrase_words = max((phrase.count(" ") + 1 for phrase in self.phrases), default=0)
+        self.load_ms = (time.perf_counter() - started) * 1000
+
+    def _fits(self, code: str) -> np.ndarray:
+        # Средство подходит, если по каждой оси у него «любая» или буква кода
+        letters = np.array(pattern_codes(code), dtype=np.uint8)
+        return ((self._axes == 0) | (self._axes == letters)).all(axis=1)
+
+    # -----------------------------------------------------------
+    #                          ПОДБОР
+    # -----------------------------------------------------------
+
+    def excluded(self, allergies: str) -> tuple:
+        """(найденные аллергены, множества номеров средств с ними)."""
+        found = {name for name in parse_allergies(allergies) if name in self.inverted}
+        # Фразы — поиском n-грамм ответа в словаре, а не перебором словаря
+        words = normalize_phrase(allergies).split()
+        for size in range(1, min(self.phrase_words, len(words)) + 1):
+            for start in range(len(words) - size + 1):
+                name = self.phrases.get(" ".join(words[start:start + size]))
+                if name is not None:
+                    found.add(name)
+        found = sorted(found)
+        return found, [self.inverted[name] for name in found]
+
+    def recommend(self, patient) -> dict:
+        """
+        Уход для пациента. patient — запись или JSON из storage.get_patient_json
+        (нужны final_skin_type или skin_code, time_of_year, allergies).
+        """
+        started = time.perf_counter()
+        if isinstance(patient, str):
+            patient = json.loads(patient or "{}")
+        code = str(patient.get("final_skin_type") or patient.get("skin_code") or "").upper()
+        season = patient.get("time_of_year") or SEASON_ANY
+        if season not in SEASONS:
+            season = SEASON_ANY
+        allergens, excluded = self.excluded(patient.get("allergies", ""))
+
+        steps = []
+        if code in SKIN_CODES:
+            for step, title in STEPS.items():
+                ranked = self.ranked[code, season, step]
+                chosen = _take(ranked, excluded, self.per_step)
+                if len(chosen) < self.per_step and len(ranked) == self.depth:
+                    # Аллергены выбили весь заготовленный список — ищем по всему каталогу
+                    chosen = self._deep(code, season, step, excluded)
+                if chosen:
+                    steps.append({"step": step, "title": title,
+                                  "products": [self.products[i] for i in chosen]})
+
+        self.lookups += 1
+        self.lookup_ms += (time.perf_counter() - started) * 1000
+        return {"skin_type": code, "season": season, "excluded_allergens": allergens, "steps": steps}
+
+    def _deep(self, code: str, season: str, step: str, excluded: list) -> list:
+        self.deep_lookups += 1
+        allowed = self._fits(code) & self._season_masks[season] & self._step_masks[step]
+        for ids in excluded:
+            allowed[list(ids)] = False
+        idx = np.flatnonzero(allowed)
+        if len(idx) > self.per_step:
+            idx = idx[np.argpartition(-self._score[idx], self.per_step)[:self.per_step]]
+        return idx[np.argsort(-self._score[idx], kind="stable")].tolist()
+
+    def stats(self) -> dict:
+        return {
+            "products": len(self.products),
+            "load_ms": self.load_ms,
+            "lookups": self.lookups,
+            "avg_lookup_ms": self.lookup_ms / self.lookups if self.lookups else 0.0,
+            "deep_lookups": self.deep_lookups,
+        }
+
+
+def _take(ranked: list, excluded: list, count: int) -> list:
+    chosen = []
+    for i in ranked:
+        if not any(i in ids for ids in excluded):
+            chosen.append(i)
+            if len(chosen) == count:
+                break
+    return chosen
+
+
+def escape_markdown(text) -> str:
+    """Экранирование для parse_mode="Markdown" (legacy): _ * ` [."""
+    return re.sub(r"([_*`\[])", r"\\\1", str(text))
+
+
+def format_routine(routine: dict, markdown: bool = True) -> str:
+    """Текст для пользователя (Markdown; markdown=False — без разметки)."""
+    if not routine["steps"]:
+        return "⚠️ Не удалось подобрать уход: тип кожи ещё не определён."
+    esc = escape_markdown if markdown else str
+    bold = "*" if markdown else ""
+    lines = [f"💄 {bold}Уход для типа кожи {esc(routine['skin_type'])}{bold}"
+             + (f" ({esc(routine['season'])})" if routine["season"] else "")]
+    if routine["excluded_allergens"]:
+        names = (ALLERGEN_NAMES.get(name, name) for name in routine["excluded_allergens"])
+        lines.append(f"🚫 Исключены средства с: {esc(', '.join(names))}")
+    for n, step in enumerate(routine["steps"], 1):
+        lines.append(f"\n{bold}{n}. {esc(step['title'])}{bold}")
+        for product in step["products"]:
+            brand = f"{product['brand']} — " if product.get("brand") else ""
+            lines.append(f"  • {esc(brand + product['name'])}")
+    lines.append("\nПодбор носит справочный характер и не заменяет консультацию дерматолога.")
+    return "\n".join(lines)
@@ -1,192 +1,240 @@
-import csv
 import asyncio
+import itertools
 import os
 import json
+import threading
+
+from utils.metrics import MeteredLock
+from utils.patient_store import PatientStore, ShardedPatientStore, shard_index
+from utils.storage import HEADERS, FINAL_FIELDS, format_percent, utc_now
+from utils.test import compare_skin_types
 
 CSV_FILE = "patients.csv"
 
-# --- Единая структура полей ---
-HEADERS = [
-    "id_patient",
-    "age",
-    "sex",
-    "allergies",
-    "answers_json",
-    "skin_code",
-    "skin_type_dermatoscopy",
-    "match_percent",
-    "final_skin_type",
-    "time_of_year"
-]
-
-LOCK = asyncio.Lock()
-
-# --- Инициализация CSV ---
-if not os.path.exists(CSV_FILE):
-    with open(CSV_FILE, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=HEADERS)
-        writer.writeheader()
+# --- Единая структура полей (общая для всех хранилищ) ---
+# HEADERS, FINAL_FIELDS — см. utils/storage.py
+
+# --- Шардирование (несколько процессов бота на одних файлах) ---
+# 1 — один файл patients.csv; N — файлы patients.0.csv … patients.N-1.csv.
+CSV_SHARDS = int(os.getenv("CSV_SHARDS", "1"))
+
+# Блокировка шарда внутри процесса (LOCK — блокировка шарда 0).
+# Между процессами записи защищает блокировка ОС на файл <шард>.lock.
+# Ожидание и удержание пишутся в метрики (skinbot_lock_*_seconds{lock="dataset_csv:<шард>"}).
+LOCK = MeteredLock("dataset_csv:0")
+
+# --- Хранилище: append-only файлы + индекс id_patient → смещение ---
+# При импорте модуль ничего не читает и не создаёт: файлы (с заголовком,
+# если их нет) открываются при первом обращении — в боте это open_store()
+# из хука запуска, построение индекса читает все файлы.
+CACHE_SIZE = 10_000   # сколько последних записей держать в памяти (LRU)
+
+_store = None
+_locks = [LOCK]
+_compaction_tasks = {}
+_OPEN_LOCK = asyncio.Lock()
+_STORE_LOCK = threading.Lock()
+
+
+def get_store() -> ShardedPatientStore:
+    """Синхронный доступ к хранилищу (для скриптов вне event loop)."""
+    global _store, _locks
+    if _store is None:
+        with _STORE_LOCK:
+            if _store is None:
+                store = ShardedPatientStore(CSV_FILE, HEADERS, shards=CSV_SHARDS, cache_size=CACHE_SIZE)
+                # open_store вызывает нас в потоке: корутина, увидевшая _store,
+                # должна уже видеть и блокировки всех его шардов
+                _locks = [LOCK] + [MeteredLock(f"dataset_csv:{i}") for i in range(1, len(store.shards))]
+                _store = store
+    return _store
+
+
+async def open_store() -> ShardedPatientStore:
+    """То же, но индекс строится в потоке, не блокируя event loop."""
+    if _store is None:
+        async with _OPEN_LOCK:
+            if _store is None:
+                await asyncio.to_thread(get_store)
+    return _store
+
+
+async def close_store():
+    """Дожидается фонового сжатия и закрывает файлы (следующее обращение откроет их заново)."""
+    global _store
+    pending = [task for task in _compaction_tasks.values() if not task.done()]
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+    _compaction_tasks.clear()
+    if _store is not None:
+        _store.close()
+        _store = None
+
+
+async def _shard(id_patient: str):
+    """Шард пациента и его блокировка внутри процесса."""
+    store = await open_store()
+    i = shard_index(id_patient, len(store.shards))
+    return store.shards[i], _locks[i]
+
+
+def _schedule_compaction(shard: PatientStore, lock: asyncio.Lock):
+    """Запускает фоновое сжатие шарда, если устаревших версий стало много."""
+    if not shard.needs_compaction():
+        return
+    task = _compaction_tasks.get(shard.path)
+    if task is None or task.done():
+        _compaction_tasks[shard.path] = asyncio.get_running_loop().create_task(_compact(shard, lock))
+
+
+async def _compact(shard: PatientStore, lock: asyncio.Lock):
+    # Перезапись файла идёт в потоке и без блокировки — пользователи
+    # продолжают сохранять данные. Блокировка нужна только на подмену файла.
+    snap = await asyncio.to_thread(shard.snapshot)
+    tmp_path, compacted = await asyncio.to_thread(shard.write_compacted, snap)
+    async with lock:
+        await asyncio.to_thread(shard.commit_compacted, snap, tmp_path, compacted)
 
 # ===============================================================
 #                        ФУНКЦИИ СОХРАНЕНИЯ
 # ===============================================================
 
-async def save_initial_data(id_patient: str, age: int, sex: str, allergies: str):
-    """Создание новой записи при старте диалога."""
-    async with LOCK:
-        with open(CSV_FILE, "a", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=HEADERS)
-            writer.writerow({
-                "id_patient": id_patient,
-                "age": age,
-                "sex": sex,
-                "allergies": allergies,
-                "answers_json": "",
-                "skin_code": "",
-                "skin_type_dermatoscopy": "",
-                "match_percent": "",
-                "final_skin_type": "",
-                "time_of_year": ""
-            })
-
-
-async def save_test_results(id_patient: str, answers_json: str, skin_code: str, time_of_year: str = ""):
+async def save_initial_data(id_patient: str, age: int, sex: str, allergies: str, consent: str = "yes"):
+    """Создание новой записи при старте диалога (после согласия)."""
+    shard, lock = await _shard(id_patient)
+    record = dict.fromkeys(HEADERS, "")
+    record.update({
+        "id_patient": id_patient,
+        "age": age,
+        "sex": sex,
+        "allergies": allergies,
+        "created_at": utc_now(),
+        "consent": consent
+    })
+    async with lock:
+        await asyncio.to_thread(shard.put, record)
+        _schedule_compaction(shard, lock)
+
+
+async def save_test_results(id_patient: str, answers_json: str, skin_code: str, time_of_year: str = "",
+                            questionnaire_version: str = ""):
     """Сохранение результатов теста."""
-    async with LOCK:
-        rows = []
-        with open(CSV_FILE, "r", newline="", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            rows = list(reader)
-
-        updated = False
-        for row in rows:
-            if row.get("id_patient") == id_patient:
-                row["answers_json"] = answers_json
-                row["skin_code"] = skin_code
-                if time_of_year:
-                    row["time_of_year"] = time_of_year
-                updated = True
-                break
-
-        if not updated:
-            rows.append({
-                "id_patient": id_patient,
-                "age": "",
-                "sex": "",
-                "allergies": "",
-                "answers_json": answers_json,
-                "skin_code": skin_code,
-                "skin_type_dermatoscopy": "",
-                "match_percent": "",
-                "final_skin_type": "",
-                "time_of_year": time_of_year
-            })
-
-        with open(CSV_FILE, "w", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=HEADERS)
-            writer.writeheader()
-            writer.writerows(rows)
+    def mutate(row):
+        row["answers_json"] = answers_json
+        row["skin_code"] = skin_code
+        row["questionnaire_version"] = questionnaire_version
+        if time_of_year:
+            row["time_of_year"] = time_of_year
+
+    shard, lock = await _shard(id_patient)
+    async with lock:
+        await asyncio.to_thread(shard.update, id_patient, mutate)
+        _schedule_compaction(shard, lock)
 
 
 async def save_dermatoscopy_result(id_patient, skin_code, skin_type_dermatoscopy):
     """Сохранение результатов анализа по фото и автоматическое вычисление совпадения."""
-    async with LOCK:
-        rows = []
-        with open(CSV_FILE, "r", encoding="utf-8", newline="") as f:
-            reader = csv.DictReader(f)
-            rows = list(reader)
-
-        found = False
-        comparison = {"match_percent": 0, "final_skin_type": skin_type_dermatoscopy}
-        for row in rows:
-            if row["id_patient"] == id_patient:
+    def save():
+        with shard.locked():
+            # Для нового пациента тест ещё не пройден — сравнивать не с чем
+            code = skin_code if id_patient in shard else ""
+            comparison = compare_skin_types(code, skin_type_dermatoscopy)
+
+            def mutate(row):
                 row["skin_type_dermatoscopy"] = skin_type_dermatoscopy
-                comparison = compare_skin_types(skin_code, skin_type_dermatoscopy)
-                row["match_percent"] = comparison["match_percent"]
+                row["match_percent"] = format_percent(comparison["match_percent"])
                 row["final_skin_type"] = comparison["final_skin_type"]
-                found = True
-                break
-
-        if not found:
-            comparison = compare_skin_types("", skin_type_dermatoscopy)
-            rows.append({
-                "id_patient": id_patient,
-                "age": "",
-                "sex": "",
-                "allergies": "",
-                "answers_json": "",
-                "skin_code": "",
-                "skin_type_dermatoscopy": skin_type_dermatoscopy,
-                "match_percent": comparison["match_percent"],
-                "final_skin_type": comparison["final_skin_type"],
-                "time_of_year": ""
-            })
-
-        with open(CSV_FILE, "w", encoding="utf-8", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=HEADERS)
-            writer.writeheader()
-            writer.writerows(rows)
-
-        return comparison  # 🔥 Возвращаем результат сразу
 
+            shard.update(id_patient, mutate)
+            return comparison
 
-# ===============================================================
-#                  АНАЛИТИКА И ФИНАЛЬНЫЙ ТИП КОЖИ
-# ===============================================================
-def compare_skin_types(skin_code: str, skin_type_dermatoscopy: str) -> dict:
-    """
-    Сравнивает тип кожи по тесту и по дерматоскопии посимвольно.
-    Возвращает процент совпадения и финальный тип кожи.
-    
-    Логика:
-    - Для каждой позиции из 4 символов:
-        - Если символы совпадают, увеличиваем счётчик совпадений и добавляем этот символ в финальный код
-        - Если нет — добавляем символ из дерматоскопии
-    - match_percent = (совпадения / 4) * 100
-    """
-    # Очистка входных данных
-    s1 = (skin_code or "").strip().upper()[:4]
-    s2 = (skin_type_dermatoscopy or "").strip().upper()[:4]
+    shard, lock = await _shard(id_patient)
+    async with lock:
+        comparison = await asyncio.to_thread(save)
+        _schedule_compaction(shard, lock)
 
-    # Если один из кодов пустой, финальный тип = непустой, совпадение = 0%
-    if not s1:
-        return {"match_percent": 0, "final_skin_type": s2}
-    if not s2:
-        return {"match_percent": 0, "final_skin_type": s1}
+    return comparison  # 🔥 Возвращаем результат сразу
 
-    matches = 0
-    final_type = []
 
-    for i, (c_test, c_derm) in enumerate(zip(s1, s2)):
-        if c_test == c_derm:
-            matches += 1
-            final_type.append(c_test)
-        else:
-            final_type.append(c_derm)
+async def bulk_update(records: list):
+    """
+    Обновление многих записей за один проход: по каждому шарду одна
+    блокировка и одна серия дозаписей в конец файла.
+    """
+    store = await open_store()
+    by_shard = {}
+    for changes in records:
+        by_shard.setdefault(shard_index(changes["id_patient"], len(store.shards)), []).append(changes)
+
+    def apply(shard, items):
+        with shard.locked():
+            for changes in items:
+                shard.update(changes["id_patient"], lambda row: row.update(changes))
 
-    match_percent = round((matches / 4) * 100, 2)
-    final_skin_type = "".join(final_type)
+    for i, items in by_shard.items():
+        shard = store.shards[i]
+        async with _locks[i]:
+            await asyncio.to_thread(apply, shard, items)
+            _schedule_compaction(shard, _locks[i])
 
-    # Для дебага: выводим в консоль
-    print(f"[DEBUG] test: {s1}, derm: {s2}, matches: {matches}, final: {final_skin_type}, %: {match_percent}")
 
-    return {"match_percent": match_percent, "final_skin_type": final_skin_type}
+async def save_time_of_year(id_patient: str, time_of_year: str):
+    """Сохранение сезона, для которого подбирается уход."""
+    def mutate(row):
+        row["time_of_year"] = time_of_year
 
+    shard, lock = await _shard(id_patient)
+    async with lock:
+        await asyncio.to_thread(shard.update, id_patient, mutate)
+        _schedule_compaction(shard, lock)
 
 
 # ===============================================================
 #                КОНВЕРТАЦИЯ В JSON ДЛЯ LLM/RAG
 # ===============================================================
 
-def get_patient_json(id_patient: str) -> str:
+async def get_patient(id_patient: str):
+    """
+    Возвращает запись пациента (dict) или None.
+    LOCK не нужен: запись по смещению в append-only файле неизменна,
+    а свежие версии только что сохранённых пациентов лежат в кэше.
+    Кэш в event loop смотрится без ожидания мьютекса (wait=False): поток
+    записи может держать его, стоя на блокировке файла другого процесса.
+    """
+    shard, _ = await _shard(id_patient)
+    row = shard.cached(id_patient, wait=False)
+    if row is None:
+        row = await asyncio.to_thread(shard.get, id_patient)
+    return row
+
+
+async def get_patient_json(id_patient: str) -> str:
     """Возвращает JSON с финальными полями для LLM/RAG."""
-    final_fields = ["age", "sex", "allergies", "final_skin_type", "time_of_year"]
-    with open(CSV_FILE, "r", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row["id_patient"] == id_patient:
-                # Формируем словарь только с нужными полями
-                filtered = {k: row[k] for k in final_fields}
-                return json.dumps(filtered, ensure_ascii=False, indent=2)
-    return "{}"
+    row = await get_patient(id_patient)
+    if row is None:
+        return "{}"
+    # Формируем словарь только с нужными полями
+    filtered = {k: row[k] for k in FINAL_FIELDS}
+    return json.dumps(filtered, ensure_ascii=False, indent=2)
+
+
+# ===============================================================
+#                  ВЫГРУЗКА ДЛЯ АНАЛИТИКИ
+# ===============================================================
 
+async def iter_records(chunk_size: int = 1000):
+    """Все записи порциями; чтение файлов идёт в потоке."""
+    store = await open_store()
+    records = store.iter_records()
+    while True:
+        chunk = await asyncio.to_thread(list, itertools.islice(records, chunk_size))
+        if not chunk:
+            break
+        for record in chunk:
+            yield record
+
+
+async def changes_since(token=None):
+    """Записи, изменённые после token (см. PatientStore.changes_since)."""
+    store = await open_store()
+    return await asyncio.to_thread(store.changes_since, token)
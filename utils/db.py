@@ -1,9 +1,109 @@
 import asyncpg
 import json
 import asyncio
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+
+from utils.metrics import POOL_WAIT_SECONDS
+from utils.storage import format_percent
+from utils.test import compare_skin_types
+from utils.write_behind import WriteBehindQueue
+
+# Колонки таблицы → имена полей записи пациента (как в dataset_csv.HEADERS)
+PATIENT_SELECT = """
+    SELECT id_patient,
+           COALESCE(age::text, '') AS age,
+           COALESCE(sex, '') AS sex,
+           COALESCE(allergies, '') AS allergies,
+           COALESCE(test_answers::text, '') AS answers_json,
+           COALESCE(test_result, '') AS skin_code,
+           COALESCE(skin_type_dermatoscopy, '') AS skin_type_dermatoscopy,
+           COALESCE(match_percent::text, '') AS match_percent,
+           COALESCE(final_skin_type, '') AS final_skin_type,
+           COALESCE(time_of_year, '') AS time_of_year,
+           COALESCE(questionnaire_version, '') AS questionnaire_version,
+           COALESCE(abandoned_stage, '') AS abandoned_stage,
+           COALESCE(to_char(created_at AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS"Z"'), '') AS created_at,
+           COALESCE(consent, '') AS consent,
+           updated_at
+    FROM patients
+"""
+
+SQL_UPDATE_TEST_RESULTS = """
+    INSERT INTO patients (id_patient, test_answers, test_result, time_of_year, questionnaire_version)
+    VALUES ($1, $2, $3, NULLIF($4, ''), $5)
+    ON CONFLICT (id_patient) DO UPDATE
+    SET test_answers = EXCLUDED.test_answers,
+        test_result = EXCLUDED.test_result,
+        questionnaire_version = EXCLUDED.questionnaire_version,
+        time_of_year = COALESCE(EXCLUDED.time_of_year, patients.time_of_year),
+        updated_at = now();
+"""
+
+SQL_SAVE_TIME_OF_YEAR = """
+    INSERT INTO patients (id_patient, time_of_year)
+    VALUES ($1, $2)
+    ON CONFLICT (id_patient) DO UPDATE
+    SET time_of_year = EXCLUDED.time_of_year,
+        updated_at = now();
+"""
+
+SQL_SAVE_TEST_RESULTS_BY_ID = """
+    UPDATE patients
+    SET test_answers = $1,
+        test_result = $2,
+        updated_at = now()
+    WHERE id = $3;
+"""
+
+INITIAL_COLUMNS = ("sex", "age", "allergies", "id_patient", "consent", "created_at")
+
+# Повторный /start с тем же id_patient создаёт запись заново (как put в CSV-хранилище)
+SQL_CREATE_PATIENT_INITIAL = """
+    INSERT INTO patients (sex, age, allergies, id_patient, consent, created_at)
+    VALUES ($1, $2, $3, $4, $5, $6)
+    ON CONFLICT (id_patient) DO UPDATE
+    SET sex = EXCLUDED.sex,
+        age = EXCLUDED.age,
+        allergies = EXCLUDED.allergies,
+        consent = EXCLUDED.consent,
+        created_at = EXCLUDED.created_at,
+        test_answers = NULL,
+        test_result = NULL,
+        skin_type_dermatoscopy = NULL,
+        match_percent = NULL,
+        final_skin_type = NULL,
+        time_of_year = NULL,
+        questionnaire_version = NULL,
+        abandoned_stage = NULL,
+        updated_at = now()
+    RETURNING id;
+"""
+
+# Поле записи пациента → колонка таблицы (для bulk_update)
+FIELD_COLUMNS = {
+    "age": "age",
+    "sex": "sex",
+    "allergies": "allergies",
+    "answers_json": "test_answers",
+    "skin_code": "test_result",
+    "skin_type_dermatoscopy": "skin_type_dermatoscopy",
+    "match_percent": "match_percent",
+    "final_skin_type": "final_skin_type",
+    "time_of_year": "time_of_year",
+    "questionnaire_version": "questionnaire_version",
+    "abandoned_stage": "abandoned_stage",
+    "created_at": "created_at",
+    "consent": "consent",
+}
+
+# Типы колонок для приведения текстовых значений из записи
+COLUMN_CASTS = {"age": "int", "test_answers": "jsonb", "match_percent": "real", "created_at": "timestamptz"}
+
 
 class DBHandler:
-    def __init__(self, config):
+    def __init__(self, config, write_behind: dict = None):
         """
         config = {
             "user": "postgres",
@@ -12,14 +112,17 @@ class DBHandler:
             "host": "127.0.0.1",
             "port": 5432
         }
+        write_behind — None (каждая запись сразу уходит в базу) или параметры
+        пакетной записи: {"batch_size": 200, "flush_interval": 0.05, "max_pending": 2000}
         """
         self.config = config
         self.pool = None
+        self.write_behind = WriteBehindQueue(self, **write_behind) if write_behind is not None else None
 
     async def init_db(self):
         """Создает подключение к базе и таблицу patients, если её нет"""
         self.pool = await asyncpg.create_pool(**self.config)
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             await conn.execute("""
                 CREATE TABLE IF NOT EXISTS patients (
                     id SERIAL PRIMARY KEY,
@@ -30,20 +133,76 @@ class DBHandler:
                     test_result VARCHAR(10)
                 );
             """)
+            # Колонки для полного сценария бота (id_patient — uuid из диалога)
+            await conn.execute("""
+                ALTER TABLE patients
+                    ADD COLUMN IF NOT EXISTS id_patient TEXT UNIQUE,
+                    ADD COLUMN IF NOT EXISTS skin_type_dermatoscopy VARCHAR(10),
+                    ADD COLUMN IF NOT EXISTS match_percent REAL,
+                    ADD COLUMN IF NOT EXISTS final_skin_type VARCHAR(10),
+                    ADD COLUMN IF NOT EXISTS time_of_year TEXT,
+                    ADD COLUMN IF NOT EXISTS questionnaire_version TEXT,
+                    ADD COLUMN IF NOT EXISTS abandoned_stage TEXT,
+                    ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ,
+                    ADD COLUMN IF NOT EXISTS consent TEXT;
+            """)
+            await conn.execute(
+                "CREATE INDEX IF NOT EXISTS patients_updated_at ON patients (updated_at);"
+            )
+            # Выгрузки фильтруют по дате создания (у старых строк created_at пустой)
+            await conn.execute(
+                "CREATE INDEX IF NOT EXISTS patients_created_at ON patients (created_at);"
+            )
         print("✅ Таблица patients готова")
+        if self.write_behind is not None:
+            self.write_behind.start()
 
-    async def create_patient_initial(self, sex: str, age: int, allergies: str) -> int:
+    async def close(self):
+        # Сначала сбрасываем отложенные записи, потом закрываем пул
+        if self.write_behind is not None:
+            await self.write_behind.close()
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Соединение из пула; время ожидания пишется в метрики."""
+        started = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+            yield conn
+
+    async def flush(self):
+        """Дописать в базу всё отложенное (чтение должно видеть свои записи)."""
+        if self.write_behind is not None:
+            await self.write_behind.flush()
+
+    async def _execute(self, sql: str, *args, wait: bool = False):
+        if self.write_behind is not None:
+            await self.write_behind.execute(sql, args, wait=wait)
+            return
+        async with self.acquire() as conn:
+            await conn.execute(sql, *args)
+
+    async def create_patient_initial(self, sex: str, age: int, allergies: str, id_patient: str = None,
+                                     wait: bool = True, consent: str = None) -> int:
         """
         Создает пациента с начальными данными
         Возвращает id нового пациента
+        (при пакетной записи и wait=False — None, не дожидаясь сброса)
+        consent — "yes", если пациент дал согласие (None — не записано)
         """
-        async with self.pool.acquire() as conn:
-            result = await conn.fetchrow("""
-                INSERT INTO patients (sex, age, allergies)
-                VALUES ($1, $2, $3)
-                RETURNING id;
-            """, sex, age, allergies)
-            return result["id"]
+        created_at = datetime.now(timezone.utc)
+        args = (sex, age, allergies, id_patient, consent, created_at)
+        if self.write_behind is not None:
+            # COPY не умеет upsert: пакет с уже существующим id_patient уйдёт
+            # повтором по одной операции, и эта — через SQL_CREATE_PATIENT_INITIAL
+            return await self.write_behind.copy_insert("patients", INITIAL_COLUMNS, args, wait=wait,
+                                                       upsert=SQL_CREATE_PATIENT_INITIAL)
+        async with self.acquire() as conn:
+            return await conn.fetchval(SQL_CREATE_PATIENT_INITIAL, *args)
 
     async def save_test_results(self, patient_id: int, answers: dict, result: str):
         """
@@ -51,13 +210,123 @@ class DBHandler:
         answers: словарь {категория: ответ, ...}
         result: итоговый код типа кожи (например "OSPW")
         """
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                UPDATE patients
-                SET test_answers = $1,
-                    test_result = $2
-                WHERE id = $3;
-            """, json.dumps(answers), result, patient_id)
+        await self._execute(SQL_SAVE_TEST_RESULTS_BY_ID, json.dumps(answers), result, patient_id)
+
+    # ------------------------------------------------------------
+    # Методы по id_patient (uuid из диалога бота).
+    # Все — upsert: как и CSV-версия, создают запись, если её нет.
+    # ------------------------------------------------------------
+
+    async def update_test_results(self, id_patient: str, answers, result: str, time_of_year: str = "",
+                                  questionnaire_version: str = ""):
+        """Ответы теста и код кожи; сезон обновляется, только если передан."""
+        await self._execute(SQL_UPDATE_TEST_RESULTS, id_patient,
+                            json.dumps(answers, ensure_ascii=False), result, time_of_year,
+                            questionnaire_version)
+
+    async def bulk_update(self, records: list):
+        """
+        Обновление многих записей одним executemany.
+        records — словари с id_patient и полями записи (значения — строки).
+        """
+        if not records:
+            return
+        fields = [f for f in records[0] if f != "id_patient"]
+        sets = []
+        for i, field in enumerate(fields, start=2):
+            column = FIELD_COLUMNS[field]
+            cast = COLUMN_CASTS.get(column)
+            value = f"NULLIF(${i}, '')::{cast}" if cast else f"${i}"
+            sets.append(f"{column} = {value}")
+        sql = (f"UPDATE patients SET {', '.join(sets)}, updated_at = now() "
+               f"WHERE id_patient = $1;")
+        args = [(r["id_patient"], *(str(r[f]) for f in fields)) for r in records]
+        await self.flush()
+        async with self.acquire() as conn:
+            await conn.executemany(sql, args)
+
+    async def save_time_of_year(self, id_patient: str, time_of_year: str):
+        await self._execute(SQL_SAVE_TIME_OF_YEAR, id_patient, time_of_year)
+
+    async def save_dermatoscopy_result(self, id_patient: str, skin_code: str, skin_type_dermatoscopy: str) -> dict:
+        """
+        Сохраняет результат дерматоскопии и совпадение с тестом.
+        Возвращает {"match_percent", "final_skin_type"}.
+        """
+        await self.flush()
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                exists = await conn.fetchval(
+                    "SELECT 1 FROM patients WHERE id_patient = $1 FOR UPDATE;", id_patient
+                )
+                # Для нового пациента тест ещё не пройден — сравнивать не с чем
+                comparison = compare_skin_types(skin_code if exists else "", skin_type_dermatoscopy)
+                await conn.execute("""
+                    INSERT INTO patients (id_patient, skin_type_dermatoscopy, match_percent, final_skin_type)
+                    VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (id_patient) DO UPDATE
+                    SET skin_type_dermatoscopy = EXCLUDED.skin_type_dermatoscopy,
+                        match_percent = EXCLUDED.match_percent,
+                        final_skin_type = EXCLUDED.final_skin_type,
+                        updated_at = now();
+                """, id_patient, skin_type_dermatoscopy,
+                    comparison["match_percent"], comparison["final_skin_type"])
+        return comparison
+
+    async def get_patient(self, id_patient: str):
+        """Запись пациента в формате dataset_csv (все значения — строки) или None."""
+        await self.flush()
+        async with self.acquire() as conn:
+            row = await conn.fetchrow(PATIENT_SELECT + " WHERE id_patient = $1;", id_patient)
+        return row_to_record(row) if row else None
+
+    async def iter_patients(self, since=None, chunk_size: int = 1000, created_since: datetime = None,
+                            created_until: datetime = None, final_skin_types=(), seasons=(), consent: str = None):
+        """
+        Все записи (или изменённые не раньше since) порциями через
+        серверный курсор — память не растёт с размером таблицы.
+        Фильтры выгрузки: created_at в [created_since, created_until),
+        final_skin_type и time_of_year из списков, значение consent.
+        """
+        await self.flush()
+        where = ["id_patient IS NOT NULL"]
+        args = []
+
+        def arg(value) -> str:
+            args.append(value)
+            return f"${len(args)}"
+
+        if since is not None:
+            where.append(f"updated_at >= {arg(since)}")
+        if created_since is not None:
+            where.append(f"created_at >= {arg(created_since)}")
+        if created_until is not None:
+            where.append(f"created_at < {arg(created_until)}")
+        if final_skin_types:
+            where.append(f"upper(final_skin_type) = ANY({arg(list(final_skin_types))}::text[])")
+        if seasons:
+            where.append(f"time_of_year = ANY({arg(list(seasons))}::text[])")
+        if consent is not None:
+            where.append(f"consent = {arg(consent)}")
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                cursor = await conn.cursor(PATIENT_SELECT + " WHERE " + " AND ".join(where) + " ORDER BY id;",
+                                           *args)
+                while True:
+                    rows = await cursor.fetch(chunk_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+
+
+def row_to_record(row) -> dict:
+    """Строка таблицы → запись пациента (без служебных колонок)."""
+    record = dict(row)
+    record.pop("updated_at", None)
+    if "match_percent" in record:
+        record["match_percent"] = format_percent(record["match_percent"])    # real::text — "75", в CSV — "75"
+    return record
 
 # ================================
 # Пример использования (для теста)
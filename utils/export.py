@@ -0,0 +1,219 @@
+import argparse
+import asyncio
+import csv
+import io
+import json
+import os
+import sys
+import time
+import zlib
+
+from utils.storage import HEADERS, RecordFilter
+
+# ===============================================================
+#             ВЫГРУЗКА ДАННЫХ ПАЦИЕНТОВ (CSV / JSONL)
+# ===============================================================
+#
+# Записи идут из хранилища потоком (CSV — порциями из файла, Postgres —
+# серверным курсором с фильтром в WHERE), копятся пачкой по batch_rows
+# и уходят в поток: кодирование, gzip и запись в файл не занимают event
+# loop, поэтому выгрузка не мешает живым диалогам. На выходе — куски
+# фиксированного размера chunk_size; в памяти одновременно только пачка
+# записей и один кусок, сколько бы записей ни было в хранилище.
+# Файл пишется во временный и переименовывается в конце: недописанная
+# выгрузка не выглядит готовой.
+#
+#   python -m utils.export --format jsonl --gzip --since 2026-01-01 --type OSPW,OSPT -o patients.jsonl.gz
+#   /export jsonl gz since=2026-01-01 type=OSPW season=Осень/Зима consent=yes     (админ в боте)
+
+FORMATS = ("csv", "jsonl")
+CHUNK_SIZE = 256 * 1024        # байт в куске на выходе
+BATCH_ROWS = 1000              # записей в пачке, кодируемой в потоке
+
+
+class ChunkedWriter:
+    """Текст → UTF-8 → (gzip) → куски по chunk_size в fileobj. Вызывается из потока."""
+
+    def __init__(self, fileobj, compress: bool = False, chunk_size: int = CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self._zip = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None    # 31 — формат gzip
+        self._buffer = bytearray()
+        self.raw_bytes = 0
+        self.bytes = 0
+        self.chunks = 0
+
+    def write(self, text: str):
+        data = text.encode("utf-8")
+        self.raw_bytes += len(data)
+        self._buffer += self._zip.compress(data) if self._zip is not None else data
+        while len(self._buffer) >= self.chunk_size:
+            self._emit(bytes(self._buffer[:self.chunk_size]))
+            del self._buffer[:self.chunk_size]
+
+    def close(self):
+        if self._zip is not None:
+            self._buffer += self._zip.flush()
+        if self._buffer:
+            self._emit(bytes(self._buffer))
+            self._buffer.clear()
+        self.fileobj.flush()
+
+    def _emit(self, chunk: bytes):
+        self.fileobj.write(chunk)
+        self.bytes += len(chunk)
+        self.chunks += 1
+
+
+def encode_csv(records: list, fields: list) -> str:
+    buf = io.StringIO()
+    csv.writer(buf).writerows([record.get(f, "") for f in fields] for record in records)
+    return buf.getvalue()
+
+
+def encode_jsonl(records: list, fields: list) -> str:
+    return "".join(json.dumps({f: record.get(f, "") for f in fields}, ensure_ascii=False) + "\n"
+                   for record in records)
+
+
+ENCODERS = {"csv": encode_csv, "jsonl": encode_jsonl}
+
+
+async def export(storage, fileobj, fmt: str = "csv", compress: bool = False, record_filter: RecordFilter = None,
+                 fields: list = None, chunk_size: int = CHUNK_SIZE, batch_rows: int = BATCH_ROWS) -> dict:
+    """
+    Пишет подходящие записи в fileobj (бинарный). Возвращает статистику:
+    {"rows", "bytes", "raw_bytes", "chunks", "seconds"}.
+    """
+    if fmt not in ENCODERS:
+        raise ValueError(f"Формат выгрузки: {', '.join(FORMATS)}")
+    encode = ENCODERS[fmt]
+    fields = list(fields or HEADERS)
+    writer = ChunkedWriter(fileobj, compress, chunk_size)
+
+    def flush(batch):
+        writer.write(encode(batch, fields))
+
+    started = time.perf_counter()
+    if fmt == "csv":
+        await asyncio.to_thread(flush, [dict(zip(fields, fields))])      # заголовок
+    rows = 0
+    batch = []
+    async for record in storage.iter_matching(record_filter or RecordFilter()):
+        batch.append(record)
+        if len(batch) >= batch_rows:
+            await asyncio.to_thread(flush, batch)
+            rows += len(batch)
+            batch = []
+    if batch:
+        await asyncio.to_thread(flush, batch)
+        rows += len(batch)
+    await asyncio.to_thread(writer.close)
+    return {"rows": rows, "bytes": writer.bytes, "raw_bytes": writer.raw_bytes, "chunks": writer.chunks,
+            "seconds": time.perf_counter() - started}
+
+
+async def export_to_file(storage, path: str, fmt: str = "csv", compress: bool = False,
+                         record_filter: RecordFilter = None, **kwargs) -> dict:
+    """
+    То же в файл path ("-" — stdout); обычный файл появляется под своим
+    именем только целиком, в устройство или канал пишется напрямую.
+    """
+    if path == "-":
+        return await export(storage, sys.stdout.buffer, fmt, compress, record_filter, **kwargs)
+    if os.path.exists(path) and not os.path.isfile(path):
+        with open(path, "wb") as f:
+            return await export(storage, f, fmt, compress, record_filter, **kwargs)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    f = await asyncio.to_thread(open, tmp_path, "wb")
+    try:
+        result = await export(storage, f, fmt, compress, record_filter, **kwargs)
+    except BaseException:
+        f.close()
+        os.remove(tmp_path)
+        raise
+    f.close()
+    os.replace(tmp_path, path)
+    return result
+
+
+def export_filename(fmt: str, compress: bool) -> str:
+    return f"patients-{time.strftime('%Y%m%d-%H%M%S')}.{fmt}{'.gz' if compress else ''}"
+
+
+def parse_command_args(args) -> tuple:
+    """
+    Аргументы команды /export: формат (csv|jsonl), gz и фильтры key=value —
+    since, until (ГГГГ-ММ-ДД), type (коды через запятую), season, consent.
+    Возвращает (формат, сжатие, RecordFilter); ValueError — непонятный аргумент.
+    """
+    fmt, compress = "csv", False
+    options = {"since": None, "until": None, "type": "", "season": [], "consent": None}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep:
+            if arg in FORMATS:
+                fmt = arg
+            elif arg in ("gz", "gzip"):
+                compress = True
+            else:
+                raise ValueError(f"Непонятный аргумент: {arg}")
+        elif key == "season":
+            options["season"].append(value)
+        elif key in options:
+            options[key] = value
+        else:
+            raise ValueError(f"Неизвестный фильтр: {key}")
+    record_filter = RecordFilter(since=options["since"], until=options["until"],
+                                 final_skin_types=options["type"].split(","), seasons=options["season"],
+                                 consent=options["consent"])
+    return fmt, compress, record_filter
+
+
+# ===============================================================
+#                              CLI
+# ===============================================================
+
+async def _main(args):
+    from utils.storage import create_storage
+
+    db_config = json.loads(args.db) if args.db else None
+    if args.storage == "postgres" and db_config is None:
+        from dermai_bot_v2 import DB_CONFIG
+        db_config = DB_CONFIG
+    record_filter = RecordFilter(since=args.since, until=args.until,
+                                 final_skin_types=(args.type or "").split(","), seasons=args.season or (),
+                                 consent=args.consent)
+    path = args.output or export_filename(args.format, args.gzip)
+    storage = create_storage(args.storage, db_config=db_config)
+    await storage.init()
+    try:
+        result = await export_to_file(storage, path, args.format, args.gzip, record_filter,
+                                      fields=args.fields.split(",") if args.fields else None,
+                                      chunk_size=args.chunk_size)
+    finally:
+        await storage.close()
+    print(f"📤 {path}: {result['rows']} записей, {result['bytes'] / 2**20:.1f} МБ "
+          f"({result['chunks']} кусков) за {result['seconds']:.1f} с", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Выгрузка данных пациентов в CSV / JSONL")
+    parser.add_argument("--storage", choices=["csv", "postgres"], default=os.getenv("STORAGE", "csv"))
+    parser.add_argument("--db", help="JSON с параметрами Postgres (по умолчанию DB_CONFIG из dermai_bot_v2)")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--gzip", action="store_true", help="сжать gzip")
+    parser.add_argument("--since", help="created_at с этой даты (ГГГГ-ММ-ДД, включительно)")
+    parser.add_argument("--until", help="created_at по эту дату (ГГГГ-ММ-ДД, включительно)")
+    parser.add_argument("--type", help="final_skin_type через запятую, напр. OSPW,DRNT")
+    parser.add_argument("--season", action="append", help="сезон (можно несколько раз)")
+    parser.add_argument("--consent", help="значение consent, напр. yes")
+    parser.add_argument("--fields", help="поля через запятую (по умолчанию все)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="размер куска на выходе, байт")
+    parser.add_argument("-o", "--output", help="файл (\"-\" — stdout; по умолчанию patients-<время>.<формат>)")
+    asyncio.run(_main(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import os
+
+# ===============================================================
+#          ПОВТОРНОЕ ИСПОЛЬЗОВАНИЕ file_id ОТПРАВЛЕННЫХ ФАЙЛОВ
+# ===============================================================
+#
+# После первой загрузки файла Telegram возвращает file_id, и тот же
+# файл можно отправить снова одним коротким запросом без загрузки байтов.
+# Здесь хранится соответствие «хэш содержимого → file_id»:
+#   - в памяти — dict, на диске — JSON-lines журнал [ключ, file_id]
+#     ([ключ, null] — запись удалена), который сжимается при разрастании;
+#   - file_id действует только для загрузившего его бота, поэтому ключ
+#     включает id бота;
+#   - если Telegram отверг file_id (BadRequest), запись удаляется и файл
+#     загружается заново.
+
+
+class FileIdCache:
+    def __init__(self, path: str = "file_ids.jsonl", compact_min: int = 1000):
+        self.path = path
+        self.compact_min = compact_min
+        self._ids = None                 # ключ -> file_id (загружается при первом обращении)
+        self._lines = 0
+        self._lock = asyncio.Lock()
+        # Счётчики
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.bytes_saved = 0
+
+    # -----------------------------------------------------------
+    #                     ХРАНЕНИЕ (в потоке)
+    # -----------------------------------------------------------
+
+    def _load(self):
+        ids, lines = {}, 0
+        if self.path and os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        key, file_id = json.loads(line)
+                    except ValueError:
+                        break            # недописанная строка при падении
+                    lines += 1
+                    if file_id is None:
+                        ids.pop(key, None)
+                    else:
+                        ids[key] = file_id
+        self._ids, self._lines = ids, lines
+        if lines > len(ids):
+            self._compact()              # заодно убираем оборванный хвост
+
+    def _append(self, key: str, file_id):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps([key, file_id]) + "\n")
+        self._lines += 1
+        if self._lines > max(self.compact_min, 2 * len(self._ids)):
+            self._compact()
+
+    def _compact(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for key, file_id in self._ids.items():
+                f.write(json.dumps([key, file_id]) + "\n")
+        os.replace(tmp_path, self.path)
+        self._lines = len(self._ids)
+
+    async def _ensure_loaded(self):
+        if self._ids is None:
+            async with self._lock:
+                if self._ids is None:
+                    await asyncio.to_thread(self._load)
+
+    async def _save(self, key: str, file_id):
+        if self.path:
+            async with self._lock:
+                await asyncio.to_thread(self._append, key, file_id)
+
+    # -----------------------------------------------------------
+    #                          API
+    # -----------------------------------------------------------
+
+    async def get(self, key: str):
+        await self._ensure_loaded()
+        return self._ids.get(key)
+
+    async def put(self, key: str, file_id: str):
+        await self._ensure_loaded()
+        if self._ids.get(key) != file_id:
+            self._ids[key] = file_id
+            await self._save(key, file_id)
+
+    async def invalidate(self, key: str):
+        await self._ensure_loaded()
+        if self._ids.pop(key, None) is not None:
+            self.invalidations += 1
+            await self._save(key, None)
+
+    async def send_document(self, message, key: str, get_path, **kwargs):
+        """
+        Отправляет документ в ответ на message: по сохранённому file_id, а если
+        его нет (или Telegram его отверг) — загружает файл из await get_path().
+        key — хэш содержимого; kwargs — как у Bot.send_document. Отправка идёт
+        с приоритетом BULK (см. utils/rate_limit.py).
+        """
+        from telegram.error import BadRequest
+        from utils.rate_limit import reply_document
+
+        key = f"{message.get_bot().id}:{key}"
+        file_id = await self.get(key)
+        if file_id is not None:
+            try:
+                sent = await reply_document(message, file_id, **kwargs)
+            except BadRequest as e:
+                print(f"⚠️ file_id отвергнут Telegram ({e}), загружаем файл заново")
+                await self.invalidate(key)
+            else:
+                self.hits += 1
+                if sent.document is not None and sent.document.file_size:
+                    self.bytes_saved += sent.document.file_size
+                return sent
+
+        self.misses += 1
+        path = await get_path()
+        with open(path, "rb") as f:
+            sent = await reply_document(message, f, **kwargs)
+        if sent.document is not None:
+            await self.put(key, sent.document.file_id)
+        return sent
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._ids or {}),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "invalidations": self.invalidations,
+            "bytes_saved": self.bytes_saved,
+        }
@@ -0,0 +1,315 @@
+import asyncio
+import bisect
+import json
+import time
+from collections import OrderedDict
+
+from utils.analytics import AGE_BINS, AGE_LABELS
+from utils.care import parse_allergies
+from utils.test import SKIN_DESCRIPTIONS
+
+# ===============================================================
+#        РЕКОМЕНДАЦИИ LLM: ПАКЕТЫ, КЭШ, ПОТОКОВЫЙ ВЫВОД
+# ===============================================================
+#
+# Текст рекомендаций генерирует LLM за OpenAI-совместимым API
+# (POST /v1/completions со stream=true: OpenAI, vLLM, llama.cpp server, ...).
+#   - Профиль пациента нормализуется: (тип кожи, сезон, пол, возрастная
+#     группа, исключённые аллергены, подобранные средства, заметки RAG).
+#     Промт строится только из него, поэтому ответ годится всем пациентам
+#     с тем же профилем: LRU-кэш с TTL отдаёт его без обращения к модели.
+#   - Одинаковые профили, запрошенные одновременно, ждут одну генерацию
+#     (single-flight) и получают её поток по мере поступления.
+#   - Разные профили, пришедшие в пределах batch_window, уходят одним
+#     запросом со списком промтов (микро-пакет до max_batch штук); куски
+#     ответа раскладываются по генерациям по choices[].index.
+# Потоковый текст показывается пользователю правками одного сообщения
+# не чаще раза в min_interval секунд (лишние правки ещё и склеит
+# OutboundRateLimiter).
+
+MAX_MESSAGE = 4000              # запас до лимита Telegram в 4096 символов
+
+
+def profile_key(patient: dict, routine: dict = None, notes: list = None) -> tuple:
+    """
+    Нормализованный профиль: всё, от чего зависит промт. Исключённые
+    аллергены берутся из подобранного ухода целиком (группы и отдельные
+    ингредиенты); без ухода — всё, что распознано в ответе про аллергии.
+    """
+    try:
+        age = int(patient.get("age"))
+        age_group = AGE_LABELS[bisect.bisect_right(AGE_BINS, age) - 1] if age >= 0 else ""
+    except (TypeError, ValueError):
+        age_group = ""
+    if routine is not None:
+        allergens = routine.get("excluded_allergens") or ()
+        products = tuple(tuple(p.get("id") or p["name"] for p in step["products"])
+                         for step in routine.get("steps", ()))
+    else:
+        allergens = parse_allergies(patient.get("allergies", ""))
+        products = ()
+    return (
+        str(patient.get("final_skin_type") or patient.get("skin_code") or "").upper(),
+        patient.get("time_of_year") or "",
+        patient.get("sex") or "",
+        age_group,
+        tuple(sorted(allergens)),
+        products,
+        tuple(notes or ()),
+    )
+
+
+def build_prompt(key: tuple, routine: dict = None, notes: list = None) -> str:
+    skin_type, season, sex, age_group, allergens = key[:5]
+    lines = [
+        "Ты — консультант по уходу за кожей. Пиши по-русски, кратко (до 150 слов), без диагнозов.",
+        f"Тип кожи по Бауманн: {skin_type} ({SKIN_DESCRIPTIONS.get(skin_type, 'не определён')}).",
+        f"Сезон: {season or 'не указан'}. Пол: {sex or 'не указан'}. Возраст: {age_group or 'не указан'}.",
+        f"Избегать: {', '.join(allergens) if allergens else 'ограничений нет'}.",
+    ]
+    if routine and routine.get("steps"):
+        lines.append("Подобранные средства:")
+        for step in routine["steps"]:
+            lines.append(f"- {step['title']}: " + "; ".join(p["name"] for p in step["products"]))
+    if notes:
+        lines.append("Справочные заметки:")
+        lines.extend(f"- {note}" for note in notes)
+    lines.append("Составь порядок ухода утром и вечером с этими средствами и объясни выбор.")
+    lines.append("Ответ:")
+    return "\n".join(lines)
+
+
+class _Generation:
+    """Одна генерация: её читают все, кто запросил тот же профиль."""
+    __slots__ = ("text", "done", "error", "changed")
+
+    def __init__(self):
+        self.text = ""
+        self.done = False
+        self.error = None
+        self.changed = asyncio.Condition()
+
+    async def append(self, piece: str):
+        async with self.changed:
+            self.text += piece
+            self.changed.notify_all()
+
+    async def finish(self, error: BaseException = None):
+        async with self.changed:
+            self.done = True
+            self.error = error
+            self.changed.notify_all()
+
+    async def follow(self):
+        """Снимки текста по мере генерации (последний — полный ответ)."""
+        seen = -1
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: self.done or len(self.text) != seen)
+                text, done, error = self.text, self.done, self.error
+            if error is not None:
+                raise error
+            if len(text) != seen:
+                seen = len(text)
+                yield text
+            if done:
+                return
+
+
+class LLMClient:
+    def __init__(self, base_url: str, model: str, api_key: str = None,
+                 max_batch: int = 16, batch_window: float = 0.05, max_concurrency: int = 4,
+                 max_tokens: int = 400, temperature: float = 0.3, timeout: float = 120,
+                 cache_size: int = 10_000, cache_ttl: float = 7 * 24 * 3600):
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.api_key = api_key
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._http = None
+        self._cache = OrderedDict()          # профиль -> (истекает, текст)
+        self._inflight = {}                  # профиль -> _Generation
+        self._pending = []                   # [(профиль, промт, _Generation)] до отправки пакета
+        self._has_data = asyncio.Event()
+        self._full = asyncio.Event()
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._task = None
+        self._batches = set()
+        # Счётчики
+        self.requests = 0
+        self.cache_hits = 0
+        self.joined = 0
+        self.batches = 0
+        self.batched_prompts = 0
+        self.errors = 0
+        self.generation_ms = 0.0
+
+    async def start(self):
+        import httpx
+
+        headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+        self._http = httpx.AsyncClient(base_url=self.base_url, headers=headers, timeout=self.timeout)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        tasks = [t for t in (self._task, *self._batches) if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    # -----------------------------------------------------------
+    #                          ЗАПРОС
+    # -----------------------------------------------------------
+
+    async def stream(self, patient: dict, routine: dict = None, notes: list = None):
+        """
+        Асинхронный генератор снимков текста рекомендаций для пациента.
+        routine и notes (заметки из RAG) входят в ключ кэша вместе с профилем.
+        """
+        self.requests += 1
+        key = profile_key(patient, routine, notes)
+
+        cached = self._cache.get(key)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                yield cached[1]
+                return
+            del self._cache[key]
+
+        generation = self._inflight.get(key)
+        if generation is not None:
+            self.joined += 1
+        else:
+            generation = self._inflight[key] = _Generation()
+            self._pending.append((key, build_prompt(key, routine, notes), generation))
+            self._has_data.set()
+            if len(self._pending) >= self.max_batch:
+                self._full.set()
+        async for text in generation.follow():
+            yield text
+
+    def _remember(self, key: tuple, text: str):
+        self._cache[key] = (time.monotonic() + self.cache_ttl, text)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    # -----------------------------------------------------------
+    #                          ПАКЕТЫ
+    # -----------------------------------------------------------
+
+    async def _run(self):
+        while True:
+            await self._has_data.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.batch_window)
+            except asyncio.TimeoutError:
+                pass
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            if not self._pending:
+                self._has_data.clear()
+                self._full.clear()
+            if not batch:
+                continue
+            await self._slots.acquire()
+            task = asyncio.get_running_loop().create_task(self._generate(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _generate(self, batch: list):
+        started = time.perf_counter()
+        self.batches += 1
+        self.batched_prompts += len(batch)
+        error = None
+        try:
+            body = {
+                "model": self.model,
+                "prompt": [prompt for _, prompt, _ in batch],
+                "max_tokens": self.max_tokens,
+                "temperature": self.temperature,
+                "stream": True,
+            }
+            async with self._http.stream("POST", "/v1/completions", json=body) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    for choice in json.loads(data).get("choices", ()):
+                        index = choice.get("index", 0)
+                        if 0 <= index < len(batch) and choice.get("text"):
+                            await batch[index][2].append(choice["text"])
+        except asyncio.CancelledError:
+            error = RuntimeError("Генерация прервана")
+            raise
+        except Exception as e:
+            error = e
+            self.errors += 1
+            print(f"❌ Ошибка LLM ({len(batch)} промтов): {e!r}")
+        finally:
+            self._slots.release()
+            self.generation_ms += (time.perf_counter() - started) * 1000
+            for key, _, generation in batch:
+                failure = error
+                if failure is None and not generation.text.strip():
+                    failure = RuntimeError("LLM вернула пустой ответ")
+                if failure is None:
+                    self._remember(key, generation.text)
+                if self._inflight.get(key) is generation:
+                    del self._inflight[key]
+                await generation.finish(failure)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "cache_hits": self.cache_hits,
+            "joined": self.joined,
+            "hit_rate": (self.cache_hits + self.joined) / self.requests if self.requests else 0.0,
+            "cached_profiles": len(self._cache),
+            "batches": self.batches,
+            "avg_batch": self.batched_prompts / self.batches if self.batches else 0.0,
+            "avg_generation_ms": self.generation_ms / self.batches if self.batches else 0.0,
+            "errors": self.errors,
+        }
+
+
+# ===============================================================
+#             ПОТОКОВЫЙ ВЫВОД В СООБЩЕНИЕ TELEGRAM
+# ===============================================================
+
+async def stream_to_message(message, snapshots, header: str = "", min_interval: float = 1.0) -> str:
+    """
+    Показывает растущий текст правками message не чаще раза в min_interval
+    секунд; последний снимок показывается всегда. Возвращает итоговый текст.
+    """
+    shown = message.text or ""
+    text = ""
+    last_edit = 0.0
+    async for text in snapshots:
+        now = time.monotonic()
+        if now - last_edit < min_interval:
+            continue
+        shown = await _edit(message, header + text + " ▌", shown)
+        last_edit = now
+    await _edit(message, header + text, shown)
+    return text
+
+
+async def _edit(message, text: str, shown: str) -> str:
+    text = text[:MAX_MESSAGE]
+    if text != shown:                    # одинаковый текст Telegram отвергает
+        await message.edit_text(text)
+    return text
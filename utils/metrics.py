@@ -0,0 +1,294 @@
+import asyncio
+import bisect
+import functools
+import time
+
+# ===============================================================
+#            МЕТРИКИ ГОРЯЧЕГО ПУТИ (формат Prometheus)
+# ===============================================================
+#
+# Гистограммы задержек обработчиков бота и вызовов хранилища, ожидание
+# и удержание блокировок шардов dataset_csv, ожидание соединения из пула
+# DBHandler, число диалогов по состояниям. Запись — одна bisect по
+# границам корзин и два сложения, без блокировок (всё в event loop),
+# поэтому метрики включены всегда. Наружу — текстовый формат Prometheus
+# на локальном HTTP (serve), только если задан порт:
+#
+#   METRICS_PORT=9108 python dermai_bot_v2.py
+#   curl http://127.0.0.1:9108/metrics
+
+# Границы корзин, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+WAIT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, 5.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# -----------------------------------------------------------
+#                     ТИПЫ МЕТРИК
+# -----------------------------------------------------------
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _Buckets:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)       # последняя — +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        # le в Prometheus включительно: первая граница >= value
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labels)
+        self._children = {}
+        (REGISTRY if registry is None else registry).register(self)
+
+    def labels(self, *values):
+        """Ряд метрики для значений меток (создаётся при первом обращении)."""
+        child = self._children.get(values)
+        if child is None:
+            assert len(values) == len(self.labelnames), f"{self.name}: метки {self.labelnames}"
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        return _Value()
+
+    def samples(self):
+        """(суффикс, значения меток, доп. метка, значение) для рендера."""
+        for values, child in list(self._children.items()):
+            yield "", values, "", child.value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels=(), registry=None):
+        super().__init__(name, documentation, labels, registry)
+        self._function = None
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        """
+        Значение считается при каждом сборе: function() возвращает число
+        (без меток) или {кортеж значений меток: число}.
+        """
+        self._function = function
+
+    def samples(self):
+        if self._function is None:
+            yield from super().samples()
+            return
+        try:
+            values = self._function()
+        except Exception as e:
+            print(f"⚠️ Метрика {self.name} не посчитана: {e!r}")
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            yield "", labels, "", value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labels, registry)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self):
+        bounds = self.buckets + (float("inf"),)
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, child.counts):
+                cumulative += count
+                yield "_bucket", values, f'le="{_format_value(bound)}"', cumulative
+            yield "_sum", values, "", child.sum
+            yield "_count", values, "", cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric):
+        assert metric.name not in self.metrics, f"Метрика {metric.name} уже есть"
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus 0.0.4."""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, values, extra, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(metric.labelnames, values, extra)} "
+                             f"{_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# -----------------------------------------------------------
+#                   МЕТРИКИ БОТА
+# -----------------------------------------------------------
+
+HANDLER_SECONDS = Histogram("skinbot_handler_seconds", "Время обработчика апдейта", ["handler"])
+HANDLER_ERRORS = Counter("skinbot_handler_errors_total", "Обработчики, завершившиеся исключением", ["handler"])
+STORAGE_SECONDS = Histogram("skinbot_storage_seconds", "Время вызова хранилища", ["backend", "op"])
+LOCK_WAIT_SECONDS = Histogram("skinbot_lock_wait_seconds", "Ожидание блокировки", ["lock"], WAIT_BUCKETS)
+LOCK_HOLD_SECONDS = Histogram("skinbot_lock_hold_seconds", "Удержание блокировки", ["lock"])
+POOL_WAIT_SECONDS = Histogram("skinbot_db_pool_wait_seconds", "Ожидание соединения из пула Postgres", (),
+                              WAIT_BUCKETS)
+CONVERSATIONS = Gauge("skinbot_conversations", "Незавершённые тесты по состояниям диалога", ["state"])
+SESSIONS = Gauge("skinbot_sessions", "Сессии пользователей в памяти")
+STARTUP_SECONDS = Gauge("skinbot_startup_seconds", "Длительность фаз запуска бота", ["phase"])
+STARTED_AT = Gauge("skinbot_start_time_seconds", "Время запуска процесса (unix)")
+STARTED_AT.set(time.time())
+
+
+# -----------------------------------------------------------
+#                     ИЗМЕРЕНИЕ
+# -----------------------------------------------------------
+
+def timed_handler(callback, name: str = None):
+    """Обёртка обработчика PTB: гистограмма времени и счётчик ошибок."""
+    series = HANDLER_SECONDS.labels(name or callback.__name__)
+    errors = HANDLER_ERRORS.labels(name or callback.__name__)
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            series.observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+def timed_storage(method):
+    """Обёртка метода хранилища: время по (self.name, имя метода)."""
+    op = method.__name__
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(self, *args, **kwargs)
+        finally:
+            STORAGE_SECONDS.labels(self.name, op).observe(time.perf_counter() - started)
+
+    wrapper.timed = True
+    return wrapper
+
+
+class MeteredLock(asyncio.Lock):
+    """asyncio.Lock, который пишет время ожидания и удержания."""
+
+    def __init__(self, name: str):
+        super().__init__()
+        self._wait = LOCK_WAIT_SECONDS.labels(name)
+        self._hold = LOCK_HOLD_SECONDS.labels(name)
+        self._acquired_at = 0.0
+
+    async def acquire(self):
+        started = time.perf_counter()
+        await super().acquire()
+        self._acquired_at = time.perf_counter()
+        self._wait.observe(self._acquired_at - started)
+        return True
+
+    def release(self):
+        self._hold.observe(time.perf_counter() - self._acquired_at)
+        super().release()
+
+
+# -----------------------------------------------------------
+#                        HTTP
+# -----------------------------------------------------------
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, registry: Registry):
+    try:
+        line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = line.decode(errors="replace").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/metrics", "/"):
+            status, body = "200 OK", registry.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str = "127.0.0.1", port: int = 9108, registry: Registry = None) -> asyncio.Server:
+    """HTTP-сервер /metrics в текущем event loop."""
+    registry = REGISTRY if registry is None else registry
+    server = await asyncio.start_server(lambda r, w: _handle(r, w, registry), host, port)
+    print(f"📈 Метрики на http://{host}:{port}/metrics")
+    return server
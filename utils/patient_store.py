@@ -0,0 +1,572 @@
+import csv
+import io
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+# ===============================================================
+#          APPEND-ONLY ХРАНИЛИЩЕ ПАЦИЕНТОВ С ИНДЕКСОМ
+# ===============================================================
+#
+# Файл остаётся обычным CSV с заголовком, но записи в нём никогда не
+# переписываются: каждое обновление пациента дописывает в конец полную
+# новую версию строки. В памяти держится индекс id_patient → смещение
+# последней версии записи, поэтому чтение и обновление стоят O(1).
+# Устаревшие версии копятся в файле и периодически убираются сжатием
+# (compaction), которое переписывает файл только с актуальными строками.
+#
+# Поверх индекса работает ограниченный LRU-кэш записей: put() сразу
+# кладёт новую версию в кэш (write-through), поэтому повторные чтения
+# недавно активных пациентов вообще не трогают диск.
+#
+# Если с одним файлом работают несколько процессов бота, каждая операция
+# берёт блокировку ОС на соседний файл <path>.lock и сначала дочитывает
+# в индекс чужие дозаписи (или перестраивает индекс, если другой процесс
+# сжал файл). ShardedPatientStore раскладывает пациентов по нескольким
+# таким файлам по хэшу id_patient, чтобы процессы реже ждали друг друга.
+#
+# Сжатие подменяет файл через os.replace. В Windows файл, открытый кем-то
+# ещё (читатель в другом потоке, другой процесс бота), подменить нельзя:
+# свой дескриптор закрывается перед подменой, на чужие даётся несколько
+# коротких повторов, а если файл так и не освободился — сжатие
+# откладывается до удвоения числа записей. С несколькими процессами на
+# одном файле в Windows сжатие поэтому фактически не выполняется.
+
+def _complete(chunk: bytes) -> bool:
+    """CSV-запись закончена, если кавычки в ней сбалансированы."""
+    return chunk.count(b'"') % 2 == 0
+
+
+def _read_at(f, offset: int) -> bytes:
+    """Байты записи, начинающейся со смещения offset (запись заведомо полная)."""
+    f.seek(offset)
+    chunk = b""
+    while not chunk or not _complete(chunk):
+        chunk += f.readline()
+    return chunk
+
+
+class FileLock:
+    """Эксклюзивная блокировка ОС (flock / msvcrt), повторно входимая в потоке."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+        self._depth = 0
+
+    def __enter__(self):
+        if self._depth == 0:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                while True:
+                    try:
+                        msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:  # LK_LOCK сдаётся через ~10 секунд
+                        continue
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+
+    @property
+    def held(self) -> bool:
+        return self._depth > 0
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class PatientStore:
+    def __init__(self, path: str, headers: list, cache_size: int = 10_000,
+                 interprocess: bool = True):
+        self.path = path
+        self.headers = list(headers)
+        self.index = {}          # id_patient -> смещение последней версии
+        self.records_total = 0   # всего записей в файле (включая устаревшие)
+        self.end = 0             # смещение конца последней полной записи
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._mutex = threading.RLock()
+        self._flock = FileLock(path + ".lock") if interprocess else None
+        self._fh = None
+        self._compact_after = 0  # records_total, до которого сжатие отложено (файл не удалось подменить)
+        with self._guard(refresh=False):
+            self._open()
+
+    @contextmanager
+    def _guard(self, refresh: bool = True):
+        """Мьютекс потоков + (при нескольких процессах) блокировка файла."""
+        with self._mutex:
+            if self._flock is None:
+                yield
+                return
+            first = not self._flock.held
+            with self._flock:
+                if first and refresh:
+                    self._refresh()
+                yield
+
+    def locked(self):
+        """Несколько операций подряд атомарно (в т.ч. относительно других процессов)."""
+        return self._guard()
+
+    def _inode(self) -> int:
+        return os.fstat(self._fh.fileno()).st_ino
+
+    def _refresh(self):
+        """Подтягивает изменения, сделанные другими процессами."""
+        st = os.stat(self.path)
+        if st.st_ino != self._inode():
+            # Другой процесс сжал файл — смещения устарели целиком
+            self._fh.close()
+            self._cache.clear()
+            self._open()
+        elif st.st_size > self.end:
+            self._scan(self.end)
+
+    def _is_fresh(self) -> bool:
+        """Дешёвая проверка без блокировки: файл не меняли другие процессы."""
+        if self._flock is None:
+            return True
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return st.st_size == self.end and st.st_ino == self._inode()
+
+    # -----------------------------------------------------------
+    #                 ОТКРЫТИЕ И ПОСТРОЕНИЕ ИНДЕКСА
+    # -----------------------------------------------------------
+
+    def _open(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            with open(self.path, "wb") as f:
+                f.write(self._encode(self.headers))
+
+        self._fh = open(self.path, "a+b")
+        self._fh.seek(0)
+        header_raw = self._read_record()
+        file_headers = self._decode(header_raw) if header_raw else []
+        self.index.clear()
+        self.records_total = 0
+        self.end = self._fh.tell()
+        self._scan(self.end)
+
+        # Заголовок на диске отличается от текущего — переписываем файл
+        # в новом формате (старые колонки переносятся по имени).
+        if file_headers != self.headers:
+            self._rewrite(file_headers)
+
+    def _scan(self, start: int):
+        """Индексирует полные записи начиная со смещения start."""
+        self._fh.seek(start)
+        offset = start
+        while True:
+            raw = self._read_record()
+            if raw is None:
+                break
+            row = self._decode(raw)
+            if row and row[0]:
+                self.index[row[0]] = offset
+                self.records_total += 1
+                self._cache.pop(row[0], None)
+            offset += len(raw)
+        self.end = offset
+
+    def _read_record(self):
+        """
+        Читает одну полную CSV-запись с текущей позиции.
+        Возвращает байты записи или None, если дальше нет полной записи
+        (например, хвост, оборванный при падении процесса).
+        """
+        chunk = b""
+        while True:
+            line = self._fh.readline()
+            if not line:
+                return None
+            chunk += line
+            if _complete(chunk):
+                return chunk if chunk.endswith(b"\n") else None
+
+    # -----------------------------------------------------------
+    #                       КОДИРОВАНИЕ СТРОК
+    # -----------------------------------------------------------
+
+    @staticmethod
+    def _encode(values) -> bytes:
+        buf = io.StringIO()
+        csv.writer(buf).writerow(values)
+        return buf.getvalue().encode("utf-8")
+
+    @staticmethod
+    def _decode(raw: bytes) -> list:
+        return next(csv.reader(io.StringIO(raw.decode("utf-8"))), [])
+
+    def _row_to_record(self, row: list, headers=None) -> dict:
+        headers = headers or self.headers
+        record = dict.fromkeys(self.headers, "")
+        record.update({k: v for k, v in zip(headers, row) if k in record})
+        return record
+
+    # -----------------------------------------------------------
+    #                       ЧТЕНИЕ / ЗАПИСЬ
+    # -----------------------------------------------------------
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, id_patient):
+        with self._guard():
+            return id_patient in self.index
+
+    def cached(self, id_patient: str, wait: bool = True):
+        """
+        Запись из кэша (копия) или None — без обращения к диску.
+        wait=False — для event loop: не ждать мьютекс (его может держать
+        поток, стоящий на блокировке файла) и не вызывать os.stat; если
+        нельзя ответить сразу — None, читать через get() в потоке.
+        """
+        if not wait and self._flock is not None:
+            return None                  # свежесть кэша проверяется только по файлу
+        if not self._mutex.acquire(blocking=wait):
+            return None
+        try:
+            if not (self._flock is not None and self._flock.held) and not self._is_fresh():
+                return None
+            record = self._cache.get(id_patient)
+            if record is None:
+                return None
+            self._cache.move_to_end(id_patient)
+            return dict(record)
+        finally:
+            self._mutex.release()
+
+    def _remember(self, record: dict):
+        if self.cache_size <= 0:
+            return
+        self._cache[record["id_patient"]] = record
+        self._cache.move_to_end(record["id_patient"])
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def get(self, id_patient: str):
+        """Возвращает актуальную запись пациента (dict) или None."""
+        with self._guard():
+            record = self.cached(id_patient)
+            if record is not None:
+                return record
+            offset = self.index.get(id_patient)
+            if offset is None:
+                return None
+            self._fh.seek(offset)
+            record = self._row_to_record(self._decode(self._read_record()))
+            self._remember(record)
+            return dict(record)
+
+    def put(self, record: dict):
+        """Дописывает новую версию записи в конец файла."""
+        with self._guard():
+            raw = self._encode([record.get(h, "") for h in self.headers])
+            self._fh.seek(0, os.SEEK_END)
+            if self._fh.tell() != self.end:
+                # Оборванный хвост после падения — отрезаем его
+                self._fh.truncate(self.end)
+            self._fh.write(raw)
+            self._fh.flush()
+            self._remember({h: str(record.get(h, "")) for h in self.headers})
+            self.index[record["id_patient"]] = self.end
+            self.records_total += 1
+            self.end += len(raw)
+
+    def update(self, id_patient: str, mutate):
+        """
+        Атомарное чтение-изменение-запись одной записи.
+        mutate(record) изменяет словарь на месте; если пациента нет,
+        передаётся пустая запись с заполненным id_patient.
+        """
+        with self._guard():
+            record = self.get(id_patient)
+            if record is None:
+                record = dict.fromkeys(self.headers, "")
+                record["id_patient"] = id_patient
+            mutate(record)
+            self.put(record)
+            return record
+
+    def iter_records(self):
+        """Итератор по актуальным записям (в порядке файла)."""
+        # Файл открывается под мьютексом: даже если сжатие подменит его,
+        # дескриптор продолжит указывать на версию, к которой относятся смещения.
+        with self._guard():
+            offsets = sorted(self.index.values())
+            f = open(self.path, "rb")
+        with f:
+            for offset in offsets:
+                yield self._row_to_record(self._decode(_read_at(f, offset)))
+
+    def changes_since(self, token=None):
+        """
+        Записи, изменённые после token, для инкрементального обновления
+        аналитики: (список записей, новый token). token — (inode, конец файла);
+        None или устаревший token (файл сжат) — вернуть все записи.
+        Для изменений читается только хвост файла, дописанный после token.
+        """
+        with self._guard():
+            ino, end = self._inode(), self.end
+            full = token is None or token[0] != ino or token[1] > end
+            offsets = sorted(self.index.values()) if full else None
+            f = open(self.path, "rb")
+        with f:
+            if full:
+                records = [self._row_to_record(self._decode(_read_at(f, o))) for o in offsets]
+            else:
+                f.seek(token[1])
+                tail = f.read(end - token[1])
+                changed = {}
+                for row in csv.reader(io.StringIO(tail.decode("utf-8"))):
+                    if row and row[0]:
+                        changed[row[0]] = self._row_to_record(row)
+                records = list(changed.values())
+        return records, (ino, end)
+
+    # -----------------------------------------------------------
+    #                           СЖАТИЕ
+    # -----------------------------------------------------------
+
+    @property
+    def garbage(self) -> int:
+        """Количество устаревших версий записей в файле."""
+        return self.records_total - len(self.index)
+
+    def needs_compaction(self, min_garbage: int = 1000, ratio: float = 0.5) -> bool:
+        return (self.garbage >= min_garbage and self.garbage >= ratio * self.records_total
+                and self.records_total >= self._compact_after)
+
+    def snapshot(self):
+        """
+        Снимок для сжатия: (копия индекса, конец файла, открытый файл).
+        Файл открывается под блокировкой, поэтому это ровно та версия,
+        к которой относятся смещения индекса.
+        """
+        with self._guard():
+            return dict(self.index), self.end, open(self.path, "rb")
+
+
+    def write_compacted(self, snapshot) -> tuple:
+        """
+        Пишет во временный файл только актуальные записи из снимка.
+        Не держит блокировок: старые смещения в append-only файле неизменны,
+        поэтому параллельные дозаписи этому шагу не мешают.
+        Возвращает (путь к временному файлу, (inode исходного файла, новый индекс)).
+        """
+        index, _, src = snapshot
+        snap_ino = os.fstat(src.fileno()).st_ino
+        tmp_path = f"{self.path}.compact.{os.getpid()}"
+        new_index = {}
+        with src, open(tmp_path, "wb") as dst:
+            dst.write(self._encode(self.headers))
+            for id_patient, offset in sorted(index.items(), key=lambda kv: kv[1]):
+                chunk = _read_at(src, offset)
+                new_index[id_patient] = dst.tell()
+                dst.write(chunk)
+        return tmp_path, (snap_ino, new_index)
+
+    def commit_compacted(self, snapshot, tmp_path: str, compacted: tuple):
+        """
+        Дописывает в сжатый файл записи, появившиеся после снимка,
+        и атомарно подменяет им основной файл.
+        """
+        _, snap_end, _ = snapshot
+        snap_ino, new_index = compacted
+        with self._guard():
+            if self._inode() != snap_ino:
+                # Пока мы писали копию, файл уже сжал другой процесс
+                os.remove(tmp_path)
+                return
+            with open(tmp_path, "ab") as dst:
+                base = dst.tell()
+                self._fh.seek(snap_end)
+                tail = self._fh.read(self.end - snap_end)
+                dst.write(tail)
+                dst.flush()
+                os.fsync(dst.fileno())
+
+            if not self._swap(tmp_path):
+                os.remove(tmp_path)
+                self._compact_after = 2 * self.records_total
+                print(f"⚠️ {self.path}: файл открыт в другом месте, сжатие отложено")
+                return
+            self.index = new_index
+            self.records_total = len(new_index)
+            self._compact_after = 0
+            self._scan(base)
+
+    def _swap(self, tmp_path: str, attempts: int = 5) -> bool:
+        """
+        Подменяет основной файл временным (под _guard). Свой дескриптор
+        закрывается на время подмены (иначе Windows её не даст) и открывается
+        заново — на новый файл или, если подменить не удалось, на старый.
+        """
+        self._fh.close()
+        try:
+            for attempt in range(attempts):
+                try:
+                    os.replace(tmp_path, self.path)
+                    return True
+                except PermissionError:  # Windows: файл открыт читателем или другим процессом
+                    if os.name != "nt":
+                        raise
+                    time.sleep(0.05 * (attempt + 1))
+            return False
+        finally:
+            self._fh = open(self.path, "a+b")
+
+    def compact(self):
+        """Синхронное сжатие целиком (снимок, перезапись, подмена)."""
+        snap = self.snapshot()
+        tmp_path, compacted = self.write_compacted(snap)
+        self.commit_compacted(snap, tmp_path, compacted)
+
+    def _rewrite(self, file_headers: list):
+        """Миграция файла на актуальный заголовок."""
+        with self._guard(refresh=False):
+            tmp_path = f"{self.path}.compact.{os.getpid()}"
+            offsets = sorted(self.index.values())
+            new_index = {}
+            with open(tmp_path, "wb") as dst:
+                dst.write(self._encode(self.headers))
+                for offset in offsets:
+                    self._fh.seek(offset)
+                    record = self._row_to_record(self._decode(self._read_record()), file_headers)
+                    new_index[record["id_patient"]] = dst.tell()
+                    dst.write(self._encode([record[h] for h in self.headers]))
+                end = dst.tell()
+            if not self._swap(tmp_path):
+                os.remove(tmp_path)
+                raise PermissionError(f"{self.path}: файл открыт другим процессом, миграция заголовка невозможна")
+            self.index = new_index
+            self.records_total = len(new_index)
+            self.end = end
+
+    def close(self):
+        with self._mutex:
+            if self._fh:
+                self._fh.close()
+                self._fh = None
+            if self._flock is not None:
+                self._flock.close()
+
+
+# ===============================================================
+#                   ШАРДИРОВАНИЕ ПО id_patient
+# ===============================================================
+
+def shard_index(id_patient: str, shards: int) -> int:
+    """Стабильный между процессами и перезапусками номер шарда."""
+    return zlib.crc32(id_patient.encode("utf-8")) % shards
+
+
+class ShardedPatientStore:
+    """
+    Набор PatientStore по файлам <name>.<i>.csv (при shards=1 — сам path).
+    У каждого шарда своя блокировка, поэтому процессы и потоки,
+    работающие с разными пациентами, почти не мешают друг другу.
+    """
+
+    def __init__(self, path: str, headers: list, shards: int = 1, cache_size: int = 10_000,
+                 interprocess: bool = True):
+        self.path = path
+        self.headers = list(headers)
+        if shards == 1:
+            paths = [path]
+        else:
+            root, ext = os.path.splitext(path)
+            paths = [f"{root}.{i}{ext}" for i in range(shards)]
+            self._migrate_legacy(paths, interprocess)
+        per_shard_cache = max(cache_size // shards, 0)
+        self.shards = [PatientStore(p, headers, per_shard_cache, interprocess) for p in paths]
+
+    def _migrate_legacy(self, paths: list, interprocess: bool):
+        """Один раз раскладывает старый единый файл по шардам."""
+        if not os.path.exists(self.path):
+            return
+        lock = FileLock(self.path + ".lock")
+        try:
+            with lock:
+                if not os.path.exists(self.path) or any(os.path.exists(p) for p in paths):
+                    return
+                legacy = PatientStore(self.path, self.headers, cache_size=0, interprocess=False)
+                shards = [PatientStore(p, self.headers, cache_size=0, interprocess=interprocess)
+                          for p in paths]
+                for record in legacy.iter_records():
+                    shards[shard_index(record["id_patient"], len(shards))].put(record)
+                legacy.close()
+                for shard in shards:
+                    shard.close()
+                os.replace(self.path, self.path + ".migrated")
+                print(f"📦 {self.path} разложен по {len(paths)} шардам")
+        finally:
+            lock.close()
+
+    def shard_for(self, id_patient: str) -> PatientStore:
+        return self.shards[shard_index(id_patient, len(self.shards))]
+
+    def __len__(self):
+        return sum(len(s) for s in self.shards)
+
+    def __contains__(self, id_patient):
+        return id_patient in self.shard_for(id_patient)
+
+    def cached(self, id_patient: str, wait: bool = True):
+        return self.shard_for(id_patient).cached(id_patient, wait)
+
+    def get(self, id_patient: str):
+        return self.shard_for(id_patient).get(id_patient)
+
+    def put(self, record: dict):
+        self.shard_for(record["id_patient"]).put(record)
+
+    def update(self, id_patient: str, mutate):
+        return self.shard_for(id_patient).update(id_patient, mutate)
+
+    def iter_records(self):
+        for shard in self.shards:
+            yield from shard.iter_records()
+
+    def changes_since(self, token=None):
+        """То же, что PatientStore.changes_since; token — список по шардам."""
+        token = token or [None] * len(self.shards)
+        records, new_token = [], []
+        for shard, shard_token in zip(self.shards, token):
+            changed, t = shard.changes_since(shard_token)
+            records.extend(changed)
+            new_token.append(t)
+        return records, new_token
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
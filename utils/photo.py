@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import importlib
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
+
+from utils.photo_cache import PhotoCache
+
+# ===============================================================
+#          АНАЛИЗ ФОТО ДЕРМАТОСКОПА (ПУЛ ПРОЦЕССОВ)
+# ===============================================================
+#
+# Фото скачивается в память, а декодирование и классификация (чистый
+# CPU) идут в ProcessPoolExecutor, чтобы не держать event loop и GIL.
+# Перед пулом стоит ограниченная очередь заданий: если она заполнена,
+# новое фото ждёт места не дольше max_wait секунд, потом — PipelineBusy.
+# Классификатор подключается строкой "модуль:Класс" и создаётся один
+# раз в каждом процессе пула (модель грузится однажды, а не на каждое фото).
+# Перед очередью стоит PhotoCache: повтор того же файла отвечается сразу,
+# а почти такое же фото — после дешёвого dHash, без классификации.
+
+if TYPE_CHECKING:
+    import numpy as np
+
+MAX_SIDE = 512                 # до такого размера уменьшаем фото перед анализом
+
+
+class PipelineBusy(Exception):
+    """Очередь анализа переполнена."""
+
+
+class SkinClassifier:
+    """
+    Интерфейс классификатора: classify(image) → {"code": "OSPW", "confidence": 0..1}.
+    image — массив H × W × 3 (uint8, RGB).
+    """
+    name = "base"
+
+    def classify(self, image: np.ndarray) -> dict:
+        raise NotImplementedError
+
+
+class StubClassifier(SkinClassifier):
+    """
+    Детерминированная заглушка вместо модели: простые признаки изображения
+    по каждой оси Бауманн. Одно и то же фото всегда даёт один и тот же код.
+      O/D — доля бликов (жирная кожа блестит);
+      S/R — покраснение (R относительно G);
+      P/N — неравномерность яркости (пигментные пятна);
+      W/T — плотность перепадов яркости (морщины, рельеф).
+    """
+    name = "stub"
+
+    def classify(self, image: np.ndarray) -> dict:
+        import numpy as np
+
+        rgb = image.astype(np.float32)
+        luma = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+        shine = float((luma > 220).mean())
+        redness = float((rgb[..., 0] - rgb[..., 1]).mean()) / 255
+        unevenness = float(luma.std()) / 255
+        edges = float(np.abs(np.diff(luma, axis=0)).mean() + np.abs(np.diff(luma, axis=1)).mean()) / 255
+
+        # (признак, порог, буква «выше порога», буква «ниже»)
+        axes = [(shine, 0.02, "O", "D"), (redness, 0.12, "S", "R"),
+                (unevenness, 0.15, "P", "N"), (edges, 0.04, "W", "T")]
+        code = "".join(hi if value > threshold else lo for value, threshold, hi, lo in axes)
+        # Уверенность — насколько признаки далеки от порогов (0.5..1)
+        margins = [min(abs(value - threshold) / threshold, 1.0) for value, threshold, _, _ in axes]
+        return {"code": code, "confidence": round(0.5 + 0.5 * sum(margins) / len(margins), 3)}
+
+
+# ===============================================================
+#                   РАБОТА ВНУТРИ ПРОЦЕССА ПУЛА
+# ===============================================================
+
+_classifier = None
+
+
+def load_classifier(spec: str) -> SkinClassifier:
+    """spec: "модуль:Класс", например "utils.photo:StubClassifier"."""
+    module_name, _, class_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def _init_worker(spec: str):
+    global _classifier
+    _classifier = load_classifier(spec)
+
+
+def decode_image(data: bytes, max_side: int = MAX_SIDE) -> np.ndarray:
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as img:
+        # JPEG декодируется сразу в уменьшенном масштабе — в разы быстрее
+        img.draft("RGB", (max_side, max_side))
+        img = img.convert("RGB")
+        img.thumbnail((max_side, max_side))
+        return np.asarray(img)
+
+
+def fingerprint(data: bytes) -> int:
+    """
+    dHash: 64 бита «соседний пиксель справа темнее» на картинке 9 × 8 в оттенках
+    серого. Не меняется при пересжатии и масштабировании фото.
+    """
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as img:
+        img.draft("L", (64, 64))
+        small = np.asarray(img.convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def analyze(data: bytes) -> dict:
+    started = time.perf_counter()
+    image = decode_image(data)
+    result = _classifier.classify(image)
+    result["classifier"] = _classifier.name
+    result["analysis_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+
+# ===============================================================
+#                 ОЧЕРЕДЬ ЗАДАНИЙ В EVENT LOOP
+# ===============================================================
+
+class PhotoPipeline:
+    def __init__(self, classifier: str = "utils.photo:StubClassifier", workers: int = None,
+                 queue_size: int = 64, max_wait: float = 30, cache: PhotoCache = None):
+        self.classifier = classifier
+        self.cache = cache if cache is not None else PhotoCache(classifier)
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.executor = None
+        self._queue = None
+        self._tasks = []
+        self._notifications = set()     # фоновые сообщения о прогрессе
+        self.in_progress = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_ms = 0.0
+
+    def start(self):
+        if self.executor is not None:
+            return
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_init_worker, initargs=(self.classifier,)
+        )
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self):
+        for task in (*self._tasks, *self._notifications):
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._notifications, return_exceptions=True)
+        self._tasks = []
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        self.cache.close()
+
+    async def analyze(self, data: bytes, progress=None) -> dict:
+        """
+        Ставит фото в очередь и ждёт результата.
+        progress(stage, position) — корутина для сообщений пользователю:
+        stage = "queued" (position — место в очереди) | "analyzing".
+        У результата из кэша есть поле cached: "exact" | "similar".
+        """
+        sha = await asyncio.to_thread(_sha256, data) if len(data) > 1 << 20 else _sha256(data)
+        cached = await self.cache.get_exact(sha)
+        if cached is not None:
+            return cached
+
+        future = asyncio.get_running_loop().create_future()
+        job = (data, sha, future, progress)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            await _notify(progress, "queued", self._queue.qsize() + 1)
+            try:
+                await asyncio.wait_for(self._queue.put(job), self.max_wait)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise PipelineBusy(f"В очереди {self._queue.qsize()} фото") from None
+        else:
+            if self.in_progress >= self.workers:
+                await _notify(progress, "queued", self._queue.qsize())
+        return await future
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            data, sha, future, progress = await self._queue.get()
+            if future.cancelled():                   # пользователь уже не ждёт
+                continue
+            self.in_progress += 1
+            started = time.perf_counter()
+            try:
+                dhash = await loop.run_in_executor(self.executor, fingerprint, data)
+                result = await self.cache.get_similar(sha, dhash)
+                if result is None:
+                    # Правка сообщения идёт через лимитер Telegram — не держим ради неё слот пула
+                    self._notify_later(future, progress, "analyzing", 0)
+                    result = await loop.run_in_executor(self.executor, analyze, data)
+                    await self.cache.put(sha, dhash, result)
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.processed += 1
+                self.total_ms += (time.perf_counter() - started) * 1000
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.in_progress -= 1
+
+    def _notify_later(self, future, progress, stage: str, position: int):
+        if progress is None:
+            return
+
+        async def notify():
+            # Результат уже готов — «анализ…» поверх него не показываем
+            if not future.done():
+                await _notify(progress, stage, position)
+
+        task = asyncio.get_running_loop().create_task(notify())
+        self._notifications.add(task)
+        task.add_done_callback(self._notifications.discard)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "in_progress": self.in_progress,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_ms": self.total_ms / self.processed if self.processed else 0.0,
+        }
+
+
+async def _notify(progress, stage: str, position: int):
+    # Сообщение о прогрессе не должно ломать сам анализ
+    if progress is None:
+        return
+    try:
+        await progress(stage, position)
+    except Exception as e:
+        print(f"⚠️ Не удалось показать прогресс анализа: {e!r}")
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
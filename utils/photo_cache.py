@@ -0,0 +1,225 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+# ===============================================================
+#             КЭШ РЕЗУЛЬТАТОВ АНАЛИЗА ФОТО
+# ===============================================================
+#
+# Пользователи часто присылают то же самое фото повторно (или его
+# пересжатую/обрезанную телеграмом копию). Результат анализа кэшируется
+# по двум ключам:
+#   - sha256 байтов файла — точное совпадение, проверяется до очереди,
+#     без декодирования;
+#   - dHash (64-битный перцептивный хэш) декодированного изображения —
+#     почти одинаковые фото: совпадение, если различаются не больше
+#     max_distance бит. Для поиска хэш режется на полосы, и кандидаты
+#     ищутся по совпадению хотя бы одной полосы (если бит различается
+#     не больше, чем полос минус один, одна полоса точно совпадёт).
+# Память — LRU на max_entries записей; необязательный второй уровень —
+# SQLite-файл (переживает перезапуск, размер ограничен max_disk_entries;
+# там перцептивный хэш ищется только точным совпадением).
+# Ключи привязаны к классификатору: смена модели не отдаёт старые ответы.
+
+BANDS = 5                      # полосы по 13/13/13/13/12 бит
+BAND_BITS = 13
+
+
+def _bands(dhash: int):
+    for i in range(BANDS):
+        yield i, (dhash >> (i * BAND_BITS)) & ((1 << BAND_BITS) - 1)
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class PhotoCache:
+    def __init__(self, classifier: str, max_entries: int = 10_000, max_distance: int = 4,
+                 path: str = None, max_disk_entries: int = 200_000):
+        assert max_distance < BANDS, "при таком расстоянии полосы не гарантируют находку"
+        self.classifier = classifier
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()    # sha256 -> (dhash, результат)
+        self._bands = {}                 # (номер полосы, значение) -> {sha256}
+        self._db = None
+        self._disk_count = 0
+        self._db_lock = asyncio.Lock()
+        # Счётчики
+        self.hits_exact = 0
+        self.hits_similar = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.saved_ms = 0.0              # сэкономленное время анализа
+
+    # -----------------------------------------------------------
+    #                          ПАМЯТЬ
+    # -----------------------------------------------------------
+
+    def _get(self, sha: str):
+        entry = self._entries.get(sha)
+        if entry is not None:
+            self._entries.move_to_end(sha)
+        return entry
+
+    def _put(self, sha: str, dhash, result: dict):
+        if sha in self._entries:
+            self._entries.move_to_end(sha)
+            return
+        self._entries[sha] = (dhash, result)
+        if dhash is not None:
+            for band in _bands(dhash):
+                self._bands.setdefault(band, set()).add(sha)
+        while len(self._entries) > self.max_entries:
+            old_sha, (old_dhash, _) = self._entries.popitem(last=False)
+            if old_dhash is not None:
+                for band in _bands(old_dhash):
+                    shas = self._bands.get(band)
+                    if shas is not None:
+                        shas.discard(old_sha)
+                        if not shas:
+                            del self._bands[band]
+
+    def _similar(self, dhash: int):
+        best, best_distance = None, self.max_distance + 1
+        for band in _bands(dhash):
+            for sha in self._bands.get(band, ()):
+                distance = hamming(dhash, self._entries[sha][0])
+                if distance < best_distance:
+                    best, best_distance = sha, distance
+        return best
+
+    # -----------------------------------------------------------
+    #                  ПОИСК И ЗАПИСЬ (async)
+    # -----------------------------------------------------------
+
+    async def get_exact(self, sha: str):
+        """Результат по sha256 файла или None."""
+        entry = self._get(sha)
+        if entry is None and self.path:
+            entry = await self._disk_get("sha", sha)
+            if entry is not None:
+                self.hits_disk += 1
+                self._put(sha, *entry)
+        if entry is None:
+            return None
+        self.hits_exact += 1
+        return self._hit(entry[1], "exact")
+
+    async def get_similar(self, sha: str, dhash: int):
+        """Результат для почти такого же фото или None (тогда считается промахом)."""
+        similar = self._similar(dhash)
+        if similar is not None:
+            result = self._get(similar)[1]
+        elif self.path:
+            entry = await self._disk_get("dhash", dhash)
+            result = entry[1] if entry is not None else None
+            if result is not None:
+                self.hits_disk += 1
+        else:
+            result = None
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits_similar += 1
+        await self.put(sha, dhash, result)       # следующий раз — сразу по sha256
+        return self._hit(result, "similar")
+
+    async def put(self, sha: str, dhash: int, result: dict):
+        result = {k: v for k, v in result.items() if k != "cached"}
+        self._put(sha, dhash, result)
+        if self.path:
+            await self._disk_put(sha, dhash, result)
+
+    def _hit(self, result: dict, kind: str) -> dict:
+        self.saved_ms += result.get("analysis_ms", 0.0)
+        return {**result, "cached": kind}
+
+    # -----------------------------------------------------------
+    #                  ДИСК (SQLite, в потоке)
+    # -----------------------------------------------------------
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS photo_cache ("
+                " sha TEXT, classifier TEXT, dhash INTEGER, result TEXT, used REAL,"
+                " PRIMARY KEY (sha, classifier))"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS photo_cache_dhash ON photo_cache (dhash, classifier)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS photo_cache_used ON photo_cache (used)")
+            self._disk_count = self._db.execute("SELECT count(*) FROM photo_cache").fetchone()[0]
+        return self._db
+
+    async def _disk_get(self, column: str, value):
+        def get():
+            db = self._connect()
+            row = db.execute(
+                f"SELECT sha, dhash, result FROM photo_cache WHERE {column} = ? AND classifier = ? LIMIT 1",
+                (_to_sql(value) if column == "dhash" else value, self.classifier)
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE photo_cache SET used = ? WHERE sha = ? AND classifier = ?",
+                       (time.time(), row[0], self.classifier))
+            db.commit()
+            return _from_sql(row[1]), json.loads(row[2])
+
+        async with self._db_lock:
+            return await asyncio.to_thread(get)
+
+    async def _disk_put(self, sha: str, dhash: int, result: dict):
+        def put():
+            db = self._connect()
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO photo_cache VALUES (?, ?, ?, ?, ?)",
+                (sha, self.classifier, _to_sql(dhash), json.dumps(result), time.time())
+            )
+            self._disk_count += cursor.rowcount
+            # Сверх лимита — выкидываем давно не использованные (пачкой по 1000)
+            if self._disk_count > self.max_disk_entries:
+                cursor = db.execute(
+                    "DELETE FROM photo_cache WHERE rowid IN "
+                    "(SELECT rowid FROM photo_cache ORDER BY used LIMIT ?)",
+                    (self._disk_count - self.max_disk_entries + 1000,)
+                )
+                self._disk_count -= cursor.rowcount
+            db.commit()
+
+        async with self._db_lock:
+            await asyncio.to_thread(put)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def stats(self) -> dict:
+        hits = self.hits_exact + self.hits_similar
+        total = hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits_exact": self.hits_exact,
+            "hits_similar": self.hits_similar,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+            "saved_ms": self.saved_ms,
+            "disk": bool(self.path) and os.path.exists(self.path),
+        }
+
+
+# SQLite INTEGER — знаковый 64-битный, dHash — беззнаковый
+def _to_sql(dhash):
+    return dhash - (1 << 64) if dhash is not None and dhash >= 1 << 63 else dhash
+
+
+def _from_sql(value):
+    return value + (1 << 64) if value is not None and value < 0 else value
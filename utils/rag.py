@@ -0,0 +1,244 @@
+import hashlib
+import json
+import os
+import re
+import time
+import zlib
+
+import numpy as np
+
+from utils.care import STEPS, pattern_codes
+from utils.test import MEDICAL_NOTES, SKIN_CODES, SKIN_DESCRIPTIONS
+
+# ===============================================================
+#        ВЕКТОРНЫЙ ПОИСК ПО ЗАМЕТКАМ ДЛЯ LLM (RAG)
+# ===============================================================
+#
+# Корпус (медицинские заметки, заметки по уходу, каталог средств)
+# превращается в векторы хэширующим эмбеддером: слова и их символьные
+# триграммы (устойчивость к окончаниям) раскладываются по dim корзинам
+# через crc32. Модель не нужна, результат одинаков в любом процессе.
+# Векторы квантуются в int8 (масштаб на строку) и сохраняются в .npy,
+# которые при следующем старте открываются через mmap: в памяти процесса
+# только то, что читает поиск. Индекс пересобирается, если изменился корпус.
+# Поиск — пакетом запросов, по блокам строк (память на запрос не зависит
+# от размера корпуса), с фильтрами по коду Бауманн и сезону (битовые маски).
+
+INDEX_VERSION = 1
+SEASON_BITS = {"Осень/Зима": 1, "Весна/Лето": 2}
+ALL_SEASONS = 3
+ALL_CODES = (1 << len(SKIN_CODES)) - 1
+BLOCK_ROWS = 65_536
+
+_WORD = re.compile(r"[a-zа-яё0-9]+")
+
+# К каким типам кожи относятся заметки из utils/test.py
+MEDICAL_NOTE_SKIN = {
+    "atopic_dermatitis": "*S**", "eczema": "*S**", "contact_dermatitis": "*S**",
+    "rosacea": "*S**", "couperose": "*S**", "melasma": "**P*",
+}
+
+
+def skin_mask(pattern: str) -> int:
+    """Битовая маска кодов SKIN_CODES, подходящих под шаблон "O*S*"."""
+    wanted = pattern_codes(pattern)
+    mask = 0
+    for i, code in enumerate(SKIN_CODES):
+        if all(w == 0 or w == c for w, c in zip(wanted, pattern_codes(code))):
+            mask |= 1 << i
+    return mask
+
+
+def season_mask(seasons) -> int:
+    return sum(SEASON_BITS.get(s, 0) for s in set(seasons or ())) or ALL_SEASONS
+
+
+class HashingEmbedder:
+    def __init__(self, dim: int = 256):
+        assert dim & (dim - 1) == 0, "dim должен быть степенью двойки"
+        self.dim = dim
+
+    def features(self, text: str):
+        for word in _WORD.findall(text.lower()):
+            if len(word) < 2:
+                continue
+            yield word
+            padded = f"#{word}#"
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3]
+
+    def embed(self, texts: list) -> np.ndarray:
+        """float32 N × dim, строки нормированы (скалярное произведение = косинус)."""
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self.features(text):
+                h = zlib.crc32(feature.encode())
+                out[row, h & (self.dim - 1)] += 1.0 if h & 0x80000000 else -1.0
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        return out / np.maximum(norms, 1e-9)
+
+
+def quantize(vectors: np.ndarray) -> tuple:
+    """int8-векторы и масштаб на строку: vector ≈ q * scale."""
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    q = np.round(vectors / scales[:, None]).astype(np.int8)
+    return q, scales.astype(np.float32)
+
+
+def care_corpus(catalog_path: str = None, knowledge_path: str = None) -> list:
+    """Документы: {"text", "skin", "seasons", "source"} из заметок и каталога."""
+    docs = [{"text": text, "skin": MEDICAL_NOTE_SKIN.get(name, "****"), "seasons": [], "source": name}
+            for name, text in MEDICAL_NOTES.items()]
+    for path, kind in ((knowledge_path, "knowledge"), (catalog_path, "catalog")):
+        if not path or not os.path.exists(path):
+            continue
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                if kind == "catalog":
+                    text = (f"{STEPS.get(item.get('step'), item.get('step', ''))}: {item['name']}. "
+                            f"Состав: {', '.join(item.get('ingredients', ()))}")
+                else:
+                    text = item["text"]
+                docs.append({"text": text, "skin": item.get("skin", "****"),
+                             "seasons": item.get("seasons", []), "source": item.get("id", kind)})
+    return docs
+
+
+class VectorIndex:
+    def __init__(self, path: str = "rag_index", dim: int = 256):
+        self.path = path
+        self.embedder = HashingEmbedder(dim)
+        self.vectors = None              # int8 N × dim (mmap)
+        self.scales = None               # float32 N
+        self.skin = None                 # uint16 N — маска кодов
+        self.season = None               # uint8 N — маска сезонов
+        self.texts = []
+        self.build_ms = 0.0
+        self.rebuilt = False                 # при последнем open индекс собирался заново
+        self.queries = 0
+        self.search_ms = 0.0
+
+    def __len__(self):
+        return len(self.texts)
+
+    # -----------------------------------------------------------
+    #                     СБОРКА И ЗАГРУЗКА
+    # -----------------------------------------------------------
+
+    def open(self, docs: list):
+        """Открывает индекс с диска (mmap) или собирает заново, если корпус изменился."""
+        started = time.perf_counter()
+        digest = hashlib.sha256(json.dumps([INDEX_VERSION, self.embedder.dim, docs], ensure_ascii=False,
+                                           sort_keys=True).encode()).hexdigest()
+        meta_path = os.path.join(self.path, "meta.json")
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                fresh = json.load(f).get("digest") == digest
+        except (OSError, ValueError):
+            fresh = False
+        if not fresh:
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+            self._build(docs)
+            with open(f"{meta_path}.tmp", "w", encoding="utf-8") as f:
+                json.dump({"digest": digest, "docs": len(docs), "dim": self.embedder.dim}, f)
+            os.replace(f"{meta_path}.tmp", meta_path)   # meta — последним: недописанный индекс не «свежий»
+        self._load()
+        self.rebuilt = not fresh
+        self.build_ms = (time.perf_counter() - started) * 1000
+
+    def _build(self, docs: list, chunk: int = 10_000):
+        os.makedirs(self.path, exist_ok=True)
+        n, dim = len(docs), self.embedder.dim
+        # Пишем прямо в .npy на диске, блоками — без матрицы float32 на весь корпус
+        vectors = np.lib.format.open_memmap(self._file("vectors.tmp.npy"), mode="w+", dtype=np.int8,
+                                            shape=(n, dim))
+        scales = np.empty(n, dtype=np.float32)
+        for start in range(0, n, chunk):
+            part = docs[start:start + chunk]
+            q, s = quantize(self.embedder.embed([d["text"] for d in part]))
+            vectors[start:start + len(part)] = q
+            scales[start:start + len(part)] = s
+        vectors.flush()
+        del vectors
+        masks = {pattern: skin_mask(pattern) for pattern in {d["skin"] for d in docs}}
+        skin = np.array([masks[d["skin"]] for d in docs], dtype=np.uint16)
+        season = np.array([season_mask(d.get("seasons")) for d in docs], dtype=np.uint8)
+
+        os.replace(self._file("vectors.tmp.npy"), self._file("vectors.npy"))
+        for name, array in (("scales", scales), ("skin", skin), ("season", season)):
+            np.save(self._file(f"{name}.tmp.npy"), array)
+            os.replace(self._file(f"{name}.tmp.npy"), self._file(f"{name}.npy"))
+        with open(self._file("texts.jsonl.tmp"), "w", encoding="utf-8") as f:
+            for d in docs:
+                f.write(json.dumps(d["text"], ensure_ascii=False) + "\n")
+        os.replace(self._file("texts.jsonl.tmp"), self._file("texts.jsonl"))
+
+    def _load(self):
+        self.vectors = np.load(self._file("vectors.npy"), mmap_mode="r")
+        self.scales = np.load(self._file("scales.npy"), mmap_mode="r")
+        self.skin = np.load(self._file("skin.npy"), mmap_mode="r")
+        self.season = np.load(self._file("season.npy"), mmap_mode="r")
+        with open(self._file("texts.jsonl"), encoding="utf-8") as f:
+            self.texts = [json.loads(line) for line in f]
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    # -----------------------------------------------------------
+    #                          ПОИСК
+    # -----------------------------------------------------------
+
+    def search(self, queries: list, k: int = 3, skin_code: str = None, season: str = None) -> list:
+        """
+        Для каждого запроса — до k пар (сходство, текст), лучшие первыми.
+        skin_code / season отбрасывают документы, не относящиеся к ним.
+        """
+        started = time.perf_counter()
+        q = self.embedder.embed(queries).T                       # dim × B
+        code_bit = 1 << SKIN_CODES.index(skin_code) if skin_code in SKIN_CODES else ALL_CODES
+        season_bit = SEASON_BITS.get(season, ALL_SEASONS)
+
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self), BLOCK_ROWS):
+            stop = min(start + BLOCK_ROWS, len(self))
+            rows = np.arange(start, stop)
+            allowed = ((self.skin[start:stop] & code_bit) != 0) & ((self.season[start:stop] & season_bit) != 0)
+            rows = rows[allowed]
+            if not len(rows):
+                continue
+            block = self.vectors[rows] if len(rows) < stop - start else self.vectors[start:stop]
+            scores = (block.astype(np.float32) @ q).T * self.scales[rows]       # B × строки блока
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_rows = np.concatenate([best_rows, np.broadcast_to(rows, scores.shape)], axis=1)
+            if best_scores.shape[1] > k:
+                top = np.argpartition(-best_scores, k, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, top, axis=1)
+                best_rows = np.take_along_axis(best_rows, top, axis=1)
+
+        results = []
+        for scores, rows in zip(best_scores, best_rows):
+            order = np.argsort(-scores)
+            results.append([(float(scores[i]), self.texts[rows[i]]) for i in order])
+        self.queries += len(queries)
+        self.search_ms += (time.perf_counter() - started) * 1000
+        return results
+
+    def context_for(self, skin_code: str, season: str, k: int = 3) -> list:
+        """Заметки для промта по профилю пациента."""
+        query = f"Уход: {SKIN_DESCRIPTIONS.get(skin_code, '')}. {season or ''}"
+        return [text for _, text in self.search([query], k, skin_code, season or None)[0]]
+
+    def stats(self) -> dict:
+        return {
+            "documents": len(self),
+            "build_ms": self.build_ms,
+            "rebuilt": self.rebuilt,
+            "queries": self.queries,
+            "avg_search_ms": self.search_ms / self.queries if self.queries else 0.0,
+        }
@@ -0,0 +1,276 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+# ===============================================================
+#         ОГРАНИЧЕНИЕ ИСХОДЯЩИХ ЗАПРОСОВ К BOT API
+# ===============================================================
+#
+# Telegram ограничивает отправку сообщений: ~30 в секунду на бота
+# и ~1 в секунду в один чат (в группах — 20 в минуту). При превышении
+# приходит 429 (RetryAfter). Здесь каждый send*/edit*-запрос:
+#   1. проходит корзину токенов своего чата (по порядку внутри чата;
+#      INTERACTIVE — только паузу после 429, см. ниже);
+#   2. встаёт в общую очередь с приоритетом: INTERACTIVE (ответы на
+#      нажатия, по умолчанию) обгоняют BULK (рассылки, отчёты);
+#      общую корзину токенов раздаёт один диспетчер;
+#   3. если для того же сообщения уже ждёт правка того же вида, новая
+#      правка не занимает своего места в очереди, а подменяет содержимое
+#      ждущей; отправляется одна (самая свежая), результат получают все.
+# answerCallbackQuery, getFile и прочие служебные запросы не ограничиваются.
+# INTERACTIVE-запросы (ответ на нажатие — следующий вопрос теста) берут
+# из корзины чата до interactive_burst токенов в долг: короткая серия
+# быстрых нажатий не ждёт секунду на каждое, а длинная всё равно идёт
+# не быстрее chat_rate. BULK в долг не берёт и ждёт, пока долг погасится.
+# Паузу после 429 в чате соблюдают оба.
+#
+# Приоритет задаётся при вызове метода бота:
+#   await bot.send_message(..., rate_limit_args={"priority": BULK})
+# У Message.reply_* такого аргумента нет — для документов есть reply_document().
+
+INTERACTIVE, BULK = 0, 1
+
+LIMITED_PREFIXES = ("send", "edit", "copy", "forward")
+EDIT_ENDPOINTS = ("editMessageText", "editMessageCaption", "editMessageReplyMarkup", "editMessageMedia")
+
+
+class TokenBucket:
+    """Корзина токенов с резервированием: токены могут уходить в минус."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reserve(self, now: float = None, debt: float = 0) -> float:
+        """
+        Забирает токен; возвращает, сколько секунд ждать до его появления.
+        debt — сколько токенов можно взять в долг без ожидания.
+        """
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= -debt else -(self.tokens + debt) / self.rate
+
+    def pause(self, seconds: float, now: float = None):
+        """После 429: ближайший токен — не раньше чем через seconds."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+        self.paused_until = max(self.paused_until, now + seconds)
+
+    def blocked(self, now: float = None) -> float:
+        """Сколько секунд ещё длится пауза после 429 (токен не забирается)."""
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.paused_until - now)
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Edit:
+    """Ждущая отправки правка сообщения; более свежие правки подменяют call."""
+    __slots__ = ("call", "sending", "result")
+
+    def __init__(self, call):
+        self.call = call                 # (callback, args, kwargs) самой свежей правки
+        self.sending = False
+        self.result = asyncio.get_running_loop().create_future()
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    def __init__(self, global_rate: float = 30, global_burst: float = 30,
+                 chat_rate: float = 1, chat_burst: float = 3,
+                 group_rate: float = 20 / 60, group_burst: float = 3,
+                 interactive_burst: float = 2, max_retries: int = 3):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_limits = (chat_rate, chat_burst)
+        self.group_limits = (group_rate, group_burst)
+        self.interactive_burst = interactive_burst
+        self.max_retries = max_retries
+        self._chats = {}                 # chat_id -> TokenBucket
+        self._heap = []                  # (приоритет, порядковый номер, future)
+        self._seq = itertools.count()
+        self._has_requests = None
+        self._dispatcher = None
+        self._edits = {}                 # (endpoint, chat_id, message_id) -> ждущая правка
+        # Счётчики
+        self.sent = [0, 0]               # по приоритетам
+        self.delay_total = [0.0, 0.0]    # суммарное ожидание в очереди, с
+        self.delay_max = [0.0, 0.0]
+        self.coalesced = 0
+        self.retries = 0
+
+    async def initialize(self) -> None:
+        # PTB вызывает initialize и из Application, и из Updater — диспетчер один
+        if self._dispatcher is not None and not self._dispatcher.done():
+            return
+        self._has_requests = asyncio.Event()
+        self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    # -----------------------------------------------------------
+    #                      ОБРАБОТКА ЗАПРОСА
+    # -----------------------------------------------------------
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith(LIMITED_PREFIXES):
+            return await callback(*args, **kwargs)
+
+        priority = (rate_limit_args or {}).get("priority", INTERACTIVE)
+        chat_id = data.get("chat_id")
+
+        if endpoint not in EDIT_ENDPOINTS:
+            return await self._send(callback, args, kwargs, endpoint, chat_id, priority)
+
+        key = (endpoint, chat_id, data.get("message_id"), data.get("inline_message_id"))
+        edit = self._edits.get(key)
+        if edit is not None and not edit.sending:
+            # Правка этого сообщения ещё в очереди — отправится наша, более свежая,
+            # в её слоте; результат общий
+            edit.call = (callback, args, kwargs)
+            self.coalesced += 1
+            return await asyncio.shield(edit.result)
+
+        edit = self._edits[key] = _Edit((callback, args, kwargs))
+        try:
+            result = await self._send(None, None, None, endpoint, chat_id, priority, edit)
+        except BaseException as e:
+            if isinstance(e, Exception):
+                edit.result.set_exception(e)
+                edit.result.exception()          # не ругаться, если результат никто не ждёт
+            else:
+                edit.result.cancel()
+            raise
+        else:
+            edit.result.set_result(result)
+            return result
+        finally:
+            if self._edits.get(key) is edit:
+                del self._edits[key]
+
+    async def _send(self, callback, args, kwargs, endpoint, chat_id, priority: int, edit: _Edit = None):
+        enqueued = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id, priority)
+            if attempt == 0:
+                self._record_delay(priority, time.monotonic() - enqueued)
+            if edit is not None:
+                edit.sending = True
+                callback, args, kwargs = edit.call
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                seconds = _seconds(e.retry_after) + 0.1
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+                bucket.pause(seconds)
+                print(f"⏳ 429 от Telegram ({endpoint}, чат {chat_id}), повтор через {seconds:.1f} с")
+                if edit is not None:
+                    edit.sending = False         # пока ждём, правку снова можно подменить
+
+    async def _acquire(self, chat_id, priority: int):
+        if chat_id is not None:
+            bucket = self._chat_bucket(chat_id)
+            debt = self.interactive_burst if priority == INTERACTIVE else 0
+            wait = max(bucket.reserve(debt=debt), bucket.blocked())
+            if wait:
+                await asyncio.sleep(wait)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), future))
+        self._has_requests.set()
+        await future
+
+    async def _dispatch(self):
+        """Раздаёт общие токены: после ожидания — самому приоритетному запросу."""
+        while True:
+            await self._has_requests.wait()
+            wait = self.global_bucket.reserve()
+            if wait:
+                await asyncio.sleep(wait)
+            while self._heap:
+                _, _, future = heapq.heappop(self._heap)
+                if not future.done():            # вызывающий мог быть отменён
+                    future.set_result(None)
+                    break
+            else:
+                # Токен никому не достался — вернём его
+                self.global_bucket.tokens += 1
+            if not self._heap:
+                self._has_requests.clear()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10_000:
+                now = time.monotonic()
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle(now)}
+            rate, burst = self.group_limits if _is_group(chat_id) else self.chat_limits
+            bucket = self._chats[chat_id] = TokenBucket(rate, burst)
+        return bucket
+
+    # -----------------------------------------------------------
+    #                         СЧЁТЧИКИ
+    # -----------------------------------------------------------
+
+    def _record_delay(self, priority: int, delay: float):
+        self.sent[priority] += 1
+        self.delay_total[priority] += delay
+        self.delay_max[priority] = max(self.delay_max[priority], delay)
+
+    def stats(self) -> dict:
+        names = ("interactive", "bulk")
+        return {
+            "queued": len(self._heap),
+            "coalesced": self.coalesced,
+            "retries_429": self.retries,
+            **{
+                name: {
+                    "sent": self.sent[i],
+                    "delay_avg_ms": self.delay_total[i] / self.sent[i] * 1000 if self.sent[i] else 0.0,
+                    "delay_max_ms": self.delay_max[i] * 1000,
+                }
+                for i, name in enumerate(names)
+            },
+        }
+
+
+async def reply_document(message, document, priority: int = BULK, **kwargs):
+    """
+    Message.reply_document с приоритетом в очереди (отчёты, выгрузки — BULK).
+    Без ограничителя у бота rate_limit_args PTB не принимает — тогда без него.
+    """
+    bot = message.get_bot()
+    if getattr(bot, "rate_limiter", None) is not None:
+        kwargs["rate_limit_args"] = {"priority": priority}
+    return await bot.send_document(message.chat_id, document, **kwargs)
+
+
+def _is_group(chat_id) -> bool:
+    # У групп и каналов отрицательные id; @username — публичные каналы
+    return isinstance(chat_id, str) or (isinstance(chat_id, int) and chat_id < 0)
+
+
+def _seconds(value) -> float:
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
@@ -0,0 +1,221 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.test import SKIN_DESCRIPTIONS
+
+# ===============================================================
+#                 PDF-ОТЧЁТЫ ДЛЯ ПАЦИЕНТОВ
+# ===============================================================
+#
+# Отчёт собирается из сохранённой записи пациента (без id — данные
+# анонимные) и рендерится reportlab'ом в пуле процессов. Имя файла —
+# sha256 содержимого отчёта, поэтому одинаковые отчёты (тот же тип
+# кожи, возраст, пол, ...) рендерятся один раз, а параллельные запросы
+# одного и того же отчёта ждут общий рендер. Рендер запускается сразу
+# после сохранения результата дерматоскопии (prefetch), и к нажатию
+# «PDF-отчёт» файл обычно уже готов.
+# Каталог чистится по возрасту (max_age_days) и общему размеру (max_bytes),
+# начиная с давно не запрашивавшихся файлов.
+
+REPORT_VERSION = 1             # поменять при изменении вёрстки — старые отчёты перерендерятся
+
+# Шрифты с кириллицей: стандартные шрифты PDF её не содержат
+FONT_CANDIDATES = [
+    os.getenv("REPORT_FONT", ""),
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    r"C:\Windows\Fonts\arial.ttf",
+    "/Library/Fonts/Arial Unicode.ttf",
+]
+
+REPORT_FIELDS = ["age", "sex", "allergies", "skin_code", "skin_type_dermatoscopy",
+                 "match_percent", "final_skin_type", "time_of_year"]
+
+
+def report_payload(record: dict) -> dict:
+    """Содержимое отчёта из записи пациента (все значения — строки)."""
+    payload = {field: str(record.get(field, "") or "") for field in REPORT_FIELDS}
+    payload["final_desc"] = SKIN_DESCRIPTIONS.get(payload["final_skin_type"].upper(), "")
+    payload["version"] = REPORT_VERSION
+    return payload
+
+
+def report_key(payload: dict) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+# ===============================================================
+#                 РЕНДЕР (внутри процесса пула)
+# ===============================================================
+
+def _font() -> str:
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    if "ReportFont" in pdfmetrics.getRegisteredFontNames():
+        return "ReportFont"
+    for path in FONT_CANDIDATES:
+        if path and os.path.exists(path):
+            pdfmetrics.registerFont(TTFont("ReportFont", path))
+            return "ReportFont"
+    return "Helvetica"             # кириллица не отобразится — задайте REPORT_FONT
+
+
+def render_pdf(payload: dict, path: str):
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    font = _font()
+    pdf = canvas.Canvas(path, pagesize=A4, invariant=1)    # invariant — без даты, байты стабильны
+    width, height = A4
+    y = height - 60
+
+    def line(text, size=11, gap=18):
+        nonlocal y
+        pdf.setFont(font, size)
+        pdf.drawString(50, y, text)
+        y -= gap
+
+    line("Отчёт по типу кожи (Бауманн)", size=16, gap=30)
+    line(f"Возраст: {payload['age'] or '—'}    Пол: {payload['sex'] or '—'}")
+    line(f"Аллергии: {payload['allergies'] or '—'}", gap=26)
+    line(f"Тип кожи по тесту: {payload['skin_code'] or '—'}")
+    line(f"Тип кожи по дерматоскопии: {payload['skin_type_dermatoscopy'] or '—'}")
+    match = f"{payload['match_percent']}%" if payload["match_percent"] else "—"
+    line(f"Совпадение: {match}", gap=26)
+    line(f"Финальный тип кожи: {payload['final_skin_type'] or '—'}", size=13, gap=20)
+    for part in payload["final_desc"].split(", "):
+        line(f"  • {part.rstrip('.')}", size=10, gap=15)
+    y -= 10
+    line(f"Сезон ухода: {payload['time_of_year'] or '—'}")
+    line("Отчёт сформирован автоматически и не заменяет консультацию дерматолога.", size=8, gap=12)
+    pdf.showPage()
+    pdf.save()
+
+
+# ===============================================================
+#                  КЭШ ОТЧЁТОВ НА ДИСКЕ
+# ===============================================================
+
+class ReportBuilder:
+    def __init__(self, reports_dir: str = "reports", workers: int = 2,
+                 max_bytes: int = 500 * 2**20, max_age_days: float = 30, cleanup_every: int = 100):
+        self.reports_dir = reports_dir
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 86400
+        self.cleanup_every = cleanup_every
+        self.executor = None
+        self._inflight = {}              # ключ -> future рендера
+        self._prefetch = set()           # фоновые задачи (держим ссылки)
+        self.rendered = 0
+        self.reused = 0
+        self.removed = 0
+
+    def start(self):
+        os.makedirs(self.reports_dir, exist_ok=True)
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    async def close(self):
+        for task in list(self._prefetch):
+            task.cancel()
+        await asyncio.gather(*self._prefetch, return_exceptions=True)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.reports_dir, f"{key}.pdf")
+
+    @staticmethod
+    def key_for(record: dict) -> str:
+        """Ключ отчёта без рендера (например, чтобы найти уже загруженный в Telegram файл)."""
+        return report_key(report_payload(record))
+
+    async def ensure(self, record: dict) -> tuple:
+        """Готовый PDF для записи пациента: (путь, ключ). Рендерит, если ещё нет."""
+        payload = report_payload(record)
+        key = report_key(payload)
+        path = self.path_for(key)
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            await asyncio.shield(inflight)
+            return path, key
+        if os.path.exists(path):
+            self.reused += 1
+            _touch(path)                 # для очистки «давно не запрашивавшихся»
+            return path, key
+
+        future = self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            await asyncio.get_running_loop().run_in_executor(self.executor, render_pdf, payload, tmp_path)
+            os.replace(tmp_path, path)
+            self.rendered += 1
+            future.set_result(None)
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()           # не ругаться, если никто не ждёт
+            raise
+        finally:
+            del self._inflight[key]
+
+        if self.rendered % self.cleanup_every == 0:
+            await asyncio.to_thread(self.cleanup)
+        return path, key
+
+    def prefetch(self, record: dict):
+        """Запускает рендер в фоне (без ожидания)."""
+        task = asyncio.get_running_loop().create_task(self.ensure(record))
+        self._prefetch.add(task)
+        task.add_done_callback(self._prefetch_done)
+
+    def _prefetch_done(self, task):
+        self._prefetch.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"⚠️ Не удалось подготовить отчёт: {task.exception()!r}")
+
+    def cleanup(self) -> int:
+        """Удаляет устаревшие отчёты и самые старые сверх max_bytes. Возвращает число удалённых."""
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.reports_dir):
+            if entry.is_file() and entry.name.endswith(".pdf"):
+                st = entry.stat()
+                files.append((st.st_mtime, st.st_size, entry.path))
+        files.sort()                     # сначала давно не запрашивавшиеся
+
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for mtime, size, path in files:
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        self.removed += removed
+        return removed
+
+    def stats(self) -> dict:
+        return {
+            "rendered": self.rendered,
+            "reused": self.reused,
+            "removed": self.removed,
+            "rendering": len(self._inflight),
+        }
+
+
+def _touch(path: str):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
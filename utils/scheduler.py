@@ -0,0 +1,114 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# ===============================================================
+#      ПЛАНИРОВЩИК АПДЕЙТОВ: ПО ПОРЯДКУ В ЧАТЕ, ПАРАЛЛЕЛЬНО МЕЖДУ ЧАТАМИ
+# ===============================================================
+#
+# При concurrent_updates > 1 PTB запускает каждый апдейт отдельной
+# задачей, и два быстрых нажатия одного пользователя могут обработаться
+# в обратном порядке (handle_answer сдвигает user_data["index"]).
+# Здесь у каждого чата своя очередь: апдейт ждёт, пока закончится
+# предыдущий апдейт того же чата, и только потом занимает одного из
+# workers исполнителей. Ожидающий своей очереди апдейт исполнителя
+# не держит, так что медленный чат не тормозит остальных.
+#
+# Очередь чата — цепочка future: каждый апдейт запоминает future
+# предыдущего и ставит на его место свой. Порядок в цепочке задаётся
+# синхронно при входе в do_process_update, а задачи PTB стартуют в
+# порядке поступления апдейтов.
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, workers: int = 16, max_pending: int = 10_000):
+        """
+        workers — сколько апдейтов обрабатывается одновременно;
+        max_pending — сколько апдейтов может быть в работе и в очередях
+        всего (семафор BaseUpdateProcessor, ограничивает память).
+        """
+        super().__init__(max_pending)
+        self.workers = workers
+        self._workers = asyncio.Semaphore(workers)
+        self._tails = {}                 # чат -> future последнего апдейта в очереди
+        self._depth = {}                 # чат -> апдейтов в очереди (включая выполняемый)
+        self.max_depth = 0               # самая длинная очередь одного чата за всё время
+        self.running = 0
+        self.processed = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key = _chat_key(update)
+        if key is None:
+            # Не апдейт чата (ошибки, собственные объекты) — без очереди
+            async with self._workers:
+                await self._run(coroutine)
+            return
+
+        prev = self._tails.get(key)
+        done = asyncio.get_running_loop().create_future()
+        self._tails[key] = done
+        depth = self._depth[key] = self._depth.get(key, 0) + 1
+        self.max_depth = max(self.max_depth, depth)
+        started = False
+        try:
+            if prev is not None:
+                await asyncio.shield(prev)     # отмена нашей задачи не должна отменять чужой future
+            async with self._workers:
+                started = True
+                await self._run(coroutine)
+        finally:
+            if not started:
+                coroutine.close()        # отменён в очереди — корутина так и не запустилась
+            done.set_result(None)
+            if self._depth[key] == 1:
+                del self._depth[key]
+            else:
+                self._depth[key] -= 1
+            if self._tails.get(key) is done:
+                del self._tails[key]
+
+    async def _run(self, coroutine):
+        self.running += 1
+        try:
+            await coroutine
+        finally:
+            self.running -= 1
+            self.processed += 1
+
+    # -----------------------------------------------------------
+    #                         МЕТРИКИ
+    # -----------------------------------------------------------
+
+    def queue_depth(self, chat_id) -> int:
+        """Апдейтов чата в очереди (включая выполняемый)."""
+        return self._depth.get(chat_id, 0)
+
+    def stats(self) -> dict:
+        busiest = max(self._depth.items(), key=lambda item: item[1], default=(None, 0))
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "queued": sum(self._depth.values()),
+            "chats": len(self._depth),
+            "busiest_chat": busiest[0],
+            "busiest_depth": busiest[1],
+            "max_depth": self.max_depth,
+            "processed": self.processed,
+        }
+
+
+def _chat_key(update):
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return None
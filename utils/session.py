@@ -0,0 +1,267 @@
+import asyncio
+import json
+import os
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+# ===============================================================
+#                 СЕССИЯ ПРОХОЖДЕНИЯ ТЕСТА
+# ===============================================================
+#
+# Вместо словаря user_data на каждого пользователя — объект со __slots__
+# (≈100 байт против ≈650 у dict). Ответы хранятся упакованными в int
+# (см. SkinTest.pack_answer). Интерфейс словаря сохранён, поэтому
+# обработчики по-прежнему пишут context.user_data["sex"], "age" in ... и т.д.
+# Незаполненное поле — это просто незаданный слот. touched — время
+# последнего апдейта от пользователя (для SessionSweeper).
+
+class Session:
+    __slots__ = ("id_patient", "sex", "age", "allergies", "index", "answers", "skin_code", "time_of_year",
+                 "touched")
+    FIELDS = __slots__
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(f"Неизвестное поле сессии: {key}")
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return key in self.FIELDS and hasattr(self, key)
+
+    def __len__(self):
+        return sum(hasattr(self, f) for f in self.FIELDS)
+
+    def __repr__(self):
+        fields = ", ".join(f"{f}={getattr(self, f)!r}" for f in self.FIELDS if hasattr(self, f))
+        return f"Session({fields})"
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.FIELDS else default
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        if key in self:
+            delattr(self, key)
+        return value
+
+    def clear(self):
+        for f in self.FIELDS:
+            if hasattr(self, f):
+                delattr(self, f)
+
+    # -----------------------------------------------------------
+    #                      СЕРИАЛИЗАЦИЯ
+    # -----------------------------------------------------------
+
+    def to_row(self) -> list:
+        """Значения полей по порядку FIELDS (None — поле не задано)."""
+        return [getattr(self, f, None) for f in self.FIELDS]
+
+    @classmethod
+    def from_row(cls, row) -> "Session":
+        session = cls()
+        for f, value in zip(cls.FIELDS, row):
+            if value is not None:
+                setattr(session, f, value)
+        return session
+
+    # Все поля — неизменяемые скаляры, так что копия = пересборка
+    def __copy__(self):
+        return self.from_row(self.to_row())
+
+    def __deepcopy__(self, memo):
+        return self.__copy__()
+
+
+# ===============================================================
+#             ЖУРНАЛ СЕССИЙ (PERSISTENCE ДЛЯ PTB)
+# ===============================================================
+#
+# Вместо того чтобы целиком пиклить все сессии (как PicklePersistence),
+# каждое изменение дописывается в JSON-lines журнал одной строкой:
+#   ["u", user_id, <Session.to_row()>]   — сессия пользователя
+#   ["d", user_id]                       — сессия удалена
+#   ["c", name, [ключ], state]           — состояние диалога (null — завершён)
+# При старте журнал проигрывается (последняя запись побеждает), при
+# разрастании — переписывается снимком живых записей (tmp + os.replace).
+# В памяти журнал ничего не держит: сессии живут только в Application.
+
+class JournalPersistence(BasePersistence):
+    def __init__(self, path: str = "sessions.jsonl", update_interval: float = 5, compact_min: int = 10_000):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.path = path
+        self.compact_min = compact_min
+        self._file = None
+        self._lines = 0                 # строк в журнале
+        self._compacted = 0             # строк сразу после последнего сжатия
+        self._users = None              # прочитанное при старте, отдаётся один раз
+        self._conversations = None
+        self._buffer = []
+        self._write_lock = asyncio.Lock()
+        self._load_lock = asyncio.Lock()
+
+    # -----------------------------------------------------------
+    #                         ЗАГРУЗКА
+    # -----------------------------------------------------------
+
+    def _load(self):
+        users, conversations, lines, torn = _replay(self.path)
+        self._users, self._conversations = users, conversations
+        # Недописанный хвост надо убрать до того, как к нему что-то допишется
+        if torn or lines > max(self.compact_min, 2 * _live(users, conversations)):
+            lines = _write_snapshot(self.path, users, conversations)
+        self._lines = self._compacted = lines
+        self._file = open(self.path, "a", encoding="utf-8", newline="")
+
+    async def _ensure_loaded(self):
+        async with self._load_lock:
+            if self._file is None:
+                await asyncio.to_thread(self._load)
+
+    async def get_user_data(self) -> dict:
+        await self._ensure_loaded()
+        users, self._users = self._users or {}, {}
+        return {user_id: Session.from_row(row) for user_id, row in users.items()}
+
+    async def get_conversations(self, name: str) -> dict:
+        await self._ensure_loaded()
+        return self._conversations.pop(name, {})
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # -----------------------------------------------------------
+    #                       ЗАПИСЬ ИЗМЕНЕНИЙ
+    # -----------------------------------------------------------
+
+    async def update_user_data(self, user_id: int, data) -> None:
+        await self._append(["u", user_id, data.to_row()])
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._append(["d", user_id])
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        await self._append(["c", name, list(key), new_state])
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def _append(self, item):
+        # Application.update_persistence вызывает update_* пачкой через gather:
+        # строки копятся в буфере и уходят в файл одной записью
+        self._buffer.append(json.dumps(item, ensure_ascii=False, separators=(",", ":")) + "\n")
+        async with self._write_lock:
+            if self._buffer:
+                lines, self._buffer = self._buffer, []
+                await asyncio.to_thread(self._write, lines)
+
+    def _write(self, lines: list):
+        self._file.write("".join(lines))
+        self._file.flush()
+        self._lines += len(lines)
+        if self._lines > max(self.compact_min, 2 * self._compacted):
+            self._compact()
+
+    def _compact(self):
+        self._file.close()
+        users, conversations, _, _ = _replay(self.path)
+        self._lines = self._compacted = _write_snapshot(self.path, users, conversations)
+        self._file = open(self.path, "a", encoding="utf-8", newline="")
+        print(f"🗜 Журнал сессий сжат: {self._lines} записей")
+
+    async def flush(self) -> None:
+        """Вызывается при остановке: дописывает буфер и сжимает журнал."""
+        async with self._write_lock:
+            if self._file is None:
+                return
+            lines, self._buffer = self._buffer, []
+            if lines:
+                await asyncio.to_thread(self._write, lines)
+            await asyncio.to_thread(self._compact)
+            self._file.close()
+            self._file = None
+
+
+def _replay(path: str) -> tuple:
+    """
+    Проигрывает журнал.
+    Возвращает (сессии, диалоги {name: {key: state}}, число строк, оборван ли хвост).
+    """
+    users, conversations, lines = {}, {}, 0
+    if not os.path.exists(path):
+        return users, conversations, lines, False
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                return users, conversations, lines, True    # недописанная строка при падении
+            lines += 1
+            kind = item[0]
+            if kind == "u":
+                users[item[1]] = item[2]
+            elif kind == "d":
+                users.pop(item[1], None)
+            elif kind == "c":
+                states = conversations.setdefault(item[1], {})
+                key = tuple(item[2])
+                if item[3] is None:
+                    states.pop(key, None)
+                else:
+                    states[key] = item[3]
+    return users, conversations, lines, False
+
+
+def _live(users: dict, conversations: dict) -> int:
+    return len(users) + sum(len(states) for states in conversations.values())
+
+
+def _write_snapshot(path: str, users: dict, conversations: dict) -> int:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        for user_id, row in users.items():
+            f.write(json.dumps(["u", user_id, row], ensure_ascii=False, separators=(",", ":")) + "\n")
+        for name, states in conversations.items():
+            for key, state in states.items():
+                f.write(json.dumps(["c", name, list(key), state], separators=(",", ":")) + "\n")
+    os.replace(tmp_path, path)
+    return _live(users, conversations)
@@ -0,0 +1,380 @@
+import json
+from datetime import date, datetime, timedelta, timezone
+
+from utils.metrics import timed_storage
+from utils.test import compare_skin_types
+
+# ===============================================================
+#                 ХРАНИЛИЩЕ ДАННЫХ ПАЦИЕНТОВ
+# ===============================================================
+#
+# SkinBot работает только через этот интерфейс, поэтому CSV, Postgres
+# и хранилище в памяти взаимозаменяемы. Все методы — корутины.
+# Записи пациентов — словари с полями HEADERS (все значения — строки).
+
+HEADERS = [
+    "id_patient",
+    "age",
+    "sex",
+    "allergies",
+    "answers_json",
+    "skin_code",
+    "skin_type_dermatoscopy",
+    "match_percent",
+    "final_skin_type",
+    "time_of_year",
+    "questionnaire_version",
+    "abandoned_stage",
+    "created_at",
+    "consent"
+]
+
+FINAL_FIELDS = ["age", "sex", "allergies", "final_skin_type", "time_of_year"]
+
+# created_at — время создания записи (save_initial_data), ISO 8601 UTC;
+# consent — "yes": пациент дал согласие в диалоге (без согласия запись не
+# создаётся). У записей, сохранённых до появления этих полей, они пустые.
+
+
+def format_percent(value) -> str:
+    """match_percent в записи: одинаково во всех хранилищах ("75", "37.5", "" — нет значения)."""
+    if value is None or value == "":
+        return ""
+    return f"{float(value):g}"
+
+
+def utc_now() -> str:
+    """Значение created_at: одинаковый формат во всех хранилищах."""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class RecordFilter:
+    """
+    Отбор записей для выгрузки: created_at в [since, until] (даты включительно),
+    final_skin_type из списка, сезон из списка, значение consent.
+    Пустой фильтр пропускает всё. Postgres переводит его в WHERE.
+    """
+
+    def __init__(self, since: date = None, until: date = None, final_skin_types=(), seasons=(),
+                 consent: str = None):
+        self.since = _as_date(since)
+        self.until = _as_date(until)
+        self.final_skin_types = frozenset(t.strip().upper() for t in final_skin_types if t.strip())
+        self.seasons = frozenset(seasons)
+        self.consent = consent
+
+    def bounds(self) -> tuple:
+        """Границы created_at: [начало since, начало дня после until) в UTC (None — без границы)."""
+        lo = datetime.combine(self.since, datetime.min.time(), timezone.utc) if self.since else None
+        hi = (datetime.combine(self.until + timedelta(days=1), datetime.min.time(), timezone.utc)
+              if self.until else None)
+        return lo, hi
+
+    def __call__(self, record: dict) -> bool:
+        if self.since or self.until:
+            created = record.get("created_at") or ""
+            if not created:
+                return False
+            if self.since and created < self.since.isoformat():
+                return False
+            if self.until and created >= (self.until + timedelta(days=1)).isoformat():
+                return False
+        if self.final_skin_types and (record.get("final_skin_type") or "").upper() not in self.final_skin_types:
+            return False
+        if self.seasons and record.get("time_of_year") not in self.seasons:
+            return False
+        if self.consent is not None and record.get("consent") != self.consent:
+            return False
+        return True
+
+    def __repr__(self):
+        parts = [f"{name}={value!r}" for name, value in vars(self).items() if value]
+        return f"RecordFilter({', '.join(parts)})"
+
+
+def _as_date(value):
+    if value is None or value == "" or isinstance(value, date):
+        return value or None
+    return date.fromisoformat(value)
+
+# Методы, время которых пишется в метрики (utils/metrics.py, skinbot_storage_seconds)
+TIMED_METHODS = (
+    "save_initial_data", "save_test_results", "save_time_of_year", "save_dermatoscopy_result",
+    "get_patient", "get_patient_json", "save_abandonment", "bulk_update",
+)
+
+
+class BaseStorage:
+    name = "base"
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Переопределённые методы хранилища оборачиваются замером времени
+        for method in TIMED_METHODS:
+            fn = cls.__dict__.get(method)
+            if fn is not None and not getattr(fn, "timed", False):
+                setattr(cls, method, timed_storage(fn))
+
+    async def init(self):
+        """Открытие соединений / построение индексов при старте бота."""
+
+    async def close(self):
+        """Сброс данных и закрытие соединений при остановке бота."""
+
+    async def save_initial_data(self, id_patient: str, age: int, sex: str, allergies: str, consent: str = "yes"):
+        """Новая запись после согласия; created_at — текущее время."""
+        raise NotImplementedError
+
+    async def save_test_results(self, id_patient: str, answers_json: str, skin_code: str, time_of_year: str = "",
+                                questionnaire_version: str = ""):
+        raise NotImplementedError
+
+    async def save_time_of_year(self, id_patient: str, time_of_year: str):
+        raise NotImplementedError
+
+    async def save_dermatoscopy_result(self, id_patient: str, skin_code: str, skin_type_dermatoscopy: str) -> dict:
+        """Возвращает {"match_percent", "final_skin_type"}."""
+        raise NotImplementedError
+
+    async def get_patient(self, id_patient: str):
+        """Запись пациента (dict) или None."""
+        raise NotImplementedError
+
+    @timed_storage
+    async def save_abandonment(self, id_patient: str, stage: str):
+        """Отметка, на каком шаге пациент бросил тест (например, "Q_STATE:7")."""
+        await self.bulk_update([{"id_patient": id_patient, "abandoned_stage": stage}])
+
+    @timed_storage
+    async def get_patient_json(self, id_patient: str) -> str:
+        """JSON с финальными полями для LLM/RAG."""
+        row = await self.get_patient(id_patient)
+        if row is None:
+            return "{}"
+        filtered = {k: row.get(k, "") for k in FINAL_FIELDS}
+        return json.dumps(filtered, ensure_ascii=False, indent=2)
+
+    async def bulk_update(self, records: list):
+        """
+        Обновление многих записей за один проход (пересчёт, миграции).
+        records — словари с id_patient и изменяемыми полями из HEADERS;
+        у всех записей одинаковый набор полей.
+        """
+        raise NotImplementedError
+
+    async def iter_records(self):
+        """Все записи пациентов (асинхронный генератор)."""
+        raise NotImplementedError
+        yield
+
+    async def changes_since(self, token=None):
+        """
+        Записи, изменённые после token: (список записей, новый token).
+        Удалений нет, поэтому записи можно просто накатывать поверх
+        (upsert). По умолчанию — все записи каждый раз.
+        """
+        return [record async for record in self.iter_records()], None
+
+    async def iter_matching(self, record_filter: RecordFilter):
+        """Записи, подходящие под фильтр (по умолчанию — фильтр поверх iter_records)."""
+        async for record in self.iter_records():
+            if record_filter(record):
+                yield record
+
+
+# ===============================================================
+#                            CSV
+# ===============================================================
+
+class CsvStorage(BaseStorage):
+    """Обёртка над функциями utils.dataset_csv (append-only patients.csv)."""
+    name = "csv"
+
+    def __init__(self):
+        from utils import dataset_csv
+        self.backend = dataset_csv
+
+    async def init(self):
+        await self.backend.open_store()
+
+    async def close(self):
+        await self.backend.close_store()
+
+    async def save_initial_data(self, id_patient, age, sex, allergies, consent="yes"):
+        await self.backend.save_initial_data(id_patient, age, sex, allergies, consent)
+
+    async def save_test_results(self, id_patient, answers_json, skin_code, time_of_year="",
+                                questionnaire_version=""):
+        await self.backend.save_test_results(id_patient, answers_json, skin_code, time_of_year,
+                                             questionnaire_version)
+
+    async def save_time_of_year(self, id_patient, time_of_year):
+        await self.backend.save_time_of_year(id_patient, time_of_year)
+
+    async def save_dermatoscopy_result(self, id_patient, skin_code, skin_type_dermatoscopy):
+        return await self.backend.save_dermatoscopy_result(id_patient, skin_code, skin_type_dermatoscopy)
+
+    async def get_patient(self, id_patient):
+        return await self.backend.get_patient(id_patient)
+
+    async def get_patient_json(self, id_patient):
+        return await self.backend.get_patient_json(id_patient)
+
+    async def bulk_update(self, records):
+        await self.backend.bulk_update(records)
+
+    async def iter_records(self):
+        async for record in self.backend.iter_records():
+            yield record
+
+    async def changes_since(self, token=None):
+        return await self.backend.changes_since(token)
+
+
+# ===============================================================
+#                     POSTGRES (asyncpg pool)
+# ===============================================================
+
+class PostgresStorage(BaseStorage):
+    """Обёртка над utils.db.DBHandler с пулом соединений."""
+    name = "postgres"
+
+    def __init__(self, config: dict, write_behind: dict = None):
+        from utils.db import DBHandler
+        self.db = DBHandler(config, write_behind=write_behind)
+
+    async def init(self):
+        await self.db.init_db()
+
+    async def close(self):
+        await self.db.close()
+
+    async def save_initial_data(self, id_patient, age, sex, allergies, consent="yes"):
+        # id строки боту не нужен — не ждём сброса пакетной записи
+        await self.db.create_patient_initial(sex, age, allergies, id_patient=id_patient, consent=consent,
+                                             wait=False)
+
+    async def save_test_results(self, id_patient, answers_json, skin_code, time_of_year="",
+                                questionnaire_version=""):
+        answers = json.loads(answers_json) if answers_json else {}
+        await self.db.update_test_results(id_patient, answers, skin_code, time_of_year,
+                                          questionnaire_version)
+
+    async def save_time_of_year(self, id_patient, time_of_year):
+        await self.db.save_time_of_year(id_patient, time_of_year)
+
+    async def save_dermatoscopy_result(self, id_patient, skin_code, skin_type_dermatoscopy):
+        return await self.db.save_dermatoscopy_result(id_patient, skin_code, skin_type_dermatoscopy)
+
+    async def get_patient(self, id_patient):
+        return await self.db.get_patient(id_patient)
+
+    async def bulk_update(self, records):
+        await self.db.bulk_update(records)
+
+    async def iter_records(self):
+        from utils.db import row_to_record
+        async for row in self.db.iter_patients():
+            yield row_to_record(row)
+
+    async def iter_matching(self, record_filter):
+        """Фильтр выполняется в базе, строки идут серверным курсором."""
+        from utils.db import row_to_record
+        created_since, created_until = record_filter.bounds()
+        async for row in self.db.iter_patients(created_since=created_since, created_until=created_until,
+                                               final_skin_types=record_filter.final_skin_types,
+                                               seasons=record_filter.seasons, consent=record_filter.consent):
+            yield row_to_record(row)
+
+    # Запас на транзакции, которые взяли now() раньше, а закоммитились позже
+    CHANGES_OVERLAP = timedelta(seconds=5)
+
+    async def changes_since(self, token=None):
+        """token — updated_at последней выборки (с запасом назад)."""
+        from utils.db import row_to_record
+        records, newest = [], None
+        async for row in self.db.iter_patients(since=token):
+            records.append(row_to_record(row))
+            if newest is None or row["updated_at"] > newest:
+                newest = row["updated_at"]
+        if newest is None:
+            return records, token
+        return records, newest - self.CHANGES_OVERLAP
+
+
+# ===============================================================
+#                   В ПАМЯТИ (для тестов)
+# ===============================================================
+
+class MemoryStorage(BaseStorage):
+    """Словарь в памяти процесса; семантика та же, что у CSV-версии."""
+    name = "memory"
+
+    def __init__(self):
+        self.records = {}
+
+    def _record(self, id_patient: str) -> dict:
+        record = self.records.get(id_patient)
+        if record is None:
+            record = dict.fromkeys(HEADERS, "")
+            record["id_patient"] = id_patient
+            self.records[id_patient] = record
+        return record
+
+    async def save_initial_data(self, id_patient, age, sex, allergies, consent="yes"):
+        self.records.pop(id_patient, None)
+        self._record(id_patient).update({"age": str(age), "sex": sex, "allergies": allergies,
+                                         "created_at": utc_now(), "consent": consent})
+
+    async def save_test_results(self, id_patient, answers_json, skin_code, time_of_year="",
+                                questionnaire_version=""):
+        record = self._record(id_patient)
+        record["answers_json"] = answers_json
+        record["skin_code"] = skin_code
+        record["questionnaire_version"] = questionnaire_version
+        if time_of_year:
+            record["time_of_year"] = time_of_year
+
+    async def save_time_of_year(self, id_patient, time_of_year):
+        self._record(id_patient)["time_of_year"] = time_of_year
+
+    async def save_dermatoscopy_result(self, id_patient, skin_code, skin_type_dermatoscopy):
+        if id_patient not in self.records:
+            skin_code = ""
+        comparison = compare_skin_types(skin_code, skin_type_dermatoscopy)
+        self._record(id_patient).update({
+            "skin_type_dermatoscopy": skin_type_dermatoscopy,
+            "match_percent": format_percent(comparison["match_percent"]),
+            "final_skin_type": comparison["final_skin_type"]
+        })
+        return comparison
+
+    async def get_patient(self, id_patient):
+        record = self.records.get(id_patient)
+        return dict(record) if record else None
+
+    async def bulk_update(self, records):
+        for changes in records:
+            self._record(changes["id_patient"]).update({k: str(v) for k, v in changes.items()})
+
+    async def iter_records(self):
+        for record in list(self.records.values()):
+            yield dict(record)
+
+
+# ===============================================================
+#                    ВЫБОР ХРАНИЛИЩА ПРИ СТАРТЕ
+# ===============================================================
+
+def create_storage(kind: str = "csv", db_config: dict = None, write_behind: dict = None) -> BaseStorage:
+    """
+    kind: "csv" | "postgres" | "memory" (для postgres нужен db_config).
+    write_behind — параметры пакетной записи для postgres (см. DBHandler).
+    """
+    if kind == "csv":
+        return CsvStorage()
+    if kind == "postgres":
+        return PostgresStorage(db_config, write_behind=write_behind)
+    if kind == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Неизвестное хранилище: {kind}")
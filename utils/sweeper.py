@@ -0,0 +1,135 @@
+import asyncio
+import sys
+import time
+
+try:
+    import resource                      # нет на Windows
+except ImportError:
+    resource = None
+
+# ===============================================================
+#          ОЧИСТКА БРОШЕННЫХ СЕССИЙ (TTL ПО СОСТОЯНИЮ)
+# ===============================================================
+#
+# Пользователь, бросивший тест на середине, оставляет в процессе свою
+# сессию (Application.user_data) и состояние ConversationHandler.
+# Раз в interval секунд проверяем время последней активности
+# (Session.touched) и, если в текущем состоянии диалога пользователь
+# молчит дольше его таймаута, завершаем диалог и удаляем сессию.
+# Сессии вне диалога (тест пройден, ждём фото/уход) живут idle_timeout.
+# Журнал сессий (JournalPersistence) получит удаление при следующем
+# update_persistence, так что после перезапуска они не вернутся.
+
+
+class SessionSweeper:
+    def __init__(self, app, conversation, timeouts: dict, idle_timeout: float = 24 * 3600,
+                 interval: float = 60, on_abandon=None):
+        """
+        timeouts — {состояние диалога: секунд бездействия}.
+        on_abandon(user_id, session, state) — корутина, вызывается для
+        каждой сессии, удалённой посреди диалога.
+        """
+        self.app = app
+        self.conversation = conversation
+        self.timeouts = timeouts
+        self.idle_timeout = idle_timeout
+        self.interval = interval
+        self.on_abandon = on_abandon
+        self.evicted = 0                 # всего удалено сессий
+        self.abandoned = 0               # из них брошено посреди диалога
+        self.last = {}                   # результат последнего прохода (см. stats)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"⚠️ Очистка сессий не удалась: {e!r}")
+
+    async def sweep(self, now: float = None) -> dict:
+        now = time.time() if now is None else now
+        # Приватный атрибут ConversationHandler: публичного способа
+        # завершить чужой диалог в PTB нет
+        conversations = self.conversation._conversations
+        in_conversation = set()
+        abandoned = []
+
+        for key, state in list(conversations.items()):
+            user_id = key[-1]
+            session = self.app.user_data.get(user_id)
+            timeout = self.timeouts.get(state)
+            if timeout is None:                  # неизвестное/ожидающее состояние
+                in_conversation.add(user_id)
+                continue
+            if not self._expired(session, now, timeout):
+                in_conversation.add(user_id)
+                continue
+            self.conversation._update_state(self.conversation.END, key)
+            if session is not None:
+                abandoned.append((user_id, session, state))
+                self.app.drop_user_data(user_id)
+
+        evicted = len(abandoned)
+        for user_id, session in list(self.app.user_data.items()):
+            if user_id not in in_conversation and self._expired(session, now, self.idle_timeout):
+                self.app.drop_user_data(user_id)
+                evicted += 1
+
+        self.evicted += evicted
+        self.abandoned += len(abandoned)
+        if self.on_abandon is not None:
+            for user_id, session, state in abandoned:
+                try:
+                    await self.on_abandon(user_id, session, state)
+                except Exception as e:
+                    print(f"⚠️ Не удалось записать брошенную сессию {user_id}: {e!r}")
+
+        self.last = self.stats()
+        self.last["evicted_now"] = evicted
+        if evicted:
+            print(f"🧹 Удалено сессий: {evicted} (брошено посреди теста: {len(abandoned)}), "
+                  f"осталось: {self.last['sessions']}")
+        return self.last
+
+    @staticmethod
+    def _expired(session, now: float, timeout: float) -> bool:
+        if session is None:
+            return True
+        touched = session.get("touched")
+        if touched is None:
+            # Сессия из старого журнала без отметки — начинаем отсчёт с сейчас
+            session["touched"] = now
+            return False
+        return now - touched > timeout
+
+    # -----------------------------------------------------------
+    #                        СТАТИСТИКА
+    # -----------------------------------------------------------
+
+    def by_state(self) -> dict:
+        """Число незавершённых диалогов в каждом состоянии (дёшево, для метрик)."""
+        by_state = {}
+        for state in self.conversation._conversations.values():
+            by_state[state] = by_state.get(state, 0) + 1
+        return by_state
+
+    def stats(self) -> dict:
+        """Живые сессии по состояниям и оценка занимаемой ими памяти."""
+        by_state = self.by_state()
+
+        memory = 0
+        for session in self.app.user_data.values():
+            memory += sys.getsizeof(session)
+            memory += sum(sys.getsizeof(value) for value in session.to_row() if value is not None)
+
+        # ru_maxrss — пиковый RSS (в КБ на Linux)
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else None
+        return {
+            "sessions": len(self.app.user_data),
+            "by_state": by_state,
+            "memory_bytes": memory,
+            "rss_peak_bytes": rss_peak,
+            "evicted_total": self.evicted,
+            "abandoned_total": self.abandoned,
+        }
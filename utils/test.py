@@ -1,3 +1,9 @@
+import hashlib
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
 MEDICAL_NOTES = {
     "atopic_dermatitis": "Атопический дерматит — хроническое воспалительное заболевание кожи, сопровождается зудом и сухостью.",
     "eczema": "Экзема — воспаление кожи с зудом и сыпью, часто аллергической природы.",
@@ -102,44 +108,179 @@ QUESTIONS = [
 ]
 
 
+def questionnaire_version(questions=QUESTIONS) -> str:
+    """
+    Отпечаток анкеты (категории и тексты вопросов). Сохраняется вместе
+    с результатом теста, чтобы после правки QUESTIONS найти устаревшие записи.
+    """
+    payload = json.dumps([(cat, q) for cat, q, _ in questions], ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:8]
+
+
+QUESTIONNAIRE_VERSION = questionnaire_version()
+
+
+AXES = ["O/D", "S/R", "P/N", "W/T"]
+
+EXPLANATIONS = {
+    "O": "Жирная", "D": "Сухая",
+    "S": "Чувствительная", "R": "Устойчивая",
+    "P": "Пигментированная", "N": "Без склонности к пигментации",
+    "W": "Склонна к морщинам", "T": "Плотная/упругая"
+}
+
+# Все 16 кодов Бауманн в порядке индекса: бит оси = 1, если победил вариант «A»
+SKIN_CODES = [
+    "".join(axis.split("/")[0 if (idx >> (3 - i)) & 1 else 1] for i, axis in enumerate(AXES))
+    for idx in range(16)
+]
+
+
+def _explain(code: str) -> str:
+    parts = [EXPLANATIONS.get(c, "") for c in code]
+    return f"Тип кожи: {', '.join(parts)}."
+
+
+# Тексты объяснений готовятся один раз для всех 16 кодов
+SKIN_DESCRIPTIONS = {code: _explain(code) for code in SKIN_CODES}
 
 
+class PreparedQuestion:
+    """Готовое к отправке сообщение с вопросом (текст и кнопки)."""
+    __slots__ = ("text", "buttons")
+
+    def __init__(self, text: str, buttons: tuple):
+        self.text = text
+        self.buttons = buttons     # ((подпись, callback_data), ...)
+
 
 class SkinTest:
+    """
+    Анкета компилируется один раз при создании:
+      - prepared — тексты и кнопки всех вопросов;
+      - axis_masks — битовые маски вопросов каждой оси.
+    Ответы копятся в одном int (бит i = 1, если на вопрос i ответили «A»),
+    а классификация — это popcount по маскам и индекс в таблице 16 кодов.
+    """
+
     def __init__(self, questions=QUESTIONS):
         self.questions = questions
+        self.version = questionnaire_version(questions)
+        self.categories = [cat for cat, _, _ in questions]
+
+        self.prepared = tuple(self._prepare(question, options) for _, question, options in questions)
+        self.axis_masks = tuple(
+            sum(1 << i for i, cat in enumerate(self.categories) if cat == axis) for axis in AXES
+        )
+        self.axis_sizes = tuple(mask.bit_count() for mask in self.axis_masks)
+        self.full_mask = (1 << len(questions)) - 1
+        self.results = tuple({"code": code, "desc": SKIN_DESCRIPTIONS[code]} for code in SKIN_CODES)
+
+    @staticmethod
+    def _prepare(question: str, options: dict) -> PreparedQuestion:
+        # Если есть заметка, добавляем её
+        note_text = options.get("note", "")
+        text = f"{question}\n\n{note_text}\n\nВыберите вариант:"
+        buttons = ((f"A: {options['A']}", "A"), (f"B: {options['B']}", "B"))
+        return PreparedQuestion(text, buttons)
+
+    # -----------------------------------------------------------
+    #                    УПАКОВАННЫЕ ОТВЕТЫ
+    # -----------------------------------------------------------
+
+    @staticmethod
+    def pack_answer(bits: int, index: int, answer: str) -> int:
+        """Добавляет ответ на вопрос index к упакованным ответам."""
+        return bits | (1 << index) if answer == "A" else bits & ~(1 << index)
+
+    def unpack(self, bits: int, count: int = None) -> list:
+        """Упакованные ответы → ["A", "B", ...] по порядку вопросов."""
+        count = len(self.questions) if count is None else count
+        return ["A" if (bits >> i) & 1 else "B" for i in range(count)]
+
+    def pack(self, answers) -> int:
+        bits = 0
+        for i, answer in enumerate(answers):
+            bits = self.pack_answer(bits, i, answer)
+        return bits
+
+    def classify_bits(self, bits: int, answered: int = None) -> dict:
+        """
+        Классификация по упакованным ответам за O(1).
+        answered — маска отвеченных вопросов (по умолчанию все).
+        """
+        answered = self.full_mask if answered is None else answered
+        idx = 0
+        for mask in self.axis_masks:
+            a_count = (bits & answered & mask).bit_count()
+            b_count = (answered & mask).bit_count() - a_count
+            idx = (idx << 1) | (a_count > b_count)
+        return dict(self.results[idx])           # копия: общий результат не должен меняться у вызывающих
+
+    def pair_answers(self, answers):
+        """Ответы по порядку вопросов ["A", "B", ...] → [(категория, ответ), ...]."""
+        return list(zip(self.categories, answers))
 
     def classify_baumann(self, answers):
         """
         answers: список кортежей (категория, выбранный вариант)
         """
-        summary = {"O/D": [], "S/R": [], "P/N": [], "W/T": []}
+        a_counts = dict.fromkeys(AXES, 0)
+        b_counts = dict.fromkeys(AXES, 0)
         for cat, ans in answers:
-            summary[cat].append(ans)
-
-        result = {}
-        for cat, vals in summary.items():
-            a_count = vals.count("A")
-            b_count = vals.count("B")
-            if cat == "O/D":
-                result[cat] = "O" if a_count > b_count else "D"
-            elif cat == "S/R":
-                result[cat] = "S" if a_count > b_count else "R"
-            elif cat == "P/N":
-                result[cat] = "P" if a_count > b_count else "N"
-            elif cat == "W/T":
-                result[cat] = "W" if a_count > b_count else "T"
-
-        code = result["O/D"] + result["S/R"] + result["P/N"] + result["W/T"]
-        desc = self.explain_skin_type(code)
-        return {"code": code, "desc": desc}
+            if ans == "A":
+                a_counts[cat] += 1
+            elif ans == "B":
+                b_counts[cat] += 1
+
+        idx = 0
+        for axis in AXES:
+            idx = (idx << 1) | (a_counts[axis] > b_counts[axis])
+        return dict(self.results[idx])
 
     def explain_skin_type(self, code):
-        explanations = {
-            "O": "Жирная", "D": "Сухая",
-            "S": "Чувствительная", "R": "Устойчивая",
-            "P": "Пигментированная", "N": "Без склонности к пигментации",
-            "W": "Склонна к морщинам", "T": "Плотная/упругая"
-        }
-        parts = [explanations.get(c, "") for c in code]
-        return f"Тип кожи: {', '.join(parts)}."
+        description = SKIN_DESCRIPTIONS.get(code)
+        return description if description is not None else _explain(code)
+
+
+# ===============================================================
+#                  АНАЛИТИКА И ФИНАЛЬНЫЙ ТИП КОЖИ
+# ===============================================================
+def compare_skin_types(skin_code: str, skin_type_dermatoscopy: str) -> dict:
+    """
+    Сравнивает тип кожи по тесту и по дерматоскопии посимвольно.
+    Возвращает процент совпадения и финальный тип кожи.
+    
+    Логика:
+    - Для каждой позиции из 4 символов:
+        - Если символы совпадают, увеличиваем счётчик совпадений и добавляем этот символ в финальный код
+        - Если нет — добавляем символ из дерматоскопии
+    - match_percent = (совпадения / 4) * 100
+    """
+    # Очистка входных данных
+    s1 = (skin_code or "").strip().upper()[:4]
+    s2 = (skin_type_dermatoscopy or "").strip().upper()[:4]
+
+    # Если один из кодов пустой, финальный тип = непустой, совпадение = 0%
+    if not s1:
+        return {"match_percent": 0, "final_skin_type": s2}
+    if not s2:
+        return {"match_percent": 0, "final_skin_type": s1}
+
+    matches = 0
+    final_type = []
+
+    for i, (c_test, c_derm) in enumerate(zip(s1, s2)):
+        if c_test == c_derm:
+            matches += 1
+            final_type.append(c_test)
+        else:
+            final_type.append(c_derm)
+
+    match_percent = round((matches / 4) * 100, 2)
+    final_skin_type = "".join(final_type)
+
+    logger.debug("test: %s, derm: %s, matches: %s, final: %s, %%: %s",
+                 s1, s2, matches, final_skin_type, match_percent)
+
+    return {"match_percent": match_percent, "final_skin_type": final_skin_type}
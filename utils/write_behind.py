@@ -0,0 +1,193 @@
+import asyncio
+
+# ===============================================================
+#            ОТЛОЖЕННАЯ ПАКЕТНАЯ ЗАПИСЬ В POSTGRES
+# ===============================================================
+#
+# Вместо отдельного запроса на каждое нажатие кнопки операции копятся
+# в очереди и уходят в базу одной транзакцией:
+#   - обычные INSERT/UPDATE/upsert — через executemany (подряд идущие
+#     одинаковые запросы группируются, порядок операций сохраняется);
+#   - вставки новых пациентов — через COPY с заранее выданными id
+#     из последовательности, так что RETURNING id по-прежнему доступен.
+#
+# Сброс происходит, когда накопилось batch_size операций или прошло
+# flush_interval секунд с первой несброшенной операции. max_pending
+# ограничивает, сколько операций может быть потеряно при падении
+# процесса: при переполнении вызывающий код ждёт сброса.
+
+
+class WriteBehindQueue:
+    def __init__(self, pool_owner, batch_size: int = 200, flush_interval: float = 0.05,
+                 max_pending: int = 2000):
+        self.owner = pool_owner          # объект с методом acquire() (DBHandler)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = []               # [(kind, sql/table, args, future)]
+        self._has_data = asyncio.Event()
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._stopping = False
+        self.flushed_ops = 0
+        self.flushes = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        """
+        Гарантированный сброс всего накопленного при остановке. Фоновый
+        цикл не отменяется (отмена посреди flush потеряла бы пакет), а
+        доводит текущий сброс до конца и выходит сам.
+        """
+        if self._task is not None:
+            self._stopping = True
+            self._has_data.set()
+            self._full.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    # -----------------------------------------------------------
+    #                       ПОСТАНОВКА В ОЧЕРЕДЬ
+    # -----------------------------------------------------------
+
+    async def execute(self, sql: str, args: tuple, wait: bool = False):
+        """Отложенный execute; wait=True — дождаться записи в базу."""
+        return await self._submit(("exec", sql, args), wait)
+
+    async def copy_insert(self, table: str, columns: tuple, args: tuple, wait: bool = True, upsert: str = None):
+        """
+        Отложенная вставка строки через COPY.
+        Возвращает сгенерированный id (если wait=True).
+        upsert — запрос с теми же аргументами и RETURNING id: им операция
+        выполняется при повторе по одной (например, строка уже есть и COPY
+        упал на уникальном ключе).
+        """
+        return await self._submit(("copy", (table, columns, upsert), args), wait)
+
+    async def _submit(self, op, wait: bool):
+        if len(self._pending) >= self.max_pending:
+            await self.flush()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((*op, future))
+        self._has_data.set()
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+        if wait:
+            return await future
+        # Ошибку никто не ждёт — не даём asyncio ругаться на неё
+        future.add_done_callback(_consume_error)
+        return None
+
+    # -----------------------------------------------------------
+    #                            СБРОС
+    # -----------------------------------------------------------
+
+    async def _run(self):
+        while not self._stopping:
+            await self._has_data.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"❌ Сброс очереди записи не удался: {e!r}")
+
+    async def flush(self):
+        async with self._flush_lock:
+            ops, self._pending = self._pending, []
+            self._has_data.clear()
+            self._full.clear()
+            if not ops:
+                return
+            try:
+                await self._write(ops)
+            except asyncio.CancelledError:
+                # Незаписанные операции (транзакция откатилась) — обратно в начало
+                # очереди, их запишет следующий сброс (в том числе из close())
+                self._pending[:0] = [op for op in ops if not op[-1].done()]
+                self._has_data.set()
+                raise
+            self.flushes += 1
+            self.flushed_ops += len(ops)
+
+    async def _write(self, ops):
+        try:
+            async with self.owner.acquire() as conn:
+                async with conn.transaction():
+                    results = await self._apply(conn, ops)
+        except Exception as e:
+            # Одна плохая строка не должна терять весь пакет:
+            # повторяем операции по одной, ошибки — только своим владельцам.
+            print(f"⚠️ Пакетная запись не удалась ({e!r}), повтор по одной операции")
+            await self._apply_one_by_one(ops)
+        else:
+            for (*_, future), result in zip(ops, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def _apply(self, conn, ops) -> list:
+        results = []
+        for kind, target, group in _runs(ops):
+            args_list = [args for _, _, args, _ in group]
+            if kind == "exec":
+                await conn.executemany(target, args_list)
+                results.extend([None] * len(group))
+            else:
+                table, columns, _ = target
+                ids = await conn.fetch(
+                    "SELECT nextval(pg_get_serial_sequence($1, 'id')) AS id "
+                    "FROM generate_series(1, $2);", table, len(group)
+                )
+                ids = [r["id"] for r in ids]
+                await conn.copy_records_to_table(
+                    table,
+                    records=[(i, *args) for i, args in zip(ids, args_list)],
+                    columns=("id", *columns)
+                )
+                results.extend(ids)
+        return results
+
+    async def _apply_one_by_one(self, ops):
+        for op in ops:
+            future = op[-1]
+            kind, target, args, _ = op
+            try:
+                async with self.owner.acquire() as conn:
+                    if kind == "copy" and target[2]:
+                        result = [await conn.fetchval(target[2], *args)]
+                    else:
+                        result = await self._apply(conn, [op])
+            except Exception as e:
+                print(f"❌ Операция не записана: {e!r}")
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result[0])
+
+
+def _runs(ops):
+    """Разбивает операции на подряд идущие группы с одинаковым запросом."""
+    group = []
+    for op in ops:
+        if group and (op[0], op[1]) != (group[0][0], group[0][1]):
+            yield group[0][0], group[0][1], group
+            group = []
+        group.append(op)
+    if group:
+        yield group[0][0], group[0][1], group
+
+
+def _consume_error(future):
+    if not future.cancelled():
+        future.exception()